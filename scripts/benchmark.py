@@ -0,0 +1,306 @@
+"""
+Microbenchmarks of the message store and context building hot paths.
+
+    PYTHONPATH=src python scripts/benchmark.py --output bench.json
+    PYTHONPATH=src python scripts/benchmark.py --compare bench-old.json --output bench.json
+    PYTHONPATH=src python scripts/benchmark.py -k fetch --redis-url redis://localhost:6379/15
+
+The store cases time AsyncMessageStore, the store the handlers use. They
+run offline against fakeredis (install it with `uv run --with fakeredis`)
+or, with --redis-url, against a local Redis: only keys under
+matvey-3000:bench: and their entries in the matvey-3000:history-index
+sorted set are written there, and all of them are removed afterwards.
+
+Every case is run in rounds long enough to time reliably; per call timings
+(min, median, mean) are written as JSON together with the commit, so two
+runs can be compared with --compare.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from pathlib import Path
+
+# bot.py creates the Bot and the stores at import time
+os.environ.setdefault('TELEGRAM_API_TOKEN', '123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11')
+os.environ.setdefault('BOT_CONFIG_TOML', str(Path(__file__).parent.parent / 'matvey-template.toml'))
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379')
+
+from aiogram import types
+
+from bot import extract_message_chain
+import executor
+from message_store import (
+    HISTORY_BUCKET_SECONDS,
+    AsyncMessageStore,
+    StoredChatMessage,
+    count_tokens,
+    get_encoding,
+)
+from summarizer import MAX_CHUNK_TOKENS, chunk_texts
+
+# bot.py logs at DEBUG, which would be most of what gets timed
+logging.getLogger().setLevel(logging.WARNING)
+
+KEY_PREFIX = 'matvey-3000:bench:'
+BOT_USERNAME = 'matvey_bench_bot'
+BOT_ID = 22222222
+SYSTEM_PROMPT = ('system', 'you are a helpful bot')
+# messages of a generated chat are this many seconds apart
+MESSAGE_INTERVAL_SECONDS = 30
+MIN_ROUND_SECONDS = 0.05
+ROUNDS = 7
+
+WORDS = (
+    'матвей привет как дела что нового сегодня завтра погода кофе код redis '
+    'python бот сообщение история контекст модель токен ответ вопрос ладно'
+).split()
+
+# a store case returns a coroutine, it is awaited in the timing loop
+Case = Callable[[], object] | Callable[[], Awaitable[object]]
+
+
+def make_text(rng: random.Random) -> str:
+    return ' '.join(rng.choices(WORDS, k=rng.randint(3, 60)))
+
+
+def make_messages(count: int, seed: int = 0) -> list[StoredChatMessage]:
+    """Messages of a chat that is active now: the newest ones are in the current bucket."""
+    rng = random.Random(seed)
+    users = [('alice', 'Alice A'), ('bob', 'Bob B'), (BOT_USERNAME, 'Matvey')]
+    first = int(time.time()) - count * MESSAGE_INTERVAL_SECONDS
+    messages = []
+    for i in range(count):
+        username, full_name = rng.choice(users)
+        messages.append(StoredChatMessage(
+            chat_name='',
+            from_username=username,
+            from_full_name=full_name,
+            timestamp=first + i * MESSAGE_INTERVAL_SECONDS,
+            text=make_text(rng),
+        ))
+    return messages
+
+
+def make_reply_chain(depth: int) -> types.Message:
+    """A message at the end of a chain of depth replies alternating user and bot."""
+    rng = random.Random(depth)
+    chat = {'id': -100, 'type': 'group'}
+    message = None
+    for i in range(depth + 1):
+        user_id = BOT_ID if i % 2 else 12345678
+        data = {
+            'message_id': i + 1,
+            'date': 0,
+            'chat': chat,
+            'from': {'id': user_id, 'is_bot': user_id == BOT_ID, 'first_name': 'x'},
+            'text': make_text(rng),
+        }
+        if message is not None:
+            data['reply_to_message'] = message
+        message = types.Message.model_validate(data)
+    return message
+
+
+class Bench:
+    def __init__(self, store: AsyncMessageStore):
+        self.store = store
+        self.cases: dict[str, Case] = {}
+        self.keys: list[str] = []
+
+    def case(self, name: str, func: Case) -> None:
+        self.cases[name] = func
+
+    async def key(self, name: str) -> str:
+        """An empty history key, deleted again (index entry included) by cleanup()."""
+        key = f'{KEY_PREFIX}{name}'
+        await self.store.clear_conversation_history(key)
+        self.keys.append(key)
+        return key
+
+    async def history(self, name: str, count: int) -> str:
+        key = await self.key(name)
+        messages = make_messages(count)
+        for start in range(0, count, 500):
+            await self.store.save_many(key, messages[start:start + 500], max_messages=None)
+        return key
+
+    async def cleanup(self) -> None:
+        for key in self.keys:
+            await self.store.clear_conversation_history(key)
+
+
+async def define_cases(bench: Bench) -> None:
+    message = make_messages(1, seed=1)[0]
+    message.ensure_token_count()
+    compact = message.serialize()
+    legacy = message.serialize_json()
+    bench.case('serialize/compact', message.serialize)
+    bench.case('serialize/json', message.serialize_json)
+    bench.case('deserialize/compact', lambda: StoredChatMessage.deserialize(compact))
+    bench.case('deserialize/json', lambda: StoredChatMessage.deserialize(legacy))
+
+    save_key = await bench.key('save')
+    bench.case('save/one', lambda: bench.store.save(save_key, message))
+    batch = make_messages(100, seed=2)
+    many_key = await bench.key('save-many')
+    bench.case('save_many/100', lambda: bench.store.save_many(many_key, batch, max_messages=None))
+
+    history = await bench.history('history-5000', 5000)
+    for limit in (10, 100, 1000, 5000):
+        bench.case(f'fetch_messages/limit={limit}', lambda limit=limit: bench.store.fetch_messages(history, limit))
+    since = time.time() - 6 * HISTORY_BUCKET_SECONDS
+    bench.case('fetch_messages_since/6h', lambda: bench.store.fetch_messages_since(history, since))
+
+    for size in (100, 2000):
+        key = await bench.history(f'context-{size}', size)
+        for limit in (20, size):
+            for max_tokens in (1000, 4000, 16000):
+                bench.case(
+                    f'build_context_messages/history={size}/limit={limit}/tokens={max_tokens}',
+                    lambda key=key, limit=limit, max_tokens=max_tokens: bench.store.build_context_messages(
+                        key, limit, BOT_USERNAME, SYSTEM_PROMPT, max_tokens=max_tokens,
+                    ),
+                )
+
+    for depth in (1, 10, 50):
+        last = make_reply_chain(depth)
+        bench.case(f'extract_message_chain/depth={depth}', lambda last=last: extract_message_chain(last, BOT_ID))
+
+    for count in (1000, 10000):
+        texts = [str(m) for m in make_messages(count, seed=3)]
+        for overlap in (0, 500):
+            bench.case(
+                f'chunk_texts/messages={count}/overlap={overlap}',
+                lambda texts=texts, overlap=overlap: chunk_texts(texts, count_tokens, MAX_CHUNK_TOKENS, overlap),
+            )
+
+
+async def measure(func: Case, rounds: int = ROUNDS) -> dict:
+    """Per call times in microseconds, timeit.autorange style."""
+    # warm up caches and lazily created connections
+    is_async = inspect.isawaitable(result := func())
+    if is_async:
+        await result
+
+    async def run(number: int) -> float:
+        started = time.perf_counter()
+        if is_async:
+            for _ in range(number):
+                await func()
+        else:
+            for _ in range(number):
+                func()
+        return time.perf_counter() - started
+
+    number = 1
+    while True:
+        elapsed = await run(number)
+        if elapsed >= MIN_ROUND_SECONDS:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(MIN_ROUND_SECONDS / elapsed * 1.2))
+
+    samples = [elapsed / number]
+    for _ in range(rounds - 1):
+        samples.append(await run(number) / number)
+    return {
+        'calls_per_round': number,
+        'rounds': rounds,
+        'min_us': min(samples) * 1e6,
+        'median_us': statistics.median(samples) * 1e6,
+        'mean_us': statistics.fmean(samples) * 1e6,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_store(redis_url: str | None) -> tuple[AsyncMessageStore, str]:
+    if redis_url:
+        return AsyncMessageStore(redis_url), 'redis'
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit('fakeredis is not installed: run with `uv run --with fakeredis` or pass --redis-url')
+    store = AsyncMessageStore('redis://localhost:6379')
+    store.redis_conn = fakeredis.FakeAsyncRedis()
+    return store, 'fakeredis'
+
+
+def selected(cases: dict[str, Case], patterns: list[str] | None) -> Iterator[tuple[str, Case]]:
+    for name, func in cases.items():
+        if not patterns or any(pattern in name for pattern in patterns):
+            yield name, func
+
+
+def compare(old: dict, new: dict) -> None:
+    old_results = old['results']
+    print(f"\nvs {old['meta'].get('commit')} ({old['meta'].get('backend')})", file=sys.stderr)
+    for name, result in new['results'].items():
+        if name not in old_results:
+            continue
+        before, after = old_results[name]['median_us'], result['median_us']
+        change = (after - before) / before * 100 if before else 0.0
+        print(f'{name:70} {before:12.2f} -> {after:12.2f} us  {change:+7.1f}%', file=sys.stderr)
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the message store and context building')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='JSON of an earlier run to compare medians with')
+    parser.add_argument('--redis-url', help='use this Redis instead of fakeredis')
+    parser.add_argument('-k', dest='patterns', action='append', help='only cases containing this, can be repeated')
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    return parser.parse_args(argv)
+
+
+async def main(argv: list[str]) -> None:
+    args = parse_args(argv)
+    store, backend = make_store(args.redis_url)
+    bench = Bench(store)
+    try:
+        await define_cases(bench)
+        results = {}
+        for name, func in selected(bench.cases, args.patterns):
+            results[name] = await measure(func, args.rounds)
+            print(f"{name:70} {results[name]['median_us']:12.2f} us", file=sys.stderr)
+    finally:
+        await bench.cleanup()
+        await store.close()
+        executor.shutdown()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'backend': backend,
+            'tiktoken': get_encoding() is not None,
+        },
+        'results': results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), report)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
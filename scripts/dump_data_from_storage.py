@@ -1,32 +1,139 @@
+"""
+Export chat history to gzipped JSONL and import it back.
+
+    PYTHONPATH=src python scripts/dump_data_from_storage.py export backup.jsonl.gz
+    PYTHONPATH=src python scripts/dump_data_from_storage.py export --chat-id -100123 chat.jsonl.gz
+    PYTHONPATH=src python scripts/dump_data_from_storage.py import backup.jsonl.gz
+
+Chats are taken from the history key index (or found with SCAN with --scan),
+history is read a fixed window of entries per LRANGE and written in batches
+of pipelined RPUSH, so memory use doesn't grow with the size of the history.
+Keys are built from BOT_CONFIG_TOML, so a dump can be loaded into another bot.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
 import os
 import sys
-import tempfile
+from collections.abc import AsyncIterator, Iterator
 
 from config import Config
-from message_store import MessageStore
+import executor
+from message_store import HISTORY_READ_WINDOW, AsyncMessageStore, StoredChatMessage
 
+IMPORT_BATCH = 500
 
-def main(config: Config, store: MessageStore, chat_id: int, limit: int = -1):
-    tag = f'matvey-3000:history:{config.me_strip_lower}:{chat_id}'
-    tag = f'matvey-3000:history:matthew_3000_bot:{chat_id}'
 
-    with tempfile.NamedTemporaryFile(
-        mode='w+t',
-        prefix='matvey-3000',
-        delete=False,
-    ) as fp:
-        messages = store.fetch_messages(key=tag, limit=-1, raw=True)
-        print(f'Found {len(messages)} messages in {tag}')
-        for m in messages:
-            print(m.decode().strip(), file=fp)
-        print(f'Saved contents as {fp.name}')
+def progress(line: str) -> None:
+    print(f'\r{line}', end='', file=sys.stderr, flush=True)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('Need chat_id as a parameter')
-        sys.exit(1)
-    chat_id = int(sys.argv[1])
+async def history_keys(config: Config, store: AsyncMessageStore, args) -> AsyncIterator[str]:
+    if args.chat_id:
+        for chat_id in args.chat_id:
+            yield config.history_tag(chat_id)
+    elif args.scan:
+        async for key in store.scan_keys(config.history_tag('*:buckets')):
+            yield key.removesuffix(':buckets')
+    else:
+        prefix = config.history_tag('')
+        for key in await store.history_keys():
+            if key.startswith(prefix):
+                yield key
+
+
+def to_line(chat_id: int, message: StoredChatMessage) -> str:
+    return json.dumps({
+        'chat_id': chat_id,
+        'from_username': message.from_username,
+        'from_full_name': message.from_full_name,
+        'timestamp': message.timestamp,
+        'text': message.text,
+        'token_count': message.token_count,
+    }, ensure_ascii=False)
+
+
+def from_line(line: str) -> tuple[int, StoredChatMessage]:
+    data = json.loads(line)
+    chat_id = data.pop('chat_id')
+    return chat_id, StoredChatMessage(chat_name='', **data)
+
+
+async def export(config: Config, store: AsyncMessageStore, args) -> None:
+    chats = exported = 0
+    with gzip.open(args.path, 'wt', encoding='utf-8') as fp:
+        async for key in history_keys(config, store, args):
+            chat_id = int(key.rsplit(':', 1)[1])
+            total = await store.count_messages(key)
+            done = 0
+            async for window in store.iter_messages(key, window=args.window):
+                fp.writelines(to_line(chat_id, message) + '\n' for message in window)
+                done += len(window)
+                progress(f'{key}: {done}/{total}')
+            print(file=sys.stderr)
+            chats += 1
+            exported += done
+    print(f'Exported {exported} messages of {chats} chats to {args.path}', file=sys.stderr)
+
+
+def read_lines(path: str) -> Iterator[tuple[int, StoredChatMessage]]:
+    with gzip.open(path, 'rt', encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                yield from_line(line)
+
+
+async def import_(config: Config, store: AsyncMessageStore, args) -> None:
+    imported = 0
+    # the export writes each chat's messages together, oldest first
+    for chat_id, chat_lines in itertools.groupby(read_lines(args.path), key=lambda item: item[0]):
+        key = config.history_tag(chat_id)
+        chat_config = config[chat_id]
+        done = 0
+        messages = (message for _, message in chat_lines)
+        while batch := list(itertools.islice(messages, args.batch)):
+            await store.save_many(key, batch, max_age=chat_config.history_max_age_seconds, max_messages=None)
+            done += len(batch)
+            progress(f'{key}: {done}')
+        await store.apply_retention(key, chat_config.history_max_age_seconds, chat_config.history_max_messages)
+        print(file=sys.stderr)
+        imported += done
+    print(f'Imported {imported} messages from {args.path}', file=sys.stderr)
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Export and import chat history')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='write history to a .jsonl.gz file')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--chat-id', type=int, action='append', help='only this chat, can be repeated')
+    export_parser.add_argument('--scan', action='store_true', help='find chats with SCAN instead of the key index')
+    export_parser.add_argument('--window', type=int, default=HISTORY_READ_WINDOW, help='entries per LRANGE')
+
+    import_parser = commands.add_parser('import', help='load history from a .jsonl.gz file')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--batch', type=int, default=IMPORT_BATCH, help='messages per pipelined write')
+    return parser.parse_args(argv)
+
+
+async def main(argv: list[str]) -> None:
+    args = parse_args(argv)
     config = Config.read_toml(path=os.getenv('BOT_CONFIG_TOML'))
-    store = MessageStore.from_env()
-    main(config, store, chat_id)
+    store = AsyncMessageStore.from_env()
+    try:
+        if args.command == 'export':
+            await export(config, store, args)
+        else:
+            await import_(config, store, args)
+    finally:
+        await store.close()
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,509 @@
+"""
+End-to-end load test: synthetic Telegram updates fed into the real
+dispatcher, with the Bot API and the LLM/image/audio providers faked.
+
+    PYTHONPATH=src python scripts/loadtest.py --rate 20 --rate 50 --rate 100 --duration 30
+    PYTHONPATH=src python scripts/loadtest.py --mix text=1 --text-latency 2:10 --output load.json
+
+Updates are sent open loop at each --rate in turn, so a stage that can't
+keep up shows it in the latencies instead of silently sending less. Handler
+latency counts from when an update was due to when the dispatcher finished
+with it; slow commands queued as background jobs are timed separately from
+enqueue to done by job workers running alongside. The event loop lag is
+sampled throughout.
+
+Everything but the providers and Telegram is real: middlewares, filters,
+handlers, the concurrency limiter, provider routing and quotas, the message
+store (on fakeredis, or a local Redis with REDIS_URL=... --real-redis).
+Chats come from scripts/loadtest.toml (or BOT_CONFIG_TOML) and are cloned
+--chats times so per-chat limits don't dominate.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# bot.py creates the Bot and the stores at import time
+os.environ.setdefault('TELEGRAM_API_TOKEN', '123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11')
+os.environ.setdefault('BOT_CONFIG_TOML', str(Path(__file__).parent / 'loadtest.toml'))
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379')
+# provider clients are created lazily and never used, but want a key
+os.environ.setdefault('OPENAI_API_KEY', 'sk-loadtest')
+os.environ.setdefault('ANTHROPIC_API_KEY', 'sk-ant-loadtest')
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.base import BaseSession
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import TelegramMethod
+
+import bot as bot_module
+import executor
+from jobs import Job
+from provider_stub import Latency
+from providers import AudioResponse, ImageResponse, ReplicateEdit, TextResponse
+from providers import clients as provider_clients
+from throttling import SHED_REACTION
+
+# bot.py logs at DEBUG, which would be most of what gets measured
+logging.getLogger().setLevel(logging.WARNING)
+
+LOOP_LAG_INTERVAL_SECONDS = 0.01
+# how long an idle job worker waits between polls of fakeredis
+FAKE_BLOCK_SECONDS = 0.01
+# distinct voice messages and photos, so the file cache gets some hits
+FILE_POOL = 50
+FILE_BYTES = b'\x00' * 32 * 1024
+DEFAULT_MIX = 'text=70,command=15,voice=10,photo=5'
+WORDS = 'привет как дела что нового сегодня погода кофе код бот история ответ вопрос'.split()
+
+
+class FakeProviders:
+    """Replace the calls that leave the process with sleeps of the configured latency."""
+
+    def __init__(self, text: Latency, image: Latency, audio: Latency, stream_chunks: int, rng: random.Random):
+        self.text = text
+        self.image = image
+        self.audio = audio
+        self.stream_chunks = stream_chunks
+        self.rng = rng
+        self.calls: Counter[str] = Counter()
+
+    def install(self) -> None:
+        TextResponse._generate_from = classmethod(self._generate_from)
+        TextResponse._stream_openai = classmethod(self._stream)
+        TextResponse._stream_anthropic = classmethod(self._stream)
+        TextResponse._stream_yandexgpt = classmethod(self._stream)
+        ImageResponse._generate_dalle = classmethod(self._generate_dalle)
+        AudioResponse.transcribe = classmethod(self._transcribe)
+        AudioResponse.text_to_speech = classmethod(self._text_to_speech)
+        ReplicateEdit.edit = classmethod(self._replicate)
+        ReplicateEdit.remove_background = classmethod(self._replicate)
+
+    async def _generate_from(self, cls, config, provider, model, messages):
+        self.calls[f'text.{provider}'] += 1
+        await asyncio.sleep(self.text.sample(self.rng))
+        text = ' '.join(self.rng.choices(WORDS, k=self.rng.randint(5, 80)))
+        return cls(success=True, text=text, tokens_used=len(text) // 4)
+
+    async def _stream(self, cls, client, model, messages):
+        self.calls['text.stream'] += 1
+        total = self.text.sample(self.rng)
+        for _ in range(self.stream_chunks):
+            await asyncio.sleep(total / self.stream_chunks)
+            yield ' '.join(self.rng.choices(WORDS, k=4)) + ' '
+
+    async def _generate_dalle(self, cls, client, prompt, model='dall-e-2', size='512x512'):
+        self.calls['image.dalle'] += 1
+        await asyncio.sleep(self.image.sample(self.rng))
+        return cls(success=True, b64_or_url='https://example.com/image.png')
+
+    async def _transcribe(self, cls, audio_bytes, filename='audio.ogg', speedup=2.0):
+        self.calls['audio.transcribe'] += 1
+        await asyncio.sleep(self.audio.sample(self.rng))
+        return cls(success=True, data=' '.join(self.rng.choices(WORDS, k=20)))
+
+    async def _text_to_speech(self, cls, text, voice='alloy', model='tts-1'):
+        self.calls['audio.tts'] += 1
+        await asyncio.sleep(self.audio.sample(self.rng))
+        return cls(success=True, data=FILE_BYTES)
+
+    async def _replicate(self, cls, image_bytes, *args):
+        self.calls['image.replicate'] += 1
+        await asyncio.sleep(self.image.sample(self.rng))
+        return cls(success=True, image_url='https://example.com/edited.png')
+
+
+class RecordingSession(BaseSession):
+    """Bot API session answering every call locally, after a Telegram-like delay."""
+
+    def __init__(self, me: types.User, latency: Latency, rng: random.Random):
+        super().__init__()
+        self.me = me
+        self.latency = latency
+        self.rng = rng
+        self.calls: Counter[str] = Counter()
+        self.shed = 0
+        self._message_ids = itertools.count(1_000_000)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if name == 'SetMessageReaction' and any(r.emoji == SHED_REACTION for r in method.reaction or ()):
+            self.shed += 1
+        await asyncio.sleep(self.latency.sample(self.rng))
+        return self._result(bot, method)
+
+    def _result(self, bot: Bot, method: TelegramMethod):
+        returning = method.__returning__
+        if returning is types.Message:
+            chat_id = int(method.chat_id)
+            return types.Message.model_validate({
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                'from': self.me.model_dump(),
+                'text': getattr(method, 'text', None),
+            }, context={'bot': bot})
+        if returning is types.File:
+            return types.File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f'files/{method.file_id}')
+        if returning is types.User:
+            return self.me
+        # bool, and Message | bool of edits
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        await asyncio.sleep(self.latency.sample(self.rng))
+        yield FILE_BYTES
+
+    async def close(self) -> None:
+        pass
+
+
+class Updates:
+    """Synthetic updates of each kind for the chats of the config."""
+
+    def __init__(self, config, rng: random.Random):
+        self.config = config
+        self.rng = rng
+        chats = list(config.configs.values())
+        self.chats = [chat.chat_id for chat in chats]
+        self.voice_chats = [chat.chat_id for chat in chats if chat.voice_enabled] or self.chats
+        self.summary_chats = {chat.chat_id for chat in chats if chat.summary_enabled}
+        self._ids = itertools.count(1)
+
+    def make(self, kind: str) -> types.Update:
+        return getattr(self, f'_{kind}')()
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        user_id = self.rng.randint(1, 200)
+        return {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'load test'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+            **fields,
+        }
+
+    def _update(self, message: dict) -> types.Update:
+        return types.Update.model_validate({'update_id': message['message_id'], 'message': message})
+
+    def _words(self, low: int, high: int) -> str:
+        return ' '.join(self.rng.choices(WORDS, k=self.rng.randint(low, high)))
+
+    def _text(self) -> types.Update:
+        chat_id = self.rng.choice(self.chats)
+        text = self._words(2, 40)
+        if chat_id < 0:
+            text = f'{self.config.me} {text}'
+        fields = {'text': text}
+        if self.rng.random() < 0.3:
+            # continuing a thread with the bot
+            fields['reply_to_message'] = self._message(
+                chat_id, text=self._words(5, 30),
+                **{'from': {'id': bot_module.bot.id, 'is_bot': True, 'first_name': 'Matvey'}},
+            )
+        return self._update(self._message(chat_id, **fields))
+
+    def _command(self) -> types.Update:
+        chat_id = self.rng.choice(self.chats)
+        commands = ['/ru ' + self._words(3, 20), '/en how are you doing today', '/pic a cat in a hat', '/blerb']
+        if chat_id in self.summary_chats:
+            commands.append('/sum 50')
+        text = self.rng.choice(commands)
+        command = text.split()[0]
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self._update(self._message(chat_id, text=text, entities=entities))
+
+    def _voice(self) -> types.Update:
+        chat_id = self.rng.choice(self.voice_chats)
+        n = self.rng.randrange(FILE_POOL)
+        voice = {'file_id': f'voice-{n}', 'file_unique_id': f'voice-{n}', 'duration': self.rng.randint(2, 60)}
+        return self._update(self._message(chat_id, voice=voice))
+
+    def _photo(self) -> types.Update:
+        chat_id = self.rng.choice(self.chats)
+        n = self.rng.randrange(FILE_POOL)
+        photo = [{'file_id': f'photo-{n}', 'file_unique_id': f'photo-{n}', 'width': 512, 'height': 512}]
+        text = '/edit add a hat'
+        return self._update(self._message(
+            chat_id,
+            text=text,
+            entities=[{'type': 'bot_command', 'offset': 0, 'length': len('/edit')}],
+            reply_to_message=self._message(chat_id, photo=photo),
+        ))
+
+
+def block_like_redis(store) -> None:
+    """
+    fakeredis answers BLMOVE at once instead of blocking, which would leave
+    idle job workers spinning on the event loop; wait a little instead.
+    """
+    claim_job = store.claim_job
+
+    async def claim(queue_key: str, processing_key: str, timeout: float) -> str | None:
+        payload = await claim_job(queue_key, processing_key, timeout)
+        if payload is None:
+            await asyncio.sleep(min(timeout, FAKE_BLOCK_SECONDS))
+        return payload
+
+    store.claim_job = claim
+
+
+def clone_chats(config, count: int) -> None:
+    """Make count allowed chats out of the configured ones, round robin."""
+    templates = list(config.configs.values())
+    for i in range(len(templates), count):
+        template = templates[i % len(templates)]
+        chat_id = (abs(template.chat_id) * 10_000 + i) * (1 if template.chat_id > 0 else -1)
+        config.configs[chat_id] = dataclasses.replace(template, chat_id=chat_id)
+        config.allowed_chat_id.append(chat_id)
+
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p95/p99/max in milliseconds."""
+    if not samples:
+        return {}
+    if len(samples) == 1:
+        value = samples[0] * 1000
+        return {'p50': value, 'p95': value, 'p99': value, 'max': value}
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49] * 1000, 'p95': cuts[94] * 1000, 'p99': cuts[98] * 1000, 'max': max(samples) * 1000}
+
+
+@dataclass
+class Stage:
+    rate: float
+    duration: float
+    sent: int = 0
+    handled: int = 0
+    unhandled: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    jobs_queued: int = 0
+    job_latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    jobs_elapsed: float = 0.0
+    loop_lag: list[float] = field(default_factory=list)
+
+    def report(self, session: RecordingSession, providers: FakeProviders) -> dict:
+        all_latencies = [s for samples in self.latencies.values() for s in samples]
+        all_jobs = [s for samples in self.job_latencies.values() for s in samples]
+        return {
+            'rate': self.rate,
+            'duration': self.duration,
+            'sent': self.sent,
+            'handled': self.handled,
+            'unhandled': self.unhandled,
+            'failed': self.failed,
+            'shed': session.shed,
+            'throughput': self.handled / self.elapsed if self.elapsed else 0.0,
+            'latency_ms': percentiles(all_latencies),
+            'latency_ms_by_kind': {kind: percentiles(samples) for kind, samples in self.latencies.items()},
+            'jobs': len(all_jobs),
+            'job_throughput': len(all_jobs) / self.jobs_elapsed if self.jobs_elapsed else 0.0,
+            'job_latency_ms': percentiles(all_jobs),
+            'job_latency_ms_by_kind': {kind: percentiles(samples) for kind, samples in self.job_latencies.items()},
+            'loop_lag_ms': percentiles(self.loop_lag),
+            'telegram_calls': dict(session.calls),
+            'provider_calls': dict(providers.calls),
+        }
+
+
+class LoadTest:
+    def __init__(self, dp: Dispatcher, bot: Bot, updates: Updates, mix: dict[str, float], drain_timeout: float):
+        self.dp = dp
+        self.bot = bot
+        self.updates = updates
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.drain_timeout = drain_timeout
+        self.stage: Stage | None = None
+        self._wrap_jobs()
+
+    def _wrap_jobs(self) -> None:
+        jobs = bot_module.jobs
+        enqueue, process = jobs.enqueue, jobs.process
+
+        async def counted_enqueue(kind, message, **kwargs):
+            job = await enqueue(kind, message, **kwargs)
+            self.stage.jobs_queued += 1
+            return job
+
+        async def timed_process(bot, payload):
+            job = Job.deserialize(payload)
+            await process(bot, payload)
+            self.stage.job_latencies[job.kind].append(time.time() - job.enqueued_at)
+
+        jobs.enqueue, jobs.process = counted_enqueue, timed_process
+
+    async def _sample_loop_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL_SECONDS
+            await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+            self.stage.loop_lag.append(max(0.0, loop.time() - expected))
+
+    async def _feed(self, kind: str, update: types.Update, due: float) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            result = await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logging.getLogger(__name__).exception('Handler failed for a %s update', kind)
+            self.stage.failed += 1
+            return
+        if result is UNHANDLED:
+            self.stage.unhandled += 1
+            return
+        self.stage.handled += 1
+        self.stage.latencies[kind].append(loop.time() - due)
+
+    async def run_stage(self, stage: Stage, rng: random.Random) -> None:
+        self.stage = stage
+        loop = asyncio.get_running_loop()
+        lag = asyncio.create_task(self._sample_loop_lag())
+        tasks = []
+        started = loop.time()
+        for i in range(int(stage.rate * stage.duration)):
+            due = started + i / stage.rate
+            if (delay := due - loop.time()) > 0:
+                await asyncio.sleep(delay)
+            kind = rng.choices(self.kinds, self.weights)[0]
+            tasks.append(asyncio.create_task(self._feed(kind, self.updates.make(kind), due)))
+            stage.sent += 1
+        await asyncio.gather(*tasks)
+        stage.elapsed = loop.time() - started
+
+        deadline = loop.time() + self.drain_timeout
+        while sum(map(len, stage.job_latencies.values())) < stage.jobs_queued and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        stage.jobs_elapsed = loop.time() - started
+        lag.cancel()
+        await asyncio.gather(lag, return_exceptions=True)
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('text', 'command', 'voice', 'photo'):
+            raise argparse.ArgumentTypeError(f'unknown update kind: {kind}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_stage(report: dict) -> None:
+    latency, lag, jobs = report['latency_ms'], report['loop_lag_ms'], report['job_latency_ms']
+    print(
+        f"rate {report['rate']:7.1f}/s  sent {report['sent']:6d}  handled {report['throughput']:7.1f}/s  "
+        f"p50 {latency.get('p50', 0):8.1f}  p95 {latency.get('p95', 0):8.1f}  p99 {latency.get('p99', 0):8.1f} ms  "
+        f"loop lag p99 {lag.get('p99', 0):6.1f} max {lag.get('max', 0):6.1f} ms  "
+        f"jobs {report['jobs']:5d} p95 {jobs.get('p95', 0):8.1f} ms  "
+        f"shed {report['shed']}  failed {report['failed']}  unhandled {report['unhandled']}",
+        file=sys.stderr,
+    )
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test the bot with synthetic updates and fake providers')
+    parser.add_argument('--rate', type=float, action='append', help='updates per second, repeat for more stages')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per stage')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'default: {DEFAULT_MIX}')
+    parser.add_argument('--chats', type=int, default=50, help='allowed chats the updates are spread over')
+    parser.add_argument('--text-latency', type=Latency.parse, default=Latency(0.8, 4.0),
+                        help='LLM reply latency as median:p99 seconds')
+    parser.add_argument('--image-latency', type=Latency.parse, default=Latency(3.0, 10.0))
+    parser.add_argument('--audio-latency', type=Latency.parse, default=Latency(1.0, 4.0))
+    parser.add_argument('--telegram-latency', type=Latency.parse, default=Latency(0.05, 0.3))
+    parser.add_argument('--stream-chunks', type=int, default=20, help='deltas of a streamed reply')
+    parser.add_argument('--job-workers', type=int, default=4)
+    parser.add_argument('--drain-timeout', type=float, default=60, help='seconds to wait for queued jobs per stage')
+    parser.add_argument('--real-redis', action='store_true', help='use REDIS_URL instead of fakeredis')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the stage reports as JSON here')
+    return parser.parse_args(argv)
+
+
+async def main(argv: list[str]) -> None:
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    bot, config, store = bot_module.bot, bot_module.config, bot_module.message_store
+    if not args.real_redis:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit('fakeredis is not installed: run with `uv run --with fakeredis` or pass --real-redis')
+        store.redis_conn = fakeredis.aioredis.FakeRedis()
+        block_like_redis(store)
+
+    clone_chats(config, args.chats)
+    providers = FakeProviders(args.text_latency, args.image_latency, args.audio_latency, args.stream_chunks, rng)
+    providers.install()
+    me = types.User(id=bot.id, is_bot=True, first_name='Matvey', username=config.me_strip_lower)
+    bot.session = RecordingSession(me, args.telegram_latency, rng)
+
+    load_test = LoadTest(
+        bot_module.build_dispatcher(storage=MemoryStorage()),
+        bot,
+        Updates(config, rng),
+        args.mix,
+        args.drain_timeout,
+    )
+    workers = asyncio.create_task(bot_module.jobs.run(bot, args.job_workers))
+    reports = []
+    try:
+        for rate in args.rate or [10.0]:
+            stage = Stage(rate=rate, duration=args.duration)
+            bot.session.calls.clear()
+            bot.session.shed = 0
+            providers.calls.clear()
+            await load_test.run_stage(stage, rng)
+            reports.append(stage.report(bot.session, providers))
+            print_stage(reports[-1])
+    finally:
+        workers.cancel()
+        await asyncio.gather(workers, return_exceptions=True)
+        await bot_module.chat_tasks.aclose()
+        await store.close()
+        await provider_clients.aclose()
+        executor.shutdown()
+
+    if args.output:
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'backend': 'redis' if args.real_redis else 'fakeredis',
+                'args': {key: str(value) for key, value in vars(args).items()},
+            },
+            'stages': reports,
+        }
+        Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,554 @@
+"""
+Local stand-in for the provider APIs the bot calls, for benchmarking and
+chaos testing the whole bot on a machine without network access.
+
+    PYTHONPATH=src python scripts/provider_stub.py --port 8090 --latency 0.8:4 --latency anthropic=2:8 \\
+        --faults 429=0.02,500=0.01,timeout=0.005 --faults yandexgpt:503=0.2
+
+and point the bot at it with the variables it prints:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8090/openai/v1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8090/anthropic
+    YANDEXGPT_BASE_URL=http://127.0.0.1:8090/yandexgpt
+    KANDINSKI_BASE_URL=http://127.0.0.1:8090/kandinski/key/api/v1
+    REPLICATE_BASE_URL=http://127.0.0.1:8090/replicate
+
+Speaks the parts of the APIs the bot uses: OpenAI chat completions (plain
+and streamed), transcriptions, speech, image generations and edits;
+Anthropic completions and messages (plain and streamed); YandexGPT
+completion (plain and streamed); the Kandinski text2image job API and
+Replicate predictions. Every call waits a log-normal latency, may fail with
+an injected 429 (with Retry-After), 5xx or a hang that runs into the client
+timeout, and answers with canned payloads (override them with --payloads
+DIR holding text.txt, transcription.txt, image.png and speech.ogg).
+GET /stats returns the counts of calls and injected faults.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from aiohttp import web
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = ('openai', 'anthropic', 'yandexgpt', 'kandinski', 'replicate')
+# z-score of the 99th percentile of the normal distribution
+P99_Z = 2.326
+DEFAULT_LATENCY = '0.5:2'
+# an injected timeout holds the request this long, past any client timeout
+HANG_SECONDS = 300.0
+RETRY_AFTER_SECONDS = 2
+STREAM_CHUNKS = 20
+# Replicate predictions kept around for polling
+MAX_PREDICTIONS = 10_000
+DEFAULT_TEXT = (
+    'Досточтимый собеседник, позвольте ответить со всей обстоятельностью: '
+    'сие есть ответ заглушки, неотличимый по форме от настоящего, но лишённый всякого смысла.'
+)
+
+
+@dataclass(frozen=True)
+class Latency:
+    """Log-normal latency given by its median and 99th percentile, seconds."""
+
+    median: float
+    p99: float
+
+    @classmethod
+    def parse(cls, value: str) -> Latency:
+        median, _, p99 = value.partition(':')
+        return cls(float(median), float(p99 or median))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        sigma = math.log(self.p99 / self.median) / P99_Z if self.p99 > self.median else 0.0
+        return rng.lognormvariate(math.log(self.median), sigma)
+
+
+@dataclass
+class Faults:
+    """Chance of each injected failure ('429', '500', 'timeout', ...), per provider or for all ('*')."""
+
+    rates: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    def add(self, value: str) -> None:
+        provider, _, spec = value.rpartition(':')
+        for part in spec.split(','):
+            fault, _, rate = part.partition('=')
+            if fault != 'timeout' and not fault.isdigit():
+                raise argparse.ArgumentTypeError(f'unknown fault: {fault}')
+            self.rates.setdefault(provider or '*', {})[fault] = float(rate)
+
+    def pick(self, provider: str, rng: random.Random) -> str | None:
+        rates = self.rates.get(provider, self.rates.get('*', {}))
+        roll = rng.random()
+        for fault, rate in rates.items():
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+
+@dataclass(frozen=True)
+class Payloads:
+    text: str
+    transcription: str
+    image: bytes
+    speech: bytes
+
+    @classmethod
+    def load(cls, directory: str | None) -> Payloads:
+        path = Path(directory) if directory else None
+
+        def read(name: str) -> bytes | None:
+            if path is None or not (path / name).exists():
+                return None
+            return (path / name).read_bytes()
+
+        text = read('text.txt')
+        transcription = read('transcription.txt')
+        return cls(
+            text=text.decode() if text else DEFAULT_TEXT,
+            transcription=transcription.decode() if transcription else DEFAULT_TEXT,
+            image=read('image.png') or _default_image(),
+            speech=read('speech.ogg') or b'OggS' + bytes(4092),
+        )
+
+
+def _default_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (512, 512), (200, 120, 60)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _split(text: str, parts: int) -> list[str]:
+    """Text cut at word boundaries into about parts pieces that join back into it."""
+    words = text.split(' ')
+    size = max(1, math.ceil(len(words) / parts))
+    pieces = [' '.join(words[i:i + size]) for i in range(0, len(words), size)]
+    return [piece + ' ' for piece in pieces[:-1]] + pieces[-1:]
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _error_body(provider: str, status: int) -> dict:
+    message = f'injected {status} from the provider stub'
+    if provider == 'openai':
+        kind = 'rate_limit_exceeded' if status == 429 else 'server_error'
+        return {'error': {'message': message, 'type': kind, 'param': None, 'code': None}}
+    if provider == 'anthropic':
+        kind = {429: 'rate_limit_error', 529: 'overloaded_error'}.get(status, 'api_error')
+        return {'type': 'error', 'error': {'type': kind, 'message': message}}
+    if provider == 'yandexgpt':
+        return {'error': {'grpcCode': 8 if status == 429 else 13, 'httpCode': status, 'message': message}}
+    return {'detail': message}
+
+
+class ProviderStub:
+    def __init__(
+        self,
+        latencies: dict[str, Latency],
+        faults: Faults,
+        payloads: Payloads,
+        stream_chunks: int = STREAM_CHUNKS,
+        hang_seconds: float = HANG_SECONDS,
+        retry_after: int = RETRY_AFTER_SECONDS,
+        rng: random.Random | None = None,
+    ):
+        self.latencies = latencies
+        self.faults = faults
+        self.payloads = payloads
+        self.stream_chunks = stream_chunks
+        self.hang_seconds = hang_seconds
+        self.retry_after = retry_after
+        self.rng = rng or random.Random()
+        self.stats: Counter[str] = Counter()
+        # kandinski run id / replicate prediction id -> when it's done
+        self._jobs: OrderedDict[str, float] = OrderedDict()
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._fault_middleware], client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/openai/v1/chat/completions', self.openai_chat)
+        app.router.add_post('/openai/v1/audio/transcriptions', self.openai_transcription)
+        app.router.add_post('/openai/v1/audio/speech', self.openai_speech)
+        app.router.add_post('/openai/v1/images/generations', self.openai_image)
+        app.router.add_post('/openai/v1/images/edits', self.openai_image)
+        app.router.add_post('/anthropic/v1/complete', self.anthropic_complete)
+        app.router.add_post('/anthropic/v1/messages', self.anthropic_messages)
+        app.router.add_post('/yandexgpt/foundationModels/v1/completion', self.yandexgpt_completion)
+        app.router.add_get('/kandinski/key/api/v1/models', self.kandinski_models)
+        app.router.add_post('/kandinski/key/api/v1/text2image/run', self.kandinski_run)
+        app.router.add_get('/kandinski/key/api/v1/text2image/status/{uuid}', self.kandinski_status)
+        app.router.add_post('/replicate/v1/predictions', self.replicate_create)
+        app.router.add_post('/replicate/v1/models/{owner}/{name}/predictions', self.replicate_create)
+        app.router.add_get('/replicate/v1/predictions/{id}', self.replicate_get)
+        app.router.add_get('/replicate/v1/models/{owner}/{name}/versions/{id}', self.replicate_version)
+        app.router.add_get('/files/image.png', self.image_file)
+        app.router.add_get('/stats', self.get_stats)
+        app.router.add_get('/healthz', self.healthz)
+        return app
+
+    @web.middleware
+    async def _fault_middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        provider = request.path.strip('/').split('/')[0]
+        if provider not in PROVIDERS:
+            return await handler(request)
+        self.stats[f'{provider}.calls'] += 1
+        fault = self.faults.pick(provider, self.rng)
+        if fault is None:
+            return await handler(request)
+
+        self.stats[f'{provider}.fault.{fault}'] += 1
+        logger.debug('Injecting %s into %s %s', fault, request.method, request.path)
+        if fault == 'timeout':
+            await asyncio.sleep(self.hang_seconds)
+            status = 504
+        else:
+            status = int(fault)
+            await self._wait(provider)
+        headers = {'Retry-After': str(self.retry_after)} if status == 429 else None
+        return web.json_response(_error_body(provider, status), status=status, headers=headers)
+
+    def _latency(self, provider: str) -> float:
+        return self.latencies.get(provider, self.latencies['*']).sample(self.rng)
+
+    async def _wait(self, provider: str) -> None:
+        await asyncio.sleep(self._latency(provider))
+
+    def _start_job(self, provider: str) -> str:
+        job_id = uuid.uuid4().hex
+        self._jobs[job_id] = time.monotonic() + self._latency(provider)
+        while len(self._jobs) > MAX_PREDICTIONS:
+            self._jobs.popitem(last=False)
+        return job_id
+
+    def _job_done(self, job_id: str) -> bool:
+        return time.monotonic() >= self._jobs.get(job_id, 0.0)
+
+    async def _stream(self, request: web.Request, provider: str, events) -> web.StreamResponse:
+        """Send the encoded events spread over one latency sample."""
+        events = list(events)
+        delay = self._latency(provider) / max(1, len(events))
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        for event in events:
+            await asyncio.sleep(delay)
+            await response.write(event)
+        await response.write_eof()
+        return response
+
+    # OpenAI
+
+    async def openai_chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get('model', 'gpt-4o-mini')
+        prompt_tokens = _tokens(json.dumps(body.get('messages', []), ensure_ascii=False))
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        created = int(time.time())
+        text = self.payloads.text
+        if body.get('stream'):
+            def chunk(delta: dict, finish_reason: str | None = None) -> bytes:
+                data = {
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': created,
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+                }
+                return f'data: {json.dumps(data, ensure_ascii=False)}\n\n'.encode()
+
+            events = [chunk({'role': 'assistant', 'content': ''})]
+            events += [chunk({'content': piece}) for piece in _split(text, self.stream_chunks)]
+            events += [chunk({}, 'stop'), b'data: [DONE]\n\n']
+            return await self._stream(request, 'openai', events)
+
+        await self._wait('openai')
+        completion_tokens = _tokens(text)
+        return web.json_response({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': text},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        })
+
+    async def openai_transcription(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._wait('openai')
+        return web.json_response({'text': self.payloads.transcription})
+
+    async def openai_speech(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._wait('openai')
+        return web.Response(body=self.payloads.speech, content_type='audio/ogg')
+
+    async def openai_image(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._wait('openai')
+        url = f'{request.url.origin()}/files/image.png'
+        return web.json_response({'created': int(time.time()), 'data': [{'url': url, 'revised_prompt': None}]})
+
+    # Anthropic
+
+    async def anthropic_complete(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get('model', 'claude-2')
+        completion_id = f'compl_{uuid.uuid4().hex}'
+
+        def completion(text: str, stop_reason: str | None) -> dict:
+            return {
+                'type': 'completion',
+                'id': completion_id,
+                'completion': text,
+                'stop_reason': stop_reason,
+                'stop': None,
+                'model': model,
+            }
+
+        if body.get('stream'):
+            pieces = _split(self.payloads.text, self.stream_chunks)
+            events = [_sse('completion', completion(piece, None)) for piece in pieces]
+            events.append(_sse('completion', completion('', 'stop_sequence')))
+            return await self._stream(request, 'anthropic', events)
+
+        await self._wait('anthropic')
+        return web.json_response(completion(self.payloads.text, 'stop_sequence'))
+
+    async def anthropic_messages(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get('model', 'claude-3-haiku-20240307')
+        input_tokens = _tokens(json.dumps(body.get('messages', []), ensure_ascii=False))
+        text = self.payloads.text
+        message = {
+            'id': f'msg_{uuid.uuid4().hex}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': model,
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+            'usage': {'input_tokens': input_tokens, 'output_tokens': _tokens(text)},
+        }
+        if body.get('stream'):
+            start = {**message, 'content': [], 'stop_reason': None, 'usage': {**message['usage'], 'output_tokens': 0}}
+            events = [
+                _sse('message_start', {'type': 'message_start', 'message': start}),
+                _sse('content_block_start', {
+                    'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''},
+                }),
+            ]
+            events += [
+                _sse('content_block_delta', {
+                    'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': piece},
+                })
+                for piece in _split(text, self.stream_chunks)
+            ]
+            events += [
+                _sse('content_block_stop', {'type': 'content_block_stop', 'index': 0}),
+                _sse('message_delta', {
+                    'type': 'message_delta',
+                    'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                    'usage': {'output_tokens': _tokens(text)},
+                }),
+                _sse('message_stop', {'type': 'message_stop'}),
+            ]
+            return await self._stream(request, 'anthropic', events)
+
+        await self._wait('anthropic')
+        return web.json_response(message)
+
+    # YandexGPT
+
+    async def yandexgpt_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        input_tokens = _tokens(json.dumps(body.get('messages', []), ensure_ascii=False))
+        text = self.payloads.text
+
+        def result(so_far: str, status: str) -> dict:
+            output_tokens = _tokens(so_far)
+            return {'result': {
+                'alternatives': [{'message': {'role': 'assistant', 'text': so_far}, 'status': status}],
+                'usage': {
+                    'inputTextTokens': str(input_tokens),
+                    'completionTokens': str(output_tokens),
+                    'totalTokens': str(input_tokens + output_tokens),
+                },
+                'modelVersion': 'stub',
+            }}
+
+        if body.get('completionOptions', {}).get('stream'):
+            # every line carries the whole text generated so far
+            so_far = list(itertools.accumulate(_split(text, self.stream_chunks)))
+            events = [
+                json.dumps(result(partial, 'ALTERNATIVE_STATUS_PARTIAL'), ensure_ascii=False).encode() + b'\n'
+                for partial in so_far[:-1]
+            ]
+            events.append(json.dumps(result(text, 'ALTERNATIVE_STATUS_FINAL'), ensure_ascii=False).encode() + b'\n')
+            return await self._stream(request, 'yandexgpt', events)
+
+        await self._wait('yandexgpt')
+        return web.json_response(result(text, 'ALTERNATIVE_STATUS_FINAL'))
+
+    # Kandinski
+
+    async def kandinski_models(self, request: web.Request) -> web.Response:
+        return web.json_response([{'id': 4, 'name': 'Kandinsky', 'version': 3.0, 'type': 'TEXT2IMAGE'}])
+
+    async def kandinski_run(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.json_response({'uuid': self._start_job('kandinski'), 'status': 'INITIAL'}, status=201)
+
+    async def kandinski_status(self, request: web.Request) -> web.Response:
+        run_id = request.match_info['uuid']
+        if not self._job_done(run_id):
+            return web.json_response({'uuid': run_id, 'status': 'PROCESSING', 'images': None, 'censored': False})
+        image = base64.b64encode(self.payloads.image).decode()
+        return web.json_response({'uuid': run_id, 'status': 'DONE', 'images': [image], 'censored': False})
+
+    # Replicate
+
+    def _prediction(self, request: web.Request, prediction_id: str, version: str, input: dict | None) -> dict:
+        done = self._job_done(prediction_id)
+        return {
+            'id': prediction_id,
+            'model': request.match_info.get('owner', 'stub') + '/' + request.match_info.get('name', 'stub'),
+            'version': version,
+            'status': 'succeeded' if done else 'processing',
+            'input': input,
+            'output': f'{request.url.origin()}/files/image.png' if done else None,
+            'logs': '',
+            'error': None,
+            'metrics': {},
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'urls': {
+                'get': f'{request.url.origin()}/replicate/v1/predictions/{prediction_id}',
+                'cancel': f'{request.url.origin()}/replicate/v1/predictions/{prediction_id}/cancel',
+            },
+        }
+
+    async def replicate_create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        prediction_id = self._start_job('replicate')
+        prefer = request.headers.get('Prefer', '')
+        if prefer.startswith('wait'):
+            # Prefer: wait[=seconds] holds the response until the prediction is done
+            limit = float(prefer.partition('=')[2] or 60)
+            await asyncio.sleep(min(limit, max(0.0, self._jobs[prediction_id] - time.monotonic())))
+        return web.json_response(
+            self._prediction(request, prediction_id, body.get('version', ''), body.get('input')), status=201,
+        )
+
+    async def replicate_get(self, request: web.Request) -> web.Response:
+        prediction_id = request.match_info['id']
+        if prediction_id not in self._jobs:
+            return web.json_response({'detail': 'Not found.'}, status=404)
+        return web.json_response(self._prediction(request, prediction_id, '', None))
+
+    async def replicate_version(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'id': request.match_info['id'],
+            'created_at': '2024-01-01T00:00:00Z',
+            'cog_version': '0.9.0',
+            'openapi_schema': {},
+        })
+
+    async def image_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.payloads.image, content_type='image/png')
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'.encode()
+
+
+def env_for(base_url: str) -> dict[str, str]:
+    """Variables pointing the bot at a stub served at base_url."""
+    return {
+        'OPENAI_BASE_URL': f'{base_url}/openai/v1',
+        'ANTHROPIC_BASE_URL': f'{base_url}/anthropic',
+        'YANDEXGPT_BASE_URL': f'{base_url}/yandexgpt',
+        'KANDINSKI_BASE_URL': f'{base_url}/kandinski/key/api/v1',
+        'REPLICATE_BASE_URL': f'{base_url}/replicate',
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Serve fake OpenAI/Anthropic/YandexGPT/Kandinski/Replicate APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', action='append', default=[],
+                        help=f'[PROVIDER=]MEDIAN:P99 seconds, can be repeated (default: {DEFAULT_LATENCY})')
+    parser.add_argument('--faults', action='append', default=[],
+                        help='[PROVIDER:]FAULT=RATE,... with FAULT a status code or timeout, e.g. 429=0.05,timeout=0.01; '
+                             'rates given for a provider replace the ones for all')
+    parser.add_argument('--hang-seconds', type=float, default=HANG_SECONDS, help='how long a timeout fault holds')
+    parser.add_argument('--retry-after', type=int, default=RETRY_AFTER_SECONDS, help='Retry-After of 429 faults')
+    parser.add_argument('--stream-chunks', type=int, default=STREAM_CHUNKS)
+    parser.add_argument('--payloads', help='directory with text.txt, transcription.txt, image.png, speech.ogg')
+    parser.add_argument('--seed', type=int)
+    return parser.parse_args(argv)
+
+
+def build_stub(args: argparse.Namespace) -> ProviderStub:
+    latencies = {'*': Latency.parse(DEFAULT_LATENCY)}
+    for value in args.latency:
+        provider, _, spec = value.rpartition('=')
+        latencies[provider or '*'] = Latency.parse(spec)
+    faults = Faults()
+    for value in args.faults:
+        faults.add(value)
+    return ProviderStub(
+        latencies=latencies,
+        faults=faults,
+        payloads=Payloads.load(args.payloads),
+        stream_chunks=args.stream_chunks,
+        hang_seconds=args.hang_seconds,
+        retry_after=args.retry_after,
+        rng=random.Random(args.seed),
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    stub = build_stub(args)
+    base_url = f'http://{args.host}:{args.port}'
+    print('\n'.join(f'export {name}={value}' for name, value in env_for(base_url).items()), flush=True)
+    logger.info('Provider stub: latencies=%s, faults=%s', stub.latencies, stub.faults.rates)
+    web.run_app(stub.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
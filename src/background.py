@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Coroutine
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChatTasks:
+    """
+    Coroutines running in the background on behalf of a chat, so a handler
+    can hand off slow work (polling an image job) and return right away.
+    Keeps the tasks referenced until they finish and lets a chat cancel its
+    own with /cancel.
+    """
+
+    def __init__(self):
+        self._tasks: dict[int, set[asyncio.Task]] = {}
+
+    def spawn(self, chat_id: int, coro: Coroutine[Any, Any, Any], name: str | None = None) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self._tasks.setdefault(chat_id, set()).add(task)
+        task.add_done_callback(lambda t: self._done(chat_id, t))
+        return task
+
+    def running(self, chat_id: int) -> int:
+        return len(self._tasks.get(chat_id, ()))
+
+    def cancel(self, chat_id: int) -> int:
+        """Cancel everything running for chat_id, return how many tasks were cancelled."""
+        tasks = self._tasks.get(chat_id, set())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.info('Cancelled %d background tasks for chat_id=%s', len(tasks), chat_id)
+        return len(tasks)
+
+    async def aclose(self) -> None:
+        tasks = [task for chat_tasks in self._tasks.values() for task in chat_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _done(self, chat_id: int, task: asyncio.Task) -> None:
+        tasks = self._tasks.get(chat_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._tasks[chat_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Background task %s failed', task.get_name(), exc_info=task.exception())
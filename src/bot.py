@@ -8,12 +8,19 @@ import random
 
 from aiogram import Bot, Dispatcher, F, Router, html, types
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.base import DefaultKeyBuilder
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.redis import RedisStorage
 
+from background import ChatTasks
 from config import Config
+from file_cache import FileCache
+import executor
+from jobs import IMAGE_JOB_WORKERS, JOB_WORKERS, JobQueue
 import metrics
-from message_store import MessageStore
+from message_store import AsyncMessageStore
+from providers import clients as provider_clients
+from response_cache import ResponseCache
+from throttling import ChatConcurrencyMiddleware, FairLimiter
 
 API_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
 
@@ -22,8 +29,13 @@ logger = logging.getLogger(__name__)
 
 bot_props = DefaultBotProperties(parse_mode="HTML")
 bot = Bot(token=API_TOKEN, default=bot_props)
-message_store = MessageStore.from_env()
+message_store = AsyncMessageStore.from_env()
 config = Config.read_toml(path=os.getenv("BOT_CONFIG_TOML"))
+response_cache = ResponseCache.from_env(message_store, namespace=config.me_strip_lower)
+file_cache = FileCache.from_env(message_store, namespace=config.me_strip_lower)
+chat_tasks = ChatTasks()
+jobs = JobQueue.from_env(message_store, namespace=config.me_strip_lower)
+image_jobs = JobQueue.from_env(message_store, namespace=f"{config.me_strip_lower}:images")
 
 
 def extract_message_chain(last_message_in_thread: types.Message, bot_id: int):
@@ -57,15 +69,77 @@ async def react(success: bool, message: types.Message):
     await message.react(reaction=[reaction])
 
 
-async def get_replied_photo_bytes(message: types.Message) -> bytes | None:
-    """Extract photo bytes from replied-to message."""
+def replied_photo(message: types.Message) -> types.PhotoSize | None:
+    """Largest size of the photo in the replied-to message."""
     reply = message.reply_to_message
     if not reply or not reply.photo:
         return None
-    photo = reply.photo[-1]
-    file = await bot.get_file(photo.file_id)
-    file_bytes = await bot.download_file(file.file_path)
-    return file_bytes.read()
+    return reply.photo[-1]
+
+
+async def get_replied_photo_bytes(message: types.Message) -> bytes | None:
+    """Extract photo bytes from replied-to message."""
+    photo = replied_photo(message)
+    if photo is None:
+        return None
+    return await download_file_bytes(photo)
+
+
+async def download_file_bytes(
+    media: types.PhotoSize | types.Voice | types.VideoNote,
+) -> bytes:
+    """Download a Telegram file, reusing earlier downloads of the same file."""
+
+    async def download() -> bytes:
+        file = await bot.get_file(media.file_id)
+        file_bytes = await bot.download_file(file.file_path)
+        return file_bytes.read()
+
+    return await file_cache.get_or_download(media.file_unique_id, download)
+
+
+async def migrate_history() -> None:
+    """Move chat histories still saved as one list per chat into hourly buckets."""
+    async for tag in message_store.legacy_history_keys(config.history_tag("*")):
+        try:
+            chat_config = config[int(tag.rsplit(":", 1)[1])]
+        except ValueError:
+            logger.warning("Skipping history key with unexpected name: %s", tag)
+            continue
+        await message_store.migrate_legacy_history(
+            tag,
+            max_age=chat_config.history_max_age_seconds,
+            max_messages=chat_config.history_max_messages,
+        )
+
+
+def build_dispatcher(storage: BaseStorage | None = None) -> Dispatcher:
+    if storage is None:
+        redis_url = os.getenv("REDIS_URL")
+        fsm_prefix = os.getenv("FSM_REDIS_PREFIX", f"fsm:{config.me_strip_lower}")
+        storage = RedisStorage.from_url(
+            redis_url,
+            key_builder=DefaultKeyBuilder(prefix=fsm_prefix),
+            state_ttl=300,
+            data_ttl=300,
+        )
+        logger.info("FSM storage initialized with prefix=%s", fsm_prefix)
+
+    # Import handlers and include routers
+    from handlers import include_all_routers
+
+    dp = Dispatcher(storage=storage)
+    limiter = FairLimiter.from_env()
+    dp.message.middleware(ChatConcurrencyMiddleware(limiter))
+    dp.callback_query.middleware(ChatConcurrencyMiddleware(limiter))
+    logger.info(
+        "Concurrency limits: global=%d, per_chat=%d, queued_per_chat=%d",
+        limiter.global_limit,
+        limiter.per_chat_limit,
+        limiter.max_queued,
+    )
+    include_all_routers(dp)
+    return dp
 
 
 async def main() -> None:
@@ -79,24 +153,38 @@ async def main() -> None:
     metrics.start_metrics_server()
     logger.info("Metrics server started on port %d", metrics.METRICS_PORT)
 
-    redis_url = os.getenv("REDIS_URL")
-    fsm_prefix = os.getenv("FSM_REDIS_PREFIX", f"fsm:{config.me_strip_lower}")
-    storage = RedisStorage.from_url(
-        redis_url,
-        key_builder=DefaultKeyBuilder(prefix=fsm_prefix),
-        state_ttl=300,
-        data_ttl=300,
-    )
-    logger.info("FSM storage initialized with prefix=%s", fsm_prefix)
-
-    # Import handlers and include routers
-    from handlers import include_all_routers
-
-    dp = Dispatcher(storage=storage)
-    include_all_routers(dp)
-
-    logger.info("Bot polling started")
-    await dp.start_polling(bot)
+    await migrate_history()
+
+    dp = build_dispatcher()
+
+    # 0 leaves the jobs to separately started workers (src/worker.py)
+    workers = [
+        asyncio.create_task(queue.run(bot, concurrency))
+        for queue, concurrency in (
+            (jobs, int(os.getenv("JOB_WORKERS", JOB_WORKERS))),
+            (image_jobs, int(os.getenv("IMAGE_JOB_WORKERS", IMAGE_JOB_WORKERS))),
+        )
+        if concurrency > 0
+    ]
+
+    mode = os.getenv("BOT_MODE", "polling")
+    try:
+        if mode == "webhook":
+            from webhook import WebhookSettings, run_webhook
+
+            logger.info("Bot webhook mode started")
+            await run_webhook(dp, bot, WebhookSettings.from_env())
+        else:
+            logger.info("Bot polling started")
+            await dp.start_polling(bot)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await chat_tasks.aclose()
+        await message_store.close()
+        await provider_clients.aclose()
+        executor.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import importlib.util
+import logging
+import os
+from dataclasses import dataclass
+
+import anthropic
+import httpx
+import openai
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ClientLimits:
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    timeout: float = 60.0
+    http2: bool = False
+
+    @classmethod
+    def from_env(cls) -> ClientLimits:
+        return cls(
+            max_connections=int(os.getenv('PROVIDER_MAX_CONNECTIONS', cls.max_connections)),
+            max_keepalive_connections=int(
+                os.getenv('PROVIDER_MAX_KEEPALIVE_CONNECTIONS', cls.max_keepalive_connections)
+            ),
+            keepalive_expiry=float(os.getenv('PROVIDER_KEEPALIVE_EXPIRY', cls.keepalive_expiry)),
+            timeout=float(os.getenv('PROVIDER_TIMEOUT_SECONDS', cls.timeout)),
+            http2=os.getenv('PROVIDER_HTTP2', '0').lower() in ('1', 'true', 'yes'),
+        )
+
+    def httpx_kwargs(self) -> dict:
+        http2 = self.http2
+        if http2 and importlib.util.find_spec('h2') is None:
+            logger.warning('PROVIDER_HTTP2 is set but h2 package is not installed, using HTTP/1.1')
+            http2 = False
+        return {
+            'limits': httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            'timeout': httpx.Timeout(self.timeout),
+            'http2': http2,
+        }
+
+
+class ProviderClients:
+    """
+    Long-lived provider clients with pooled connections, created on first use
+    and shared by every request, so each call doesn't pay for a new TLS
+    handshake and connection pool.
+    """
+
+    def __init__(self, limits: ClientLimits):
+        self.limits = limits
+        self._openai: openai.AsyncOpenAI | None = None
+        self._anthropic: anthropic.AsyncAnthropic | None = None
+        self._http: httpx.AsyncClient | None = None
+
+    @classmethod
+    def from_env(cls) -> ProviderClients:
+        return cls(ClientLimits.from_env())
+
+    @property
+    def openai(self) -> openai.AsyncOpenAI:
+        if self._openai is None:
+            self._openai = openai.AsyncOpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                # retries are done by retry.RetryPolicy around every call
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(**self.limits.httpx_kwargs()),
+            )
+            logger.info('OpenAI client created: %s', self.limits)
+        return self._openai
+
+    @property
+    def anthropic(self) -> anthropic.AsyncAnthropic:
+        if self._anthropic is None:
+            self._anthropic = anthropic.AsyncAnthropic(
+                api_key=os.getenv('ANTHROPIC_API_KEY'),
+                max_retries=0,
+                http_client=anthropic.DefaultAsyncHttpxClient(**self.limits.httpx_kwargs()),
+            )
+            logger.info('Anthropic client created: %s', self.limits)
+        return self._anthropic
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """Plain httpx client for YandexGPT and Kandinski."""
+        if self._http is None:
+            self._http = httpx.AsyncClient(**self.limits.httpx_kwargs())
+            logger.info('HTTP client created: %s', self.limits)
+        return self._http
+
+    async def aclose(self) -> None:
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
+        if self._anthropic is not None:
+            await self._anthropic.close()
+            self._anthropic = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        logger.info('Provider clients closed')
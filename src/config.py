@@ -5,7 +5,7 @@ import logging
 import os
 import pathlib
 import tomllib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from aiogram import types
 
@@ -28,6 +28,19 @@ class ChatConfig:
     context_enabled: bool = True
     max_context_messages: int = 10
     tts_voice: str = 'alloy'
+    stream_responses: bool = False
+    fallback_providers: list[str] | None = None
+    hedge_requests: bool = False
+    # history retention: messages older than this many days expire, and only
+    # the newest history_max_messages are kept; None switches a limit off
+    history_max_age_days: float | None = None
+    history_max_messages: int | None = 2000
+
+    @property
+    def history_max_age_seconds(self) -> float | None:
+        if self.history_max_age_days is None:
+            return None
+        return self.history_max_age_days * 86400
 
     @classmethod
     def just_no(cls, chat_id, provider, disabled_commands):
@@ -47,6 +60,12 @@ class ChatConfig:
         )
 
 
+@dataclass(frozen=True)
+class RateLimit:
+    requests_per_minute: int | None = None
+    tokens_per_minute: int | None = None
+
+
 @dataclass
 class Config:
     me: str
@@ -67,6 +86,8 @@ class Config:
     positive_emojis: str
     negative_emojis: str
 
+    rate_limits: dict[tuple[str, str], RateLimit] = field(default_factory=dict)
+
     PROVIDER_OPENAI = 'openai'
     PROVIDER_ANTHROPIC = 'anthropic'
     PROVIDER_YANDEXGPT = 'yandexgpt'
@@ -111,6 +132,9 @@ class Config:
 
         default_prompt = config['defaults']['prompt']
         default_provider = config['defaults']['provider']
+        default_fallback_providers = config['defaults'].get('fallback_providers', [])
+        default_max_age_days = config['defaults'].get('history_max_age_days')
+        default_max_messages = config['defaults'].get('history_max_messages', 2000)
         allowed_chat_ids = [chat['id'] for chat in config['chats']['allowed']]
         per_chat_configs = {
             chat['id']: ChatConfig(
@@ -127,10 +151,25 @@ class Config:
                 context_enabled=chat.get('context_enabled', True),
                 max_context_messages=chat.get('max_context_messages', 10),
                 tts_voice=chat.get('tts_voice', 'alloy'),
+                stream_responses=chat.get('stream_responses', False),
+                fallback_providers=chat.get('fallback_providers', default_fallback_providers),
+                hedge_requests=chat.get('hedge_requests', False),
+                # 0 in the toml switches a limit off
+                history_max_age_days=chat.get('history_max_age_days', default_max_age_days) or None,
+                history_max_messages=chat.get('history_max_messages', default_max_messages) or None,
             )
             for chat in config['chats']['allowed']
         }
 
+        rate_limits = {
+            (provider, model): RateLimit(
+                requests_per_minute=limits.get('requests_per_minute'),
+                tokens_per_minute=limits.get('tokens_per_minute'),
+            )
+            for provider, models in config.get('rate_limits', {}).items()
+            for model, limits in models.items()
+        }
+
         git_sha = os.getenv('GIT_SHA_ENV', 'Unknown')
 
         logger.info('Config loaded: version=%s, bot=%s, allowed_chats=%d, default_provider=%s',
@@ -152,6 +191,7 @@ class Config:
             ru_to_en_prompt=config['translations']['ru_to_en'],
             positive_emojis=config['positive_emojis'],
             negative_emojis=config['negative_emojis'],
+            rate_limits=rate_limits,
         )
 
     def __getitem__(self, chat_id) -> ChatConfig:
@@ -179,6 +219,12 @@ class Config:
             self.PROVIDER_YANDEXGPT: self.model_yandexgpt,
         }[provider]
 
+    def history_tag(self, chat_id) -> str:
+        return f'matvey-3000:history:{self.me_strip_lower}:{chat_id}'
+
+    def rate_limit_for(self, provider, model) -> RateLimit | None:
+        return self.rate_limits.get((provider, model))
+
     async def filter_chat_allowed(self, message) -> bool:
         allowed = message.chat.id in self.allowed_chat_id
         if not allowed:
@@ -237,6 +283,7 @@ class Config:
             f'\nconfig version {html.underline(self.version)}',
             f'model: {html.underline(model)}',
             f'provider: {html.underline(provider)}',
+            f'fallback providers: {", ".join(config.fallback_providers or []) or "none"}',
             f'saving messages: {"YES" if config.save_messages else "NO"}',
             f'git sha: {html.underline(self.git_sha)}',
         ]
@@ -247,6 +294,12 @@ class Config:
         logger.debug('Provider for chat_id=%s: %s', chat_id, provider)
         return provider
 
+    def provider_chain_for_chat_id(self, chat_id) -> list[str]:
+        """Chat provider first, then its fallbacks in order, without repeats."""
+        chat_config = self.configs[chat_id]
+        chain = [chat_config.provider, *(chat_config.fallback_providers or [])]
+        return list(dict.fromkeys(chain))
+
     def override_provider_for_chat_id(self, chat_id, new_provider) -> str:
         old_provider = self.configs[chat_id].provider
         self.configs[chat_id].provider = new_provider
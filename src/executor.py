@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', min(4, os.cpu_count() or 1)))
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='matvey-cpu')
+        logger.info('CPU executor started: workers=%d', CPU_WORKERS)
+    return _executor
+
+
+class _QueueSlot:
+    """
+    Counts a call in executor_queue_depth until a worker picks it up or it is
+    cancelled while still waiting, whichever comes first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._released = False
+        metrics.executor_queue_depth.inc()
+
+    def release(self, *_) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        metrics.executor_queue_depth.dec()
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """
+    Run a CPU-bound function (tokenisation, base64, parsing) in the shared
+    bounded thread pool so it doesn't stall the event loop for every chat.
+    """
+    loop = asyncio.get_running_loop()
+    slot = _QueueSlot()
+
+    def run():
+        slot.release()
+        return fn(*args, **kwargs)
+
+    future = loop.run_in_executor(get_executor(), run)
+    # a call cancelled before it started (hedge loser, /cancel, shutdown)
+    # never reaches run()
+    future.add_done_callback(slot.release)
+    return await future
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+        logger.info('CPU executor stopped')
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+FILE_CACHE_TTL_SECONDS = 3600
+FILE_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+# Redis keeps files shared between restarts and replicas, but huge videos
+# aren't worth the memory there
+FILE_CACHE_REDIS_MAX_FILE_BYTES = 5 * 1024 * 1024
+
+
+class FileCache:
+    """
+    Bytes of Telegram files keyed by file_unique_id, which stays the same for
+    a file no matter which message or bot it comes from. An in-process LRU
+    bounded by a byte budget sits in front of a Redis tier, so chained
+    /edit, /remove_bg, /bg on the same photo download it only once.
+    """
+
+    def __init__(
+        self,
+        store,
+        namespace: str,
+        ttl_seconds: int = FILE_CACHE_TTL_SECONDS,
+        memory_budget_bytes: int = FILE_CACHE_MEMORY_BYTES,
+        redis_max_file_bytes: int = FILE_CACHE_REDIS_MAX_FILE_BYTES,
+        clock=time.monotonic,
+    ):
+        self.store = store
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self.redis_max_file_bytes = redis_max_file_bytes
+        self.clock = clock
+        self.memory_bytes = 0
+        self._memory: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
+    @classmethod
+    def from_env(cls, store, namespace: str) -> FileCache:
+        return cls(
+            store,
+            namespace,
+            ttl_seconds=int(os.getenv('FILE_CACHE_TTL_SECONDS', FILE_CACHE_TTL_SECONDS)),
+            memory_budget_bytes=int(os.getenv('FILE_CACHE_MEMORY_BYTES', FILE_CACHE_MEMORY_BYTES)),
+        )
+
+    def key(self, file_unique_id: str) -> str:
+        return f'matvey-3000:file:{self.namespace}:{file_unique_id}'
+
+    async def get_or_download(
+        self,
+        file_unique_id: str,
+        download: Callable[[], Awaitable[bytes]],
+    ) -> bytes:
+        data = self._memory_get(file_unique_id)
+        if data is not None:
+            metrics.cache_requests_total.labels(cache='file_memory', result='hit').inc()
+            return data
+        metrics.cache_requests_total.labels(cache='file_memory', result='miss').inc()
+
+        try:
+            data = await self.store.get_cached_file(self.key(file_unique_id))
+        except Exception as e:
+            logger.warning('File cache lookup failed: %s', e)
+            data = None
+        if data is not None:
+            metrics.cache_requests_total.labels(cache='file_redis', result='hit').inc()
+            self._memory_put(file_unique_id, data)
+            return data
+        metrics.cache_requests_total.labels(cache='file_redis', result='miss').inc()
+
+        data = await download()
+        logger.debug('File downloaded: file_unique_id=%s, size=%d', file_unique_id, len(data))
+        self._memory_put(file_unique_id, data)
+        if len(data) <= self.redis_max_file_bytes:
+            try:
+                await self.store.store_cached_file(self.key(file_unique_id), data, self.ttl_seconds)
+            except Exception as e:
+                logger.warning('File cache store failed: %s', e)
+        return data
+
+    def _memory_get(self, file_unique_id: str) -> bytes | None:
+        entry = self._memory.get(file_unique_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if self.clock() >= expires_at:
+            self._memory_drop(file_unique_id)
+            return None
+        self._memory.move_to_end(file_unique_id)
+        return data
+
+    def _memory_put(self, file_unique_id: str, data: bytes) -> None:
+        if len(data) > self.memory_budget_bytes:
+            return
+        if file_unique_id in self._memory:
+            self._memory_drop(file_unique_id)
+        self._memory[file_unique_id] = (self.clock() + self.ttl_seconds, data)
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_budget_bytes:
+            oldest = next(iter(self._memory))
+            self._memory_drop(oldest)
+
+    def _memory_drop(self, file_unique_id: str) -> None:
+        _, data = self._memory.pop(file_unique_id)
+        self.memory_bytes -= len(data)
@@ -121,8 +121,8 @@ async def handle_new_chat(message: types.Message):
         message.chat.id,
         message.from_user.username,
     )
-    tag = f"matvey-3000:history:{config.me_strip_lower}:{message.chat.id}"
-    deleted_count = message_store.clear_conversation_history(tag)
+    tag = config.history_tag(message.chat.id)
+    deleted_count = await message_store.clear_conversation_history(tag)
     logger.info(
         "Conversation history cleared for chat_id=%s, deleted_count=%d",
         message.chat.id,
@@ -143,7 +143,7 @@ async def handle_stats_command(message: types.Message, command: CommandObject):
         message.chat.id,
         message.from_user.username,
     )
-    stats = message_store.fetch_stats(keys_pattern="matvey-3000:history:*")
+    stats = await message_store.fetch_stats()
     total_chats = len(config)
     logger.debug("Admin stats: total_keys=%d, total_chats=%d", len(stats), total_chats)
     response = f"Total keys in storage: {len(stats)}"
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import logging
 import time as time_module
@@ -6,9 +7,11 @@ import openai
 from aiogram import F, Router, types
 from aiogram.filters import Command, CommandObject
 
-from bot import bot, config, react
+from bot import chat_tasks, config, download_file_bytes, image_jobs, react, response_cache
+from executor import run_cpu
 import metrics
 from providers import ImageResponse, TextResponse
+from retry import is_retryable_error
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -25,49 +28,7 @@ async def gimme_pic(message: types.Message, command: CommandObject):
         message.chat.id,
         message.from_user.username,
     )
-    start_time = time_module.perf_counter()
-    prompt = command.args
-    logger.debug("DALL-E image generation requested, prompt=%r", prompt)
-    await message.chat.do("upload_photo")
-    try:
-        response = await ImageResponse.generate(prompt, mode="dall-e")
-    except openai.BadRequestError as e:
-        logger.warning(
-            "DALL-E generation failed for chat_id=%s, prompt=%r, error=%s",
-            message.chat.id,
-            prompt,
-            e,
-        )
-        metrics.requests_total.labels(command='pic', status='error').inc()
-        metrics.errors_total.labels(error_type='bad_request').inc()
-        messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
-        messages_to_send.append(
-            (
-                "user",
-                f'объясни трагикомичной шуткой почему OpenAI не может сгенерировать картинку по запросу "{prompt}"',
-            )
-        )
-        await message.chat.do("typing")
-        llm_reply = await TextResponse.generate(
-            config=config,
-            chat_id=message.chat.id,
-            messages=messages_to_send,
-        )
-        await message.answer(llm_reply.text)
-        await react(success=False, message=message)
-    else:
-        logger.info(
-            "DALL-E image generated successfully for chat_id=%s", message.chat.id
-        )
-        metrics.requests_total.labels(command='pic', status='success').inc()
-        metrics.images_generated.labels(model='dall-e-2').inc()
-        await message.chat.do("upload_photo")
-        image_from_url = types.URLInputFile(response.b64_or_url)
-        caption = f"DALL-E 2 prompt: {prompt}"
-        await message.answer_photo(image_from_url, caption=caption)
-        await react(success=True, message=message)
-    finally:
-        metrics.request_duration.labels(command='pic').observe(time_module.perf_counter() - start_time)
+    await image_jobs.submit("pic", message, prompt=command.args)
 
 
 @router.message(
@@ -81,20 +42,34 @@ async def gimme_pic3(message: types.Message, command: CommandObject):
         message.chat.id,
         message.from_user.username,
     )
+    await image_jobs.submit("pic3", message, prompt=command.args)
+
+
+@image_jobs.job("pic")
+async def draw_dalle2(message: types.Message, prompt: str | None) -> None:
+    await draw_dalle(message, prompt, command="pic", mode="dall-e", model="dall-e-2", name="DALL-E 2")
+
+
+@image_jobs.job("pic3")
+async def draw_dalle3(message: types.Message, prompt: str | None) -> None:
+    await draw_dalle(message, prompt, command="pic3", mode="dall-e-3", model="dall-e-3", name="DALL-E 3")
+
+
+async def draw_dalle(message: types.Message, prompt: str | None, command: str, mode: str, model: str, name: str):
     start_time = time_module.perf_counter()
-    prompt = command.args
-    logger.debug("DALL-E 3 image generation requested, prompt=%r", prompt)
+    logger.debug("%s image generation requested, prompt=%r", name, prompt)
     await message.chat.do("upload_photo")
     try:
-        response = await ImageResponse.generate(prompt, mode="dall-e-3")
+        response = await ImageResponse.generate(prompt, mode=mode)
     except openai.BadRequestError as e:
         logger.warning(
-            "DALL-E 3 generation failed for chat_id=%s, prompt=%r, error=%s",
+            "%s generation failed for chat_id=%s, prompt=%r, error=%s",
+            name,
             message.chat.id,
             prompt,
             e,
         )
-        metrics.requests_total.labels(command='pic3', status='error').inc()
+        metrics.requests_total.labels(command=command, status='error').inc()
         metrics.errors_total.labels(error_type='bad_request').inc()
         messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
         messages_to_send.append(
@@ -113,23 +88,24 @@ async def gimme_pic3(message: types.Message, command: CommandObject):
         await react(success=False, message=message)
     else:
         logger.info(
-            "DALL-E 3 image generated successfully for chat_id=%s", message.chat.id
+            "%s image generated successfully for chat_id=%s", name, message.chat.id
         )
-        metrics.requests_total.labels(command='pic3', status='success').inc()
-        metrics.images_generated.labels(model='dall-e-3').inc()
+        metrics.requests_total.labels(command=command, status='success').inc()
+        metrics.images_generated.labels(model=model).inc()
         await message.chat.do("upload_photo")
         image_from_url = types.URLInputFile(response.b64_or_url)
-        caption = f"DALL-E 3 prompt: {prompt}"
+        caption = f"{name} prompt: {prompt}"
         await message.answer_photo(image_from_url, caption=caption)
         await react(success=True, message=message)
     finally:
-        metrics.request_duration.labels(command='pic3').observe(time_module.perf_counter() - start_time)
+        metrics.request_duration.labels(command=command).observe(time_module.perf_counter() - start_time)
 
 
 @router.message(
     config.filter_chat_allowed,
     config.filter_command_not_disabled_for_chat,
     Command(commands=["pik"]),
+    flags={"provider_call": True},
 )
 async def gimme_pikk(message: types.Message, command: CommandObject):
     logger.info(
@@ -144,71 +120,104 @@ async def gimme_pikk(message: types.Message, command: CommandObject):
     prompt = command.args
     logger.debug("Kandinski image generation requested, prompt=%r", prompt)
     await message.chat.do("upload_photo")
+    # Kandinski jobs take a while, poll in the background so the handler
+    # doesn't hold a concurrency slot for the whole time
+    chat_tasks.spawn(
+        message.chat.id,
+        draw_kandinski(message, prompt),
+        name=f"pik:{message.chat.id}:{message.message_id}",
+    )
+
+
+async def draw_kandinski(message: types.Message, prompt: str):
+    start_time = time_module.perf_counter()
     try:
         response = await ImageResponse.generate(prompt, mode="kandinski")
-    except openai.BadRequestError as e:
+    except asyncio.CancelledError:
+        logger.info("Kandinski generation cancelled for chat_id=%s", message.chat.id)
+        metrics.requests_total.labels(command='pik', status='cancelled').inc()
+        raise
+    except Exception as e:
+        # nobody awaits this task, so the chat has to hear about it from here
+        logger.error("Kandinski generation error for chat_id=%s: %s", message.chat.id, e, exc_info=True)
+        metrics.requests_total.labels(command='pik', status='error').inc()
+        await message.answer(f"Кандинский сломался: {e}")
+        await react(success=False, message=message)
+        return
+
+    metrics.request_duration.labels(command='pik').observe(time_module.perf_counter() - start_time)
+    if response.success and not response.censored:
+        logger.info(
+            "Kandinski image generated successfully for chat_id=%s", message.chat.id
+        )
+        metrics.requests_total.labels(command='pik', status='success').inc()
+        metrics.images_generated.labels(model='kandinski').inc()
+        await message.chat.do("upload_photo")
+        caption = f"Kandinksi-3 prompt: {prompt}"
+
+        im_b64 = response.b64_or_url.encode()
+        im_f = await run_cpu(base64.decodebytes, im_b64)
+        image = types.BufferedInputFile(
+            im_f,
+            "kandinski.png",
+        )
+
+        await message.answer_photo(
+            photo=image,
+            caption=caption,
+        )
+        await react(success=True, message=message)
+        return
+
+    metrics.requests_total.labels(command='pik', status='error').inc()
+    if not response.success:
         logger.warning(
             "Kandinski generation failed for chat_id=%s, prompt=%r, error=%s",
             message.chat.id,
             prompt,
-            e,
-        )
-        messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
-        messages_to_send.append(
-            (
-                "user",
-                f'объясни шуткой почему нельзя сгенерировать картинку по запросу "{prompt}"',
-            )
+            response.b64_or_url,
         )
-        await message.chat.do("typing")
-        llm_reply = await TextResponse.generate(
-            config=config,
-            chat_id=message.chat.id,
-            messages=messages_to_send,
-        )
-        await message.answer(llm_reply.text)
+        await message.answer(response.b64_or_url)
         await react(success=False, message=message)
-    else:
-        await message.chat.do("upload_photo")
-        if response.censored:
-            logger.warning(
-                "Kandinski response censored for chat_id=%s, prompt=%r",
-                message.chat.id,
-                prompt,
-            )
-            messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
-            messages_to_send.append(
-                (
-                    "user",
-                    f'объясни шуткой почему нельзя сгенерировать картинку по запросу "{prompt}"',  # noqa
-                )
-            )
-            await message.chat.do("typing")
-            llm_reply = await TextResponse.generate(
-                config=config,
-                chat_id=message.chat.id,
-                messages=messages_to_send,
-            )
-            await message.answer(llm_reply.text)
-            await react(success=False, message=message)
-        else:
-            logger.info(
-                "Kandinski image generated successfully for chat_id=%s", message.chat.id
-            )
-            caption = f"Kandinksi-3 prompt: {prompt}"
+        return
 
-            im_b64 = response.b64_or_url.encode()
-            im_f = base64.decodebytes(im_b64)
-            image = types.BufferedInputFile(
-                im_f,
-                "kandinski.png",
-            )
+    logger.warning(
+        "Kandinski response censored for chat_id=%s, prompt=%r",
+        message.chat.id,
+        prompt,
+    )
+    messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
+    messages_to_send.append(
+        (
+            "user",
+            f'объясни шуткой почему нельзя сгенерировать картинку по запросу "{prompt}"',  # noqa
+        )
+    )
+    await message.chat.do("typing")
+    llm_reply = await TextResponse.generate(
+        config=config,
+        chat_id=message.chat.id,
+        messages=messages_to_send,
+    )
+    await message.answer(llm_reply.text)
+    await react(success=False, message=message)
 
-            await message.answer_photo(
-                photo=image,
-                caption=caption,
-            )
-            await react(success=True, message=message)
+
+@router.message(
+    config.filter_chat_allowed,
+    Command(commands=["cancel"], ignore_mention=True),
+)
+async def cancel_background_jobs(message: types.Message):
+    logger.info(
+        "Command /cancel received from chat_id=%s user=%s",
+        message.chat.id,
+        message.from_user.username,
+    )
+    cancelled = chat_tasks.cancel(message.chat.id)
+    if cancelled:
+        await message.reply(f"Отменил задач: {cancelled}")
+    else:
+        await message.reply("Нечего отменять")
 
 
 @router.message(
@@ -237,18 +246,20 @@ async def handle_reimagine(
         await react(success=False, message=message)
         return
 
+    await image_jobs.submit("reimagine", message, modification=modification)
+
+
+@image_jobs.job("reimagine")
+async def reimagine_photo(message: types.Message, modification: str) -> None:
     await message.chat.do("upload_photo")
     progress_msg = await message.answer("Analyzing image with GPT-4 Vision...")
 
     try:
-        photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        file_bytes = await bot.download_file(file.file_path)
-        image_bytes = file_bytes.read()
+        image_bytes = await download_file_bytes(message.photo[-1])
 
         await progress_msg.edit_text("Reimagining with DALL-E 3...")
 
-        response = await ImageResponse.reimagine(image_bytes, modification)
+        response = await ImageResponse.reimagine(image_bytes, modification, cache=response_cache)
 
         await progress_msg.delete()
 
@@ -264,6 +275,10 @@ async def handle_reimagine(
             await react(success=False, message=message)
 
     except Exception as e:
+        if is_retryable_error(e):
+            # the job queue tries again later, with a progress message of its own
+            await progress_msg.delete()
+            raise
         logger.error("Reimagine error: %s", e, exc_info=True)
         await progress_msg.edit_text(f"Error: {e}")
         await react(success=False, message=message)
@@ -3,7 +3,7 @@ import logging
 from aiogram import Router, types
 from aiogram.filters import Command, CommandObject
 
-from bot import config, get_replied_photo_bytes, react
+from bot import config, get_replied_photo_bytes, image_jobs, react, replied_photo
 from providers import ReplicateEdit
 
 logger = logging.getLogger(__name__)
@@ -18,8 +18,7 @@ router = Router()
 async def handle_edit_command(message: types.Message, command: CommandObject) -> None:
     logger.info("Command /edit: chat_id=%s, user=%s", message.chat.id, message.from_user.username)
 
-    image_bytes = await get_replied_photo_bytes(message)
-    if not image_bytes:
+    if replied_photo(message) is None:
         await message.reply(
             "Reply to a photo with this command.\n"
             "Example: <code>/edit make it look like a watercolor painting</code>"
@@ -33,6 +32,12 @@ async def handle_edit_command(message: types.Message, command: CommandObject) ->
         await react(success=False, message=message)
         return
 
+    await image_jobs.submit("edit", message, instruction=instruction)
+
+
+@image_jobs.job("edit")
+async def edit_photo(message: types.Message, instruction: str) -> None:
+    image_bytes = await get_replied_photo_bytes(message)
     await message.chat.do("upload_photo")
     progress_msg = await message.answer("Editing with Replicate...")
 
@@ -55,8 +60,7 @@ async def handle_edit_command(message: types.Message, command: CommandObject) ->
 async def handle_remove_command(message: types.Message, command: CommandObject) -> None:
     logger.info("Command /remove: chat_id=%s, user=%s", message.chat.id, message.from_user.username)
 
-    image_bytes = await get_replied_photo_bytes(message)
-    if not image_bytes:
+    if replied_photo(message) is None:
         await message.reply(
             "Reply to a photo with this command.\n"
             "Example: <code>/remove the person in background</code>"
@@ -70,6 +74,12 @@ async def handle_remove_command(message: types.Message, command: CommandObject)
         await react(success=False, message=message)
         return
 
+    await image_jobs.submit("remove", message, target=target)
+
+
+@image_jobs.job("remove")
+async def remove_object(message: types.Message, target: str) -> None:
+    image_bytes = await get_replied_photo_bytes(message)
     await message.chat.do("upload_photo")
     progress_msg = await message.answer("Removing object...")
 
@@ -92,8 +102,7 @@ async def handle_remove_command(message: types.Message, command: CommandObject)
 async def handle_replace_command(message: types.Message, command: CommandObject) -> None:
     logger.info("Command /replace: chat_id=%s, user=%s", message.chat.id, message.from_user.username)
 
-    image_bytes = await get_replied_photo_bytes(message)
-    if not image_bytes:
+    if replied_photo(message) is None:
         await message.reply(
             "Reply to a photo with this command.\n"
             "Example: <code>/replace the car -> a red sports car</code>"
@@ -121,6 +130,12 @@ async def handle_replace_command(message: types.Message, command: CommandObject)
         await react(success=False, message=message)
         return
 
+    await image_jobs.submit("replace", message, target=target, replacement=replacement)
+
+
+@image_jobs.job("replace")
+async def replace_object(message: types.Message, target: str, replacement: str) -> None:
+    image_bytes = await get_replied_photo_bytes(message)
     await message.chat.do("upload_photo")
     progress_msg = await message.answer(f"Replacing {target}...")
 
@@ -146,12 +161,17 @@ async def handle_replace_command(message: types.Message, command: CommandObject)
 async def handle_remove_bg_command(message: types.Message) -> None:
     logger.info("Command /remove_bg: chat_id=%s, user=%s", message.chat.id, message.from_user.username)
 
-    image_bytes = await get_replied_photo_bytes(message)
-    if not image_bytes:
+    if replied_photo(message) is None:
         await message.reply("Reply to a photo with this command.")
         await react(success=False, message=message)
         return
 
+    await image_jobs.submit("remove_bg", message)
+
+
+@image_jobs.job("remove_bg")
+async def remove_background(message: types.Message) -> None:
+    image_bytes = await get_replied_photo_bytes(message)
     await message.chat.do("upload_photo")
     progress_msg = await message.answer("Removing background...")
 
@@ -174,8 +194,7 @@ async def handle_remove_bg_command(message: types.Message) -> None:
 async def handle_background_command(message: types.Message, command: CommandObject) -> None:
     logger.info("Command /background: chat_id=%s, user=%s", message.chat.id, message.from_user.username)
 
-    image_bytes = await get_replied_photo_bytes(message)
-    if not image_bytes:
+    if replied_photo(message) is None:
         await message.reply(
             "Reply to a photo with this command.\n"
             "Example: <code>/bg sunset beach</code>"
@@ -193,6 +212,12 @@ async def handle_background_command(message: types.Message, command: CommandObje
         await react(success=False, message=message)
         return
 
+    await image_jobs.submit("background", message, new_bg=new_bg)
+
+
+@image_jobs.job("background")
+async def replace_background(message: types.Message, new_bg: str) -> None:
+    image_bytes = await get_replied_photo_bytes(message)
     await message.chat.do("upload_photo")
     progress_msg = await message.answer("Replacing background...")
 
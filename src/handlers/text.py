@@ -6,10 +6,12 @@ import time as time_module
 from aiogram import F, Router, types
 from aiogram.filters import Command, CommandObject
 
-from bot import bot, config, extract_message_chain, message_store, react
+from bot import bot, config, extract_message_chain, message_store, react, response_cache
 import metrics
 from message_store import StoredChatMessage
 from providers import TextResponse
+from response_cache import messages_parts
+from streaming import ProgressiveReply
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -19,6 +21,7 @@ router = Router()
     config.filter_chat_allowed,
     config.filter_command_not_disabled_for_chat,
     Command(commands=["ru", "en"]),
+    flags={"provider_call": True},
 )
 async def translate_ruen(message: types.Message, command: CommandObject):
     logger.info(
@@ -41,64 +44,79 @@ async def translate_ruen(message: types.Message, command: CommandObject):
         len(command.args or ""),
     )
     await message.chat.do("typing")
-    llm_reply = await TextResponse.generate(
-        config=config,
-        chat_id=message.chat.id,
-        messages=messages_to_send,
+    provider = config.provider_for_chat_id(message.chat.id)
+    model = config.model_for_chat_id(message.chat.id)
+    llm_reply = await response_cache.get_or_generate(
+        "translation",
+        messages_parts(provider, model, messages_to_send),
+        lambda: TextResponse.generate(
+            config=config,
+            chat_id=message.chat.id,
+            messages=messages_to_send,
+        ),
+        # a fallback provider's translation is cached as that provider's
+        parts_for_reply=lambda reply: messages_parts(
+            reply.provider or provider, reply.model or model, messages_to_send
+        ),
     )
 
     await message.reply(llm_reply.text)
     await react(llm_reply.success, message)
 
 
-@router.message(F.text, config.filter_chat_allowed)
-async def handle_text_message(message: types.Message):
-    logger.debug(
-        "Text message received from chat_id=%s user=%s, text_length=%d",
-        message.chat.id,
-        message.from_user.username,
-        len(message.text or ""),
-    )
-    start_time = time_module.perf_counter()
-    chat_config = config[message.chat.id]
-    save_messages = chat_config.save_messages
-    context_enabled = chat_config.context_enabled
-
-    tag = f"matvey-3000:history:{config.me_strip_lower}:{message.chat.id}"
-
+async def addressed_to_bot(message: types.Message) -> bool:
+    """Filter for text messages the bot should answer."""
     # if last message is a single word, ignore it
-    args = message.text
-    args = args.split()
+    args = message.text.split()
     if len(args) == 1:
         logger.debug("Ignoring single-word message from chat_id=%s", message.chat.id)
-        return
-
-    # Determine if we should respond
-    should_respond = False
+        return False
 
     # Check if this is a reply thread
     message_chain = extract_message_chain(message, bot.id)
     has_bot_in_thread = any(role == "assistant" for role, _ in message_chain)
 
     if has_bot_in_thread:
-        should_respond = True
         logger.debug("Responding to reply thread in chat_id=%s", message.chat.id)
+        return True
     elif len(message_chain) > 1 and random.random() < 0.95:
         logger.debug("Ignoring thread without bot in chat_id=%s", message.chat.id)
-        return
+        return False
     elif message.chat.id < 0:
         # Group chat - only respond if mentioned
         if any(config.me in x for x in args):
-            should_respond = True
             logger.debug("Responding to mention in group chat_id=%s", message.chat.id)
+            return True
     else:
         # Private chat - always respond
-        should_respond = True
         logger.debug("Responding to private chat_id=%s", message.chat.id)
+        return True
+
+    logger.debug("Not responding to message in chat_id=%s", message.chat.id)
+    return False
 
-    if not should_respond:
-        logger.debug("Not responding to message in chat_id=%s", message.chat.id)
-        return
+
+# The decision to answer is a filter rather than part of the handler, so that
+# only messages the bot actually answers go through the concurrency limiter
+@router.message(
+    F.text,
+    config.filter_chat_allowed,
+    addressed_to_bot,
+    flags={"provider_call": True},
+)
+async def handle_text_message(message: types.Message):
+    logger.debug(
+        "Text message received from chat_id=%s user=%s, text_length=%d",
+        message.chat.id,
+        message.from_user.username,
+        len(message.text or ""),
+    )
+    start_time = time_module.perf_counter()
+    chat_config = config[message.chat.id]
+    save_messages = chat_config.save_messages
+    context_enabled = chat_config.context_enabled
+
+    tag = config.history_tag(message.chat.id)
 
     # Build context for LLM
     system_prompt = config.prompt_tuple_for_chat(message.chat.id)
@@ -110,7 +128,7 @@ async def handle_text_message(message: types.Message):
             message.chat.id,
             max_context,
         )
-        messages_to_send = message_store.build_context_messages(
+        messages_to_send = await message_store.build_context_messages(
             key=tag,
             limit=max_context,
             bot_username=config.me_strip_lower,
@@ -124,6 +142,7 @@ async def handle_text_message(message: types.Message):
             len(messages_to_send),
         )
     else:
+        message_chain = extract_message_chain(message, bot.id)
         logger.debug(
             "Using thread-based context for chat_id=%s, chain_length=%d",
             message.chat.id,
@@ -146,11 +165,20 @@ async def handle_text_message(message: types.Message):
         len(messages_to_send),
     )
 
-    llm_reply = await TextResponse.generate(
-        config=config,
-        chat_id=message.chat.id,
-        messages=messages_to_send,
-    )
+    if chat_config.stream_responses:
+        progressive_reply = ProgressiveReply(message)
+        llm_reply = await TextResponse.generate_streaming(
+            config=config,
+            chat_id=message.chat.id,
+            messages=messages_to_send,
+            on_text=progressive_reply.update,
+        )
+    else:
+        llm_reply = await TextResponse.generate(
+            config=config,
+            chat_id=message.chat.id,
+            messages=messages_to_send,
+        )
 
     if llm_reply.success:
         logger.info(
@@ -167,13 +195,14 @@ async def handle_text_message(message: types.Message):
         )
         metrics.requests_total.labels(command='chat', status='error').inc()
 
-    func = message.reply if llm_reply.success else message.answer
-    await func(llm_reply.text)
+    if chat_config.stream_responses:
+        await progressive_reply.finish(llm_reply.text, llm_reply.success)
+    else:
+        func = message.reply if llm_reply.success else message.answer
+        await func(llm_reply.text)
 
     if save_messages:
         user_msg = StoredChatMessage.from_tg_message(message)
-        message_store.save(tag, user_msg)
-
         bot_msg = StoredChatMessage(
             chat_name=message.chat.full_name,
             from_username=config.me_strip_lower,
@@ -181,7 +210,12 @@ async def handle_text_message(message: types.Message):
             text=llm_reply.text,
             timestamp=int(time.time()),
         )
-        message_store.save(tag, bot_msg)
+        await message_store.save_many(
+            tag,
+            [user_msg, bot_msg],
+            max_age=chat_config.history_max_age_seconds,
+            max_messages=chat_config.history_max_messages,
+        )
         logger.debug(
             "Saved user and bot messages to Redis for chat_id=%s", message.chat.id
         )
@@ -5,9 +5,10 @@ from aiogram import F, Router, types
 from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from bot import bot, config, message_store, react
+from bot import config, download_file_bytes, jobs, message_store, react
 import metrics
 from providers import AudioResponse
+from retry import is_retryable_error
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -26,7 +27,6 @@ async def handle_voice_message(message: types.Message) -> None:
         message.from_user.username,
         message.voice.duration,
     )
-    start_time = time_module.perf_counter()
 
     if message.voice.duration > MAX_VOICE_DURATION_SECONDS:
         await message.reply(
@@ -37,12 +37,16 @@ async def handle_voice_message(message: types.Message) -> None:
         await react(success=False, message=message)
         return
 
+    await jobs.submit("voice", message)
+
+
+@jobs.job("voice")
+async def transcribe_voice(message: types.Message) -> None:
+    start_time = time_module.perf_counter()
     await message.chat.do("typing")
 
     try:
-        file = await bot.get_file(message.voice.file_id)
-        file_bytes = await bot.download_file(file.file_path)
-        audio_data = file_bytes.read()
+        audio_data = await download_file_bytes(message.voice)
 
         response = await AudioResponse.transcribe(audio_data, filename="voice.ogg")
 
@@ -68,6 +72,9 @@ async def handle_voice_message(message: types.Message) -> None:
             await react(success=False, message=message)
 
     except Exception as e:
+        if is_retryable_error(e):
+            # the job queue tries again later
+            raise
         logger.error("Voice transcription error: %s", e, exc_info=True)
         metrics.requests_total.labels(command='voice', status='error').inc()
         metrics.errors_total.labels(error_type='exception').inc()
@@ -88,7 +95,6 @@ async def handle_video_note_message(message: types.Message) -> None:
         message.from_user.username,
         message.video_note.duration,
     )
-    start_time = time_module.perf_counter()
 
     if message.video_note.duration > MAX_VOICE_DURATION_SECONDS:
         await message.reply(
@@ -99,12 +105,16 @@ async def handle_video_note_message(message: types.Message) -> None:
         await react(success=False, message=message)
         return
 
+    await jobs.submit("video_note", message)
+
+
+@jobs.job("video_note")
+async def transcribe_video_note(message: types.Message) -> None:
+    start_time = time_module.perf_counter()
     await message.chat.do("typing")
 
     try:
-        file = await bot.get_file(message.video_note.file_id)
-        file_bytes = await bot.download_file(file.file_path)
-        video_data = file_bytes.read()
+        video_data = await download_file_bytes(message.video_note)
 
         response = await AudioResponse.transcribe(video_data, filename="video_note.mp4")
 
@@ -130,6 +140,9 @@ async def handle_video_note_message(message: types.Message) -> None:
             await react(success=False, message=message)
 
     except Exception as e:
+        if is_retryable_error(e):
+            # the job queue tries again later
+            raise
         logger.error("Video note transcription error: %s", e, exc_info=True)
         metrics.requests_total.labels(command='video_note', status='error').inc()
         metrics.errors_total.labels(error_type='exception').inc()
@@ -169,6 +182,7 @@ def parse_tts_voice_and_text(args: str, default_voice: str) -> tuple[str, str]:
 @router.message(
     config.filter_voice_enabled,
     Command(commands=["tts"]),
+    flags={"provider_call": True},
 )
 async def handle_tts_command(message: types.Message, command: CommandObject) -> None:
     logger.info(
@@ -208,7 +222,7 @@ async def handle_tts_command(message: types.Message, command: CommandObject) ->
             )
             metrics.requests_total.labels(command='tts', status='success').inc()
 
-            message_store.store_tts_text(
+            await message_store.store_tts_text(
                 bot_username=config.me_strip_lower,
                 chat_id=message.chat.id,
                 user_id=message.from_user.id,
@@ -240,12 +254,12 @@ async def handle_tts_command(message: types.Message, command: CommandObject) ->
         metrics.request_duration.labels(command='tts').observe(time_module.perf_counter() - start_time)
 
 
-@router.callback_query(F.data.startswith("tts:"))
+@router.callback_query(F.data.startswith("tts:"), flags={"provider_call": True})
 async def handle_tts_voice_callback(callback: types.CallbackQuery) -> None:
     _, voice, original_msg_id = callback.data.split(":")
     original_msg_id = int(original_msg_id)
 
-    text = message_store.get_tts_text(
+    text = await message_store.get_tts_text(
         bot_username=config.me_strip_lower,
         chat_id=callback.message.chat.id,
         user_id=callback.from_user.id,
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass, field
+from typing import Any
+
+from aiogram import Bot, types
+
+import metrics
+from retry import RetryPolicy
+
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = 2
+# image jobs take tens of seconds each, so they get a queue and workers of
+# their own and never hold up voice transcriptions
+IMAGE_JOB_WORKERS = 2
+JOB_MAX_ATTEMPTS = 3
+# how long an idle worker blocks on the queue before checking for delayed jobs
+JOB_POLL_SECONDS = 1.0
+JOB_HEARTBEAT_SECONDS = 10.0
+# a worker that hasn't sent a heartbeat for this long is taken for dead and
+# its unfinished jobs are put back on the queue by the others
+JOB_WORKER_TIMEOUT_SECONDS = 60.0
+QUEUED_REACTION = '👀'
+
+JobFunc = Callable[..., Awaitable[None]]
+
+
+@dataclass
+class Job:
+    kind: str
+    message: dict
+    kwargs: dict
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    attempts: int = 0
+    enqueued_at: float = field(default_factory=time.time)
+
+    def serialize(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def deserialize(cls, payload: str) -> Job:
+        return cls(**json.loads(payload))
+
+
+class JobQueue:
+    """
+    Redis-backed queue for slow commands (image edits, transcriptions). A
+    handler enqueues the job with the Telegram message that asked for it and
+    returns at once, and a pool of workers (in the bot process or started
+    separately with src/worker.py) runs it and replies to that message. Jobs
+    of very different length go to queues of their own, so a backlog of the
+    long ones can't keep the short ones waiting.
+
+    Claimed jobs sit in a per-worker processing list until they finish. Workers
+    send heartbeats, and the processing list of a worker that stopped sending
+    them is put back on the queue by the others. Jobs that raise are
+    retried with backoff up to max_attempts, and payloads that can't be run
+    at all are moved to a dead letter list.
+    """
+
+    def __init__(
+        self,
+        store,
+        namespace: str,
+        worker_id: str | None = None,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        retry_policy: RetryPolicy | None = None,
+        poll_seconds: float = JOB_POLL_SECONDS,
+        heartbeat_seconds: float = JOB_HEARTBEAT_SECONDS,
+        worker_timeout: float = JOB_WORKER_TIMEOUT_SECONDS,
+    ):
+        self.store = store
+        self.namespace = namespace
+        # unique per process: a restarted pod gets a new hostname, and the bot
+        # and src/worker.py may share one
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.max_attempts = max_attempts
+        self.retry_policy = retry_policy or RetryPolicy(base_delay=2.0, max_delay=30.0)
+        self.poll_seconds = poll_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.worker_timeout = worker_timeout
+        self._funcs: dict[str, JobFunc] = {}
+
+    @classmethod
+    def from_env(cls, store, namespace: str) -> JobQueue:
+        return cls(
+            store,
+            namespace,
+            worker_id=os.getenv('JOB_WORKER_ID'),
+            max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', JOB_MAX_ATTEMPTS)),
+        )
+
+    @property
+    def queue_key(self) -> str:
+        return f'matvey-3000:jobs:{self.namespace}:queue'
+
+    @property
+    def delayed_key(self) -> str:
+        return f'matvey-3000:jobs:{self.namespace}:delayed'
+
+    @property
+    def dead_key(self) -> str:
+        return f'matvey-3000:jobs:{self.namespace}:dead'
+
+    @property
+    def workers_key(self) -> str:
+        return f'matvey-3000:jobs:{self.namespace}:workers'
+
+    @property
+    def processing_key(self) -> str:
+        return self.processing_key_for(self.worker_id)
+
+    def processing_key_for(self, worker_id: str) -> str:
+        return f'matvey-3000:jobs:{self.namespace}:processing:{worker_id}'
+
+    def job(self, kind: str) -> Callable[[JobFunc], JobFunc]:
+        """Register func(message, **kwargs) as the job run for kind."""
+
+        def register(func: JobFunc) -> JobFunc:
+            self._funcs[kind] = func
+            return func
+
+        return register
+
+    async def enqueue(self, kind: str, message: types.Message, **kwargs: Any) -> Job:
+        if kind not in self._funcs:
+            raise KeyError(f'No job registered for {kind}')
+        job = Job(kind=kind, message=message.model_dump(mode='json', exclude_none=True), kwargs=kwargs)
+        await self.store.push_job(self.queue_key, job.serialize())
+        metrics.jobs_total.labels(kind=kind, status='queued').inc()
+        logger.info('Job queued: kind=%s, id=%s, chat_id=%s', kind, job.id, message.chat.id)
+        return job
+
+    async def submit(self, kind: str, message: types.Message, **kwargs: Any) -> Job:
+        """Enqueue and let the user know the request was accepted."""
+        job = await self.enqueue(kind, message, **kwargs)
+        try:
+            reaction = types.reaction_type_emoji.ReactionTypeEmoji(type='emoji', emoji=QUEUED_REACTION)
+            await message.react(reaction=[reaction])
+        except Exception as e:
+            logger.debug('Failed to react to a queued job: %s', e)
+        return job
+
+    async def run(self, bot: Bot, concurrency: int = JOB_WORKERS) -> None:
+        """Process jobs with concurrency workers until cancelled."""
+        logger.info('Job workers started: worker_id=%s, concurrency=%d', self.worker_id, concurrency)
+        try:
+            await asyncio.gather(self._keep_alive(), *(self._consume(bot) for _ in range(concurrency)))
+        finally:
+            await self._retire()
+
+    async def recover_dead_workers(self, now: float | None = None) -> int:
+        """Send a heartbeat and requeue the jobs of workers that stopped sending theirs."""
+        now = time.time() if now is None else now
+        await self.store.heartbeat_worker(self.workers_key, self.worker_id, now)
+        requeued = 0
+        for worker_id in await self.store.stale_workers(self.workers_key, now - self.worker_timeout):
+            if worker_id == self.worker_id:
+                continue
+            requeued += await self.store.requeue_jobs(self.processing_key_for(worker_id), self.queue_key)
+            await self.store.forget_worker(self.workers_key, worker_id)
+            logger.warning('Job worker %s stopped sending heartbeats, its jobs were requeued', worker_id)
+        return requeued
+
+    async def _keep_alive(self) -> None:
+        while True:
+            try:
+                await self.recover_dead_workers()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('Job worker heartbeat failed: %s', e)
+            await asyncio.sleep(self.heartbeat_seconds)
+
+    async def _retire(self) -> None:
+        """Hand the jobs interrupted by shutdown to the other workers."""
+        try:
+            await self.store.requeue_jobs(self.processing_key, self.queue_key)
+            await self.store.forget_worker(self.workers_key, self.worker_id)
+        except Exception as e:
+            logger.error('Failed to requeue unfinished jobs on shutdown: %s', e)
+
+    async def _consume(self, bot: Bot) -> None:
+        while True:
+            try:
+                await self.store.promote_due_jobs(self.delayed_key, self.queue_key, time.time())
+                payload = await self.store.claim_job(self.queue_key, self.processing_key, self.poll_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('Job queue unavailable: %s', e)
+                await asyncio.sleep(self.poll_seconds)
+                continue
+            if payload is None:
+                continue
+            try:
+                await self.process(bot, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the payload stays in processing and is requeued on restart,
+                # but this worker keeps going
+                logger.error('Job processing failed: %s', e, exc_info=True)
+
+    async def process(self, bot: Bot, payload: str) -> None:
+        try:
+            job = Job.deserialize(payload)
+            func = self._funcs[job.kind]
+            message = types.Message.model_validate(job.message, context={'bot': bot})
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error('Unreadable job moved to %s: %r, payload=%.200s', self.dead_key, e, payload)
+            metrics.jobs_total.labels(kind='unknown', status='dead').inc()
+            await self.store.bury_job(self.processing_key, self.dead_key, payload)
+            return
+
+        job.attempts += 1
+        metrics.job_wait_seconds.labels(kind=job.kind).observe(max(0.0, time.time() - job.enqueued_at))
+        started_at = time.perf_counter()
+        try:
+            await func(message, **job.kwargs)
+        except asyncio.CancelledError:
+            # shutting down, the job stays in processing until _retire requeues it
+            raise
+        except Exception as e:
+            await self._failed(bot, job, e)
+        else:
+            metrics.jobs_total.labels(kind=job.kind, status='success').inc()
+            logger.info('Job done: kind=%s, id=%s, attempts=%d', job.kind, job.id, job.attempts)
+        finally:
+            metrics.job_duration.labels(kind=job.kind).observe(time.perf_counter() - started_at)
+        await self.store.finish_job(self.processing_key, payload)
+
+    async def _failed(self, bot: Bot, job: Job, error: Exception) -> None:
+        delay = self.retry_policy.backoff(job.attempts)
+        if job.attempts < self.max_attempts and delay is not None:
+            logger.warning('Job failed: kind=%s, id=%s, attempt=%d, retrying in %.1fs: %r',
+                           job.kind, job.id, job.attempts, delay, error)
+            metrics.jobs_total.labels(kind=job.kind, status='retried').inc()
+            await self.store.schedule_job(self.delayed_key, job.serialize(), time.time() + delay)
+            return
+
+        logger.error('Job failed for good: kind=%s, id=%s, attempts=%d', job.kind, job.id, job.attempts,
+                     exc_info=error)
+        metrics.jobs_total.labels(kind=job.kind, status='error').inc()
+        try:
+            await bot.send_message(
+                job.message['chat']['id'],
+                f'Не получилось: {error}',
+                reply_to_message_id=job.message['message_id'],
+            )
+        except Exception as e:
+            logger.warning('Failed to report job failure to the chat: %s', e)
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from dataclasses import dataclass
+
+import httpx
+
+from retry import is_retryable_response, with_retries
+
+
+logger = logging.getLogger(__name__)
+
+KANDINSKI_BASE_URL = 'https://api-key.fusionbrain.ai/key/api/v1'
+# 2024jan09: only one model supported at the moment anyway, it rarely changes
+MODEL_ID_TTL_SECONDS = 3600.0
+# most jobs finish within a few seconds, so poll often at first and back off
+# for the slow ones
+POLL_FIRST_INTERVAL_SECONDS = 1.0
+POLL_MAX_INTERVAL_SECONDS = 10.0
+POLL_BACKOFF_FACTOR = 1.5
+POLL_TIMEOUT_SECONDS = 120.0
+
+
+class KandinskiError(Exception):
+    """Kandinski rejected the request or reported the job as failed."""
+
+
+def _checked(response: httpx.Response) -> httpx.Response:
+    # with_retries hands back 4xx as is, and the last 5xx once it gives up
+    if not response.is_success:
+        raise KandinskiError(f'HTTP {response.status_code}: {response.text[:200]}')
+    return response
+
+
+@dataclass(frozen=True)
+class KandinskiResult:
+    done: bool
+    image_b64: str | None = None
+    censored: bool = False
+
+
+def poll_intervals(
+    first: float = POLL_FIRST_INTERVAL_SECONDS,
+    factor: float = POLL_BACKOFF_FACTOR,
+    cap: float = POLL_MAX_INTERVAL_SECONDS,
+) -> Iterator[float]:
+    interval = first
+    while True:
+        yield interval
+        interval = min(cap, interval * factor)
+
+
+class KandinskiApi:
+    """
+    Fusionbrain text2image API. The model id is cached for a while instead
+    of being fetched for every picture, and job status is polled with a
+    growing interval until the job is done or the poll timeout runs out.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        api_secret: str,
+        base_url: str = KANDINSKI_BASE_URL,
+        model_ttl: float = MODEL_ID_TTL_SECONDS,
+        poll_timeout: float = POLL_TIMEOUT_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    ):
+        self.headers = {
+            'X-Key': f'Key {api_key}',
+            'x-Secret': f'Secret {api_secret}',
+        }
+        self.base_url = base_url.rstrip('/')
+        self.model_ttl = model_ttl
+        self.poll_timeout = poll_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self._model_id: int | None = None
+        self._model_fetched_at = 0.0
+
+    @classmethod
+    def from_env(cls) -> KandinskiApi:
+        return cls(
+            api_key=os.getenv('KANDINSKI_API_KEY', default='KandiKeyOopsie'),
+            api_secret=os.getenv('KANDINSKI_API_SECRET', default='KandiSecretOopsie'),
+            base_url=os.getenv('KANDINSKI_BASE_URL', default=KANDINSKI_BASE_URL),
+            poll_timeout=float(os.getenv('KANDINSKI_POLL_TIMEOUT_SECONDS', POLL_TIMEOUT_SECONDS)),
+        )
+
+    async def _get(self, client: httpx.AsyncClient, path: str) -> httpx.Response:
+        return _checked(await with_retries('kandinski', lambda: client.get(
+            f'{self.base_url}{path}',
+            headers=self.headers,
+        ), retry_result=is_retryable_response))
+
+    async def model_id(self, client: httpx.AsyncClient) -> int:
+        if self._model_id is None or self.clock() - self._model_fetched_at > self.model_ttl:
+            response = await self._get(client, '/models')
+            self._model_id = response.json()[0]['id']
+            self._model_fetched_at = self.clock()
+            logger.debug('Kandinski model selected: model_id=%s', self._model_id)
+        return self._model_id
+
+    async def start(self, client: httpx.AsyncClient, prompt: str) -> str:
+        params = {
+            'type': 'GENERATE',
+            'width': 512,
+            'height': 512,
+            'num_images': 1,
+            'generateParams': {
+                'query': prompt,
+            },
+        }
+        data = {
+            'model_id': (None, str(await self.model_id(client))),
+            'params': (None, json.dumps(params), 'application/json'),
+        }
+        response = _checked(await with_retries('kandinski', lambda: client.post(
+            f'{self.base_url}/text2image/run',
+            headers=self.headers,
+            files=data,
+        ), retry_result=is_retryable_response))
+        run_id = response.json()['uuid']
+        logger.debug('Kandinski generation started: run_id=%s', run_id)
+        return run_id
+
+    async def wait(self, client: httpx.AsyncClient, run_id: str) -> KandinskiResult:
+        """Poll until the job is done; cancelling the caller simply stops polling."""
+        give_up_at = self.clock() + self.poll_timeout
+        for interval in poll_intervals():
+            response = await self._get(client, f'/text2image/status/{run_id}')
+            data = response.json()
+            if data['status'] == 'DONE':
+                logger.info('Kandinski image generated: run_id=%s, censored=%s', run_id, data['censored'])
+                return KandinskiResult(done=True, image_b64=data['images'][0], censored=data['censored'])
+            if data['status'] == 'FAIL':
+                raise KandinskiError(data.get('errorDescription', 'generation failed'))
+            if self.clock() + interval > give_up_at:
+                break
+            logger.debug('Kandinski generation in progress: run_id=%s, next poll in %.1fs', run_id, interval)
+            await self.sleep(interval)
+
+        logger.warning('Kandinski generation timed out: run_id=%s', run_id)
+        return KandinskiResult(done=False)
+
+    async def generate(self, client: httpx.AsyncClient, prompt: str) -> KandinskiResult:
+        logger.debug('Kandinski request: prompt=%r', prompt)
+        run_id = await self.start(client, prompt)
+        return await self.wait(client, run_id)
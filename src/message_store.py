@@ -3,19 +3,112 @@ from __future__ import annotations
 import json
 import logging
 import os
+import struct
+import time
+from collections.abc import AsyncIterator, Iterable, Iterator
 from dataclasses import asdict, dataclass
 
 import redis
+import redis.asyncio as aioredis
 import tiktoken
 
+from executor import run_cpu
 
 logger = logging.getLogger(__name__)
 
 
+# newest messages kept per chat unless its config says otherwise
 CUTOFF = 2000
+DEFAULT_MAX_CONNECTIONS = 20
+# sorted set of chat history keys scored by the time they were last written,
+# so stats never have to walk the keyspace
+HISTORY_INDEX_KEY = 'matvey-3000:history-index'
+HISTORY_KEYS_PATTERN = 'matvey-3000:history:*'
+# keys per SCAN/TYPE batch when walking the keyspace
+SCAN_BATCH = 500
+# entries per LRANGE when reading a whole history, e.g. for an export
+HISTORY_READ_WINDOW = 1000
+# chat history is kept in one list per chat per hour, so reading a time range
+# or the newest messages touches only the buckets involved and old messages
+# go away with their bucket's TTL
+HISTORY_BUCKET_SECONDS = 3600
+# a chat may go this share over its max_messages before a save trims it, so
+# a full chat pays for the extra retention round trip once per that many
+# saves rather than on every one
+RETENTION_SLACK = 0.1
+DEFAULT_ENCODING = 'cl100k_base'
+# newest job payloads kept for inspection after they turned out unrunnable
+DEAD_JOBS_MAX = 1000
 
 
-@dataclass
+# a tiktoken encoding that failed to load (usually the BPE file download) is
+# tried again after this long, not on every token count
+ENCODING_RETRY_SECONDS = 300.0
+_encodings: dict[str, tiktoken.Encoding] = {}
+_encoding_failed_at: dict[str, float] = {}
+
+
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding | None:
+    """
+    Cached tiktoken encoder lookup. Returns None when the encoding can't be
+    loaded (unknown name, or the BPE file can't be downloaded), callers then
+    fall back to a character based approximation until a later retry succeeds.
+    """
+    encoding = _encodings.get(encoding_name)
+    if encoding is not None:
+        return encoding
+    failed_at = _encoding_failed_at.get(encoding_name)
+    if failed_at is not None and time.monotonic() - failed_at < ENCODING_RETRY_SECONDS:
+        return None
+    try:
+        encoding = tiktoken.get_encoding(encoding_name)
+    except (KeyError, ValueError, LookupError, OSError) as e:
+        _encoding_failed_at[encoding_name] = time.monotonic()
+        logger.warning('Failed to load tiktoken encoding %s: %s, using character approximation', encoding_name, e)
+        return None
+    _encodings[encoding_name] = encoding
+    _encoding_failed_at.pop(encoding_name, None)
+    logger.debug('Using tiktoken encoding: %s', encoding_name)
+    return encoding
+
+
+def count_tokens(text: str | None, encoding_name: str = DEFAULT_ENCODING) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        # For Russian/Cyrillic text, use more conservative ratio
+        # Roughly 3 chars per token for mixed Latin/Cyrillic
+        return max(len(text) // 3, 1)
+    return len(encoding.encode(text))
+
+
+# Compact entry layout: format version, timestamp, token count (-1 when not
+# counted yet) and the byte lengths of username, full name and text, followed
+# by the three UTF-8 strings. The chat is already known from the Redis key, so
+# chat_name isn't stored. Entries written as JSON start with "{" and are still
+# read as before.
+COMPACT_FORMAT_V1 = 1
+_COMPACT_HEADER = struct.Struct('<BqiHHI')
+_NONE_SHORT = 0xFFFF
+_NONE_LONG = 0xFFFFFFFF
+
+
+def _pack_str(value: str | None, none: int) -> tuple[bytes, int]:
+    if value is None:
+        return b'', none
+    data = value.encode('utf-8')
+    return data, len(data)
+
+
+def _unpack_str(data: bytes, offset: int, length: int, none: int) -> tuple[str | None, int]:
+    if length == none:
+        return None, offset
+    end = offset + length
+    return data[offset:end].decode('utf-8'), end
+
+
+@dataclass(slots=True)
 class StoredChatMessage:
     chat_name: str
     from_username: str
@@ -23,8 +116,25 @@ class StoredChatMessage:
     timestamp: int
     text: str
     #    raw: str
+    # tokens in text under DEFAULT_ENCODING, filled in on save
+    token_count: int | None = None
+
+    def serialize(self) -> bytes:
+        username, username_len = _pack_str(self.from_username, _NONE_SHORT)
+        full_name, full_name_len = _pack_str(self.from_full_name, _NONE_SHORT)
+        text, text_len = _pack_str(self.text, _NONE_LONG)
+        header = _COMPACT_HEADER.pack(
+            COMPACT_FORMAT_V1,
+            int(self.timestamp),
+            -1 if self.token_count is None else self.token_count,
+            username_len,
+            full_name_len,
+            text_len,
+        )
+        return b''.join((header, username, full_name, text))
 
-    def serialize(self):
+    def serialize_json(self) -> str:
+        """The old verbose format, for exports meant to be read by people."""
         return json.dumps(asdict(self), ensure_ascii=False)
 
     def __str__(self):
@@ -34,13 +144,41 @@ class StoredChatMessage:
         return f'{tag} [at {self.timestamp}]: {self.text}'
 
     @classmethod
-    def deserialize(cls, serialized_dict: str | dict):
-        if isinstance(serialized_dict, (str, bytes)):
-            serialized_dict = json.loads(serialized_dict)
-        obj = cls(**serialized_dict)
+    def deserialize(cls, serialized: bytes | str | dict, chat_name: str = ''):
+        """Read an entry in the compact format or in the JSON one it replaced."""
+        if isinstance(serialized, bytes) and cls.is_compact(serialized):
+            return cls._deserialize_compact(serialized, chat_name)
+        if isinstance(serialized, (str, bytes)):
+            serialized = json.loads(serialized)
+        obj = cls(**serialized)
         obj.timestamp = int(obj.timestamp)
         return obj
 
+    @classmethod
+    def _deserialize_compact(cls, data: bytes, chat_name: str):
+        _, timestamp, token_count, username_len, full_name_len, text_len = _COMPACT_HEADER.unpack_from(data)
+        offset = _COMPACT_HEADER.size
+        username, offset = _unpack_str(data, offset, username_len, _NONE_SHORT)
+        full_name, offset = _unpack_str(data, offset, full_name_len, _NONE_SHORT)
+        text, _ = _unpack_str(data, offset, text_len, _NONE_LONG)
+        return cls(
+            chat_name=chat_name,
+            from_username=username,
+            from_full_name=full_name,
+            timestamp=timestamp,
+            text=text,
+            token_count=None if token_count < 0 else token_count,
+        )
+
+    @staticmethod
+    def is_compact(serialized: bytes) -> bool:
+        return serialized[:1] == bytes([COMPACT_FORMAT_V1])
+
+    def ensure_token_count(self) -> int:
+        if self.token_count is None:
+            self.token_count = count_tokens(self.text)
+        return self.token_count
+
     @classmethod
     def from_tg_message(cls, message):
         from_user = message.from_user
@@ -55,10 +193,307 @@ class StoredChatMessage:
         )
 
 
+def _redacted_url(redis_url: str) -> str:
+    return redis_url.split('@')[-1] if '@' in redis_url else redis_url
+
+
+def _temp_image_key(chat_id: int, user_id: int, image_key: str) -> str:
+    return f'matvey-3000:temp_image:{chat_id}:{user_id}:{image_key}'
+
+
+def _tts_key(bot_username: str, chat_id: int, user_id: int, message_id: int) -> str:
+    return f'matvey-3000:tts:{bot_username}:{chat_id}:{user_id}:{message_id}'
+
+
+def _bucket_start(timestamp: float) -> int:
+    return int(timestamp) // HISTORY_BUCKET_SECONDS * HISTORY_BUCKET_SECONDS
+
+
+def _bucket_key(tag: str, start: int) -> str:
+    return f'{tag}:b:{start}'
+
+
+def _buckets_key(tag: str) -> str:
+    return f'{tag}:buckets'
+
+
+# field of the bucket hash with the max_age the chat's buckets expire after,
+# so readers can tell which of the counted buckets are gone already
+_MAX_AGE_FIELD = 'max_age'
+
+
+def _migration_claim_key(key: str) -> str:
+    # outside HISTORY_KEYS_PATTERN so a claimed legacy list is not found again
+    return f'matvey-3000:migrating:{key}'
+
+
+def _is_bucket_layout_key(key: str) -> bool:
+    return ':b:' in key or key.endswith(':buckets')
+
+
+def _by_bucket(messages: list[StoredChatMessage]) -> dict[int, list[StoredChatMessage]]:
+    buckets: dict[int, list[StoredChatMessage]] = {}
+    for message in messages:
+        buckets.setdefault(_bucket_start(message.timestamp), []).append(message)
+    return buckets
+
+
+def _bucket_counts(raw: dict, with_expired: bool = False) -> list[tuple[int, int]]:
+    """
+    HGETALL of a chat's bucket hash as (bucket start, messages) oldest first.
+    Buckets Redis has already expired keep their entry until the next
+    retention pass, they are left out unless with_expired.
+    """
+    max_age = None
+    counts = []
+    for field, count in raw.items():
+        if field in (_MAX_AGE_FIELD, _MAX_AGE_FIELD.encode()):
+            max_age = int(count)
+        else:
+            counts.append((int(field), int(count)))
+    if max_age is not None and not with_expired:
+        cutoff = time.time() - max_age
+        counts = [(start, count) for start, count in counts if start + HISTORY_BUCKET_SECONDS > cutoff]
+    return sorted(counts)
+
+
+def _total(raw: dict) -> int:
+    """Messages in the live buckets of a chat's bucket hash."""
+    return sum(count for _, count in _bucket_counts(raw))
+
+
+def _newest_buckets(counts: list[tuple[int, int]], limit: int) -> list[tuple[int, int]]:
+    """
+    Buckets holding the newest limit messages (all of them when limit < 0) as
+    (bucket start, messages to read from its end), oldest first.
+    """
+    if limit < 0:
+        return counts
+    picked = []
+    remaining = limit
+    for start, count in reversed(counts):
+        if remaining <= 0:
+            break
+        picked.append((start, min(count, remaining)))
+        remaining -= count
+    return picked[::-1]
+
+
+def _guessed_buckets(limit: int) -> list[int]:
+    """
+    Buckets read along with the bucket hash by fetch_messages: the newest
+    messages of an active chat are nearly always in the current or the
+    previous bucket, so they usually take a single round trip.
+    """
+    if limit <= 0:
+        return []
+    current = _bucket_start(time.time())
+    return [current - HISTORY_BUCKET_SECONDS, current]
+
+
+def _queue_fetch(pipe, tag: str, limit: int) -> list[int]:
+    """Queue the first round trip of fetch_messages, return the guessed buckets."""
+    pipe.hgetall(_buckets_key(tag))
+    guessed = _guessed_buckets(limit)
+    for start in guessed:
+        pipe.lrange(_bucket_key(tag, start), -limit, -1)
+    return guessed
+
+
+def _picked_messages(picked: list[tuple[int, int]], read: dict[int, list[bytes]]) -> list[bytes]:
+    return [m for start, count in picked if count > 0 for m in read[start][-count:]]
+
+
+def _retention_plan(
+    counts: list[tuple[int, int]],
+    now: float,
+    max_age: float | None,
+    max_messages: int | None,
+) -> tuple[list[int], tuple[int, int] | None]:
+    """
+    Buckets to delete and, when the count limit falls inside a bucket, that
+    bucket with the number of its newest messages to keep.
+    """
+    drop = []
+    kept = counts
+    if max_age is not None:
+        cutoff = now - max_age
+        drop = [start for start, _ in counts if start + HISTORY_BUCKET_SECONDS <= cutoff]
+        kept = [(start, count) for start, count in counts if start + HISTORY_BUCKET_SECONDS > cutoff]
+
+    trim = None
+    if max_messages is not None:
+        total = 0
+        for i in range(len(kept) - 1, -1, -1):
+            start, count = kept[i]
+            if total + count > max_messages:
+                keep = max_messages - total
+                if keep > 0:
+                    trim = (start, keep)
+                    drop += [start for start, _ in kept[:i]]
+                else:
+                    drop += [start for start, _ in kept[:i + 1]]
+                break
+            total += count
+    return drop, trim
+
+
+def _queue_save(pipe, tag: str, buckets: dict[int, list[StoredChatMessage]], max_age: float | None) -> int:
+    """
+    Queue the writes of save_many on pipe, return the number of commands per
+    bucket. The last result is the bucket hash after the save.
+    """
+    for start, messages in buckets.items():
+        key = _bucket_key(tag, start)
+        pipe.rpush(key, *(message.serialize() for message in messages))
+        pipe.hincrby(_buckets_key(tag), start, len(messages))
+        if max_age is not None:
+            pipe.expireat(key, int(start + HISTORY_BUCKET_SECONDS + max_age))
+    if max_age is not None:
+        pipe.hset(_buckets_key(tag), _MAX_AGE_FIELD, int(max_age))
+        # the bucket hash lives as long as the newest bucket it describes
+        pipe.expireat(_buckets_key(tag), int(max(buckets) + HISTORY_BUCKET_SECONDS + max_age))
+    else:
+        pipe.hdel(_buckets_key(tag), _MAX_AGE_FIELD)
+    pipe.zadd(HISTORY_INDEX_KEY, {tag: time.time()})
+    pipe.hgetall(_buckets_key(tag))
+    return 3 if max_age is not None else 2
+
+
+def _needs_retention(
+    buckets: dict[int, list[StoredChatMessage]],
+    results: list,
+    per_bucket: int,
+    max_messages: int | None,
+) -> bool:
+    """
+    A bucket was started (expired buckets are dropped once per bucket) or the
+    chat holds more than max_messages plus RETENTION_SLACK.
+    """
+    for i, messages in enumerate(buckets.values()):
+        if results[i * per_bucket + 1] == len(messages):
+            return True
+    if max_messages is None:
+        return False
+    return _total(results[-1]) > max_messages * (1 + RETENTION_SLACK)
+
+
+def _log_saved(tag: str, messages: list[StoredChatMessage], bucket_len: int) -> int:
+    logger.debug('Messages saved: tag=%s, count=%d, from=%s, bucket_len=%d',
+                 tag, len(messages), ','.join(m.from_username or '' for m in messages), bucket_len)
+    return bucket_len
+
+
+def _queue_retention(pipe, tag: str, drop: list[int], trim: tuple[int, int] | None) -> None:
+    if drop:
+        pipe.delete(*(_bucket_key(tag, start) for start in drop))
+        pipe.hdel(_buckets_key(tag), *drop)
+    if trim is not None:
+        start, keep = trim
+        pipe.ltrim(_bucket_key(tag, start), -keep, -1)
+        pipe.hset(_buckets_key(tag), start, keep)
+
+
+def _json_entries(entries: list[bytes]) -> list[tuple[int, bytes]]:
+    """(index, entry re-encoded in the compact format) for entries still stored as JSON."""
+    return [
+        (i, StoredChatMessage.deserialize(entry).serialize())
+        for i, entry in enumerate(entries)
+        if not StoredChatMessage.is_compact(entry)
+    ]
+
+
+def _queue_clear(pipe, tag: str, counts: list[tuple[int, int]]) -> None:
+    pipe.delete(_buckets_key(tag), *(_bucket_key(tag, start) for start, _ in counts))
+    pipe.zrem(HISTORY_INDEX_KEY, tag)
+
+
+def _split_stats(keys: list[bytes], lengths: list[int]) -> tuple[list[tuple[str, int]], list[bytes]]:
+    stats, stale = [], []
+    for key, length in zip(keys, lengths):
+        if length:
+            stats.append((key.decode() if isinstance(key, bytes) else key, length))
+        else:
+            stale.append(key)
+    return stats, stale
+
+
+def _batched(items: Iterable[str], size: int) -> Iterator[list[str]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _ensure_token_counts(messages: list[StoredChatMessage]) -> None:
+    for message in messages:
+        message.ensure_token_count()
+
+
+def _to_conversation(
+    messages: list[StoredChatMessage], bot_username: str
+) -> list[tuple[str, str]]:
+    # Determine role based on username
+    return [
+        ('assistant' if msg.from_username == bot_username else 'user', msg.text)
+        for msg in messages
+    ]
+
+
+def _select_context(
+    messages: list[StoredChatMessage],
+    bot_username: str,
+    system_prompt: tuple[str, str],
+    max_tokens: int,
+    encoding_name: str,
+) -> list[tuple[str, str]]:
+    """
+    Pick the most recent history messages that fit into max_tokens
+    together with the system prompt. Token counts stored with the messages
+    are reused, so history is not re-tokenised on every reply.
+    """
+    # Start with system prompt
+    context = [system_prompt]
+
+    # Filter out messages with None or empty text
+    messages = [msg for msg in messages if msg.text]
+
+    if not messages:
+        logger.debug('No valid messages after filtering')
+        return context
+
+    def message_tokens(msg: StoredChatMessage) -> int:
+        if msg.token_count is not None and encoding_name == DEFAULT_ENCODING:
+            return msg.token_count
+        return count_tokens(msg.text, encoding_name)
+
+    # Count system prompt tokens
+    system_tokens = count_tokens(system_prompt[1], encoding_name)
+    total_tokens = system_tokens
+
+    # Add history messages from most recent backwards, respecting token limit
+    included_history = []
+    for msg in reversed(messages):
+        msg_tokens = message_tokens(msg)
+        if total_tokens + msg_tokens > max_tokens:
+            logger.debug('Token limit reached, stopping at %d messages included', len(included_history))
+            break
+        included_history.append(msg)
+        total_tokens += msg_tokens
+
+    context.extend(_to_conversation(reversed(included_history), bot_username))
+    logger.debug('Context built: total_messages=%d, estimated_tokens=%d', len(context), total_tokens)
+    return context
+
+
 class MessageStore:
     def __init__(self, redis_url: str):
         self.redis_conn = redis.from_url(redis_url)
-        logger.info('Redis message store initialized: url=%s', redis_url.split('@')[-1] if '@' in redis_url else redis_url)
+        logger.info('Redis message store initialized: url=%s', _redacted_url(redis_url))
 
     @classmethod
     def from_env(cls) -> MessageStore:
@@ -66,37 +501,167 @@ class MessageStore:
         logger.debug('Creating MessageStore from environment variable REDIS_URL')
         return cls(url)
 
-    def save(self, tag: str, message: StoredChatMessage):
-        # might need to have a deeper per-hour or per-day split
-        self.redis_conn.rpush(tag, message.serialize())
-        list_len = self.redis_conn.llen(tag)
-        logger.debug('Message saved: tag=%s, from=%s, list_len=%d', tag, message.from_username, list_len)
-        if list_len > CUTOFF:
-            self.redis_conn.ltrim(tag, 0, CUTOFF)
-            logger.debug('List trimmed to CUTOFF=%d for tag=%s', CUTOFF, tag)
-
-    def fetch_stats(self, keys_pattern: str) -> list[tuple[str, int]]:
-        logger.debug('Fetching stats for pattern: %s', keys_pattern)
-        keys = self.redis_conn.keys(keys_pattern)
-        stats = [
-            (key.decode(), self.redis_conn.llen(key))
-            for key in keys
-            if self.redis_conn.type(key) == b'list'  # noqa
-        ]
-        logger.debug('Stats fetched: %d keys found', len(stats))
+    def save(
+        self,
+        tag: str,
+        message: StoredChatMessage,
+        max_age: float | None = None,
+        max_messages: int | None = CUTOFF,
+    ) -> int:
+        return self.save_many(tag, [message], max_age=max_age, max_messages=max_messages)
+
+    def save_many(
+        self,
+        tag: str,
+        messages: list[StoredChatMessage],
+        max_age: float | None = None,
+        max_messages: int | None = CUTOFF,
+    ) -> int:
+        """
+        Append messages to the hourly buckets of the chat in a single
+        MULTI/EXEC round trip. Buckets expire max_age seconds after they end;
+        the count limit is enforced whenever a new bucket is started.
+
+        Args:
+            tag: Redis key prefix of the chat history
+            messages: Messages to append, oldest first
+            max_age: Seconds to keep messages for, None to keep them until trimmed
+            max_messages: Number of newest messages to keep, None for no limit
+
+        Returns:
+            Length of the bucket the last message went to
+        """
+        if not messages:
+            return 0
+        _ensure_token_counts(messages)
+        buckets = _by_bucket(messages)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        per_bucket = _queue_save(pipe, tag, buckets, max_age)
+        results = pipe.execute()
+        if (max_age is not None or max_messages is not None) and _needs_retention(
+            buckets, results, per_bucket, max_messages
+        ):
+            self.apply_retention(tag, max_age, max_messages)
+        return _log_saved(tag, messages, results[(len(buckets) - 1) * per_bucket])
+
+    def apply_retention(self, tag: str, max_age: float | None, max_messages: int | None) -> int:
+        """
+        Drop buckets older than max_age and the oldest messages beyond
+        max_messages.
+
+        Returns:
+            Number of buckets deleted
+        """
+        counts = _bucket_counts(self.redis_conn.hgetall(_buckets_key(tag)), with_expired=True)
+        drop, trim = _retention_plan(counts, time.time(), max_age, max_messages)
+        if not drop and trim is None:
+            return 0
+        pipe = self.redis_conn.pipeline(transaction=True)
+        _queue_retention(pipe, tag, drop, trim)
+        pipe.execute()
+        logger.debug('Retention applied: tag=%s, buckets_dropped=%d, trimmed=%s', tag, len(drop), trim)
+        return len(drop)
+
+    def fetch_stats(self, index_key: str = HISTORY_INDEX_KEY) -> list[tuple[str, int]]:
+        """
+        Number of stored messages of every indexed chat, with one pipelined
+        HGETALL for all of them. Chats with nothing left are dropped from the
+        index.
+
+        Returns:
+            List of (key, messages) tuples
+        """
+        keys = self.redis_conn.zrange(index_key, 0, -1)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(_buckets_key(key.decode() if isinstance(key, bytes) else key))
+        lengths = [_total(raw) for raw in pipe.execute()] if keys else []
+        stats, stale = _split_stats(keys, lengths)
+        if stale:
+            self.redis_conn.zrem(index_key, *stale)
+        logger.debug('Stats fetched: %d keys found, %d stale', len(stats), len(stale))
         return stats
 
+    def scan_keys(self, pattern: str, count: int = SCAN_BATCH) -> Iterator[str]:
+        """Keys matching pattern, walked with SCAN so Redis is never blocked."""
+        for key in self.redis_conn.scan_iter(match=pattern, count=count):
+            yield key.decode() if isinstance(key, bytes) else key
+
+    def legacy_history_keys(self, pattern: str = HISTORY_KEYS_PATTERN) -> Iterator[str]:
+        """History lists in the old one-list-per-chat layout."""
+        keys = (key for key in self.scan_keys(pattern) if not _is_bucket_layout_key(key))
+        for batch in _batched(keys, SCAN_BATCH):
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for key in batch:
+                pipe.type(key)
+            yield from (key for key, key_type in zip(batch, pipe.execute()) if key_type == b'list')
+
+    def migrate_legacy_history(
+        self, key: str, max_age: float | None = None, max_messages: int | None = CUTOFF
+    ) -> int:
+        """
+        Move a chat history list of the old layout into hourly buckets. The
+        list is renamed to a claim key first, so when several processes
+        migrate at once only the one whose RENAME succeeded moves it.
+
+        Returns:
+            Number of messages moved
+        """
+        claim = _migration_claim_key(key)
+        try:
+            self.redis_conn.rename(key, claim)
+        except redis.ResponseError:
+            logger.info('Legacy history already claimed: key=%s', key)
+            return 0
+        messages = list(map(StoredChatMessage.deserialize, self.redis_conn.lrange(claim, 0, -1)))
+        if messages:
+            _ensure_token_counts(messages)
+            pipe = self.redis_conn.pipeline(transaction=True)
+            _queue_save(pipe, key, _by_bucket(messages), max_age)
+            pipe.delete(claim)
+            pipe.execute()
+            self.apply_retention(key, max_age, max_messages)
+        logger.info('Legacy history migrated: key=%s, messages=%d', key, len(messages))
+        return len(messages)
+
     def fetch_messages(
         self, key: str, limit: int, raw: bool = False
     ) -> list[StoredChatMessage] | list[bytes]:
+        """
+        Newest limit messages of the chat (all of them when limit < 0),
+        reading only the buckets that hold them.
+        """
         logger.debug('Fetching messages: key=%s, limit=%d, raw=%s', key, limit, raw)
-        messages = self.redis_conn.lrange(key, -limit, -1)
-        logger.debug('Fetched %d messages from key=%s', len(messages), key)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        guessed = _queue_fetch(pipe, key, limit)
+        raw_counts, *chunks = pipe.execute()
+        picked = _newest_buckets(_bucket_counts(raw_counts), limit)
+        read = dict(zip(guessed, chunks))
+        missing = [(start, count) for start, count in picked if start not in read]
+        if missing:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for start, count in missing:
+                pipe.lrange(_bucket_key(key, start), -count, -1)
+            read.update(zip((start for start, _ in missing), pipe.execute()))
+        messages = _picked_messages(picked, read)
+        logger.debug('Fetched %d messages from key=%s, buckets=%d', len(messages), key, len(picked))
         if raw:
             return messages
 
         return list(map(StoredChatMessage.deserialize, messages))
 
+    def fetch_messages_since(self, key: str, since: float) -> list[StoredChatMessage]:
+        """Messages of the chat sent at or after the since timestamp."""
+        counts = _bucket_counts(self.redis_conn.hgetall(_buckets_key(key)))
+        starts = [start for start, _ in counts if start + HISTORY_BUCKET_SECONDS > since]
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for start in starts:
+            pipe.lrange(_bucket_key(key, start), 0, -1)
+        raw = [m for chunk in pipe.execute() for m in chunk] if starts else []
+        messages = [m for m in map(StoredChatMessage.deserialize, raw) if m.timestamp >= since]
+        logger.debug('Fetched %d messages since %d from key=%s', len(messages), since, key)
+        return messages
+
     def fetch_conversation_history(
         self, key: str, limit: int, bot_username: str
     ) -> list[tuple[str, str]]:
@@ -113,13 +678,7 @@ class MessageStore:
         """
         logger.debug('Fetching conversation history: key=%s, limit=%d', key, limit)
         messages = self.fetch_messages(key=key, limit=limit, raw=False)
-        conversation = []
-
-        for msg in messages:
-            # Determine role based on username
-            role = 'assistant' if msg.from_username == bot_username else 'user'
-            conversation.append((role, msg.text))
-
+        conversation = _to_conversation(messages, bot_username)
         logger.debug('Conversation history fetched: %d messages', len(conversation))
         return conversation
 
@@ -133,11 +692,41 @@ class MessageStore:
         Returns:
             Number of messages deleted
         """
-        count = self.redis_conn.llen(key)
-        self.redis_conn.delete(key)
+        counts = _bucket_counts(self.redis_conn.hgetall(_buckets_key(key)))
+        pipe = self.redis_conn.pipeline(transaction=True)
+        _queue_clear(pipe, key, counts)
+        pipe.execute()
+        count = sum(count for _, count in counts)
         logger.info('Conversation history cleared: key=%s, messages_deleted=%d', key, count)
         return count
 
+    def history_keys(self, index_key: str = HISTORY_INDEX_KEY) -> list[str]:
+        return [key.decode() for key in self.redis_conn.zrange(index_key, 0, -1)]
+
+    def compact_history(self, key: str) -> int:
+        """
+        Rewrite entries of a chat still stored as JSON in the compact format.
+        Entries are replaced in place with LSET, so bucket TTLs and messages
+        appended meanwhile are kept.
+
+        Returns:
+            Number of entries rewritten
+        """
+        counts = _bucket_counts(self.redis_conn.hgetall(_buckets_key(key)))
+        rewritten = 0
+        for start, _ in counts:
+            bucket = _bucket_key(key, start)
+            entries = _json_entries(self.redis_conn.lrange(bucket, 0, -1))
+            if not entries:
+                continue
+            pipe = self.redis_conn.pipeline(transaction=True)
+            for index, entry in entries:
+                pipe.lset(bucket, index, entry)
+            pipe.execute()
+            rewritten += len(entries)
+        logger.info('History compacted: key=%s, entries=%d', key, rewritten)
+        return rewritten
+
     def build_context_messages(
         self,
         key: str,
@@ -163,54 +752,8 @@ class MessageStore:
             List of (role, text) tuples ready for LLM
         """
         logger.debug('Building context messages: key=%s, limit=%d, max_tokens=%d', key, limit, max_tokens)
-        # Start with system prompt
-        context = [system_prompt]
-
-        # Fetch conversation history
-        history = self.fetch_conversation_history(key, limit, bot_username)
-
-        if not history:
-            logger.debug('No conversation history found for key=%s', key)
-            return context
-
-        # Filter out messages with None or empty text
-        history = [(role, text) for role, text in history if text]
-
-        if not history:
-            logger.debug('No valid messages after filtering for key=%s', key)
-            return context
-
-        # Try to get appropriate encoding
-        try:
-            encoding = tiktoken.get_encoding(encoding_name)
-            def count_tokens(text: str) -> int:
-                return len(encoding.encode(text))
-            logger.debug('Using tiktoken encoding: %s', encoding_name)
-        except (KeyError, ValueError, LookupError) as e:
-            # If encoding fails, use character count approximation
-            # For Russian/Cyrillic text, use more conservative ratio
-            logger.warning('Failed to load tiktoken encoding %s: %s, using character approximation', encoding_name, e)
-            def count_tokens(text: str) -> int:
-                # Roughly 3 chars per token for mixed Latin/Cyrillic
-                return max(len(text) // 3, 1)
-
-        # Count system prompt tokens
-        system_tokens = count_tokens(system_prompt[1])
-        total_tokens = system_tokens
-
-        # Add history messages from most recent backwards, respecting token limit
-        included_history = []
-        for role, text in reversed(history):
-            msg_tokens = count_tokens(text)
-            if total_tokens + msg_tokens > max_tokens:
-                logger.debug('Token limit reached, stopping at %d messages included', len(included_history))
-                break
-            included_history.insert(0, (role, text))
-            total_tokens += msg_tokens
-
-        context.extend(included_history)
-        logger.debug('Context built: total_messages=%d, estimated_tokens=%d', len(context), total_tokens)
-        return context
+        messages = self.fetch_messages(key=key, limit=limit, raw=False)
+        return _select_context(messages, bot_username, system_prompt, max_tokens, encoding_name)
 
     def store_temp_image(
         self,
@@ -230,7 +773,7 @@ class MessageStore:
             image_bytes: PNG image bytes
             ttl_seconds: Time-to-live in seconds (default 5 minutes)
         """
-        key = f'matvey-3000:temp_image:{chat_id}:{user_id}:{image_key}'
+        key = _temp_image_key(chat_id, user_id, image_key)
         self.redis_conn.setex(key, ttl_seconds, image_bytes)
         logger.debug('Temp image stored: key=%s, size=%d, ttl=%d', key, len(image_bytes), ttl_seconds)
 
@@ -251,7 +794,7 @@ class MessageStore:
         Returns:
             Image bytes if found, None otherwise
         """
-        key = f'matvey-3000:temp_image:{chat_id}:{user_id}:{image_key}'
+        key = _temp_image_key(chat_id, user_id, image_key)
         data = self.redis_conn.get(key)
         if data:
             logger.debug('Temp image retrieved: key=%s, size=%d', key, len(data))
@@ -274,8 +817,8 @@ class MessageStore:
         Returns:
             Number of keys deleted
         """
-        pattern = f'matvey-3000:temp_image:{chat_id}:{user_id}:*'
-        keys = self.redis_conn.keys(pattern)
+        pattern = _temp_image_key(chat_id, user_id, '*')
+        keys = list(self.scan_keys(pattern))
         count = 0
         if keys:
             count = self.redis_conn.delete(*keys)
@@ -291,7 +834,7 @@ class MessageStore:
         text: str,
         ttl_seconds: int = 300,
     ) -> None:
-        key = f'matvey-3000:tts:{bot_username}:{chat_id}:{user_id}:{message_id}'
+        key = _tts_key(bot_username, chat_id, user_id, message_id)
         self.redis_conn.setex(key, ttl_seconds, text)
         logger.debug('TTS text stored: key=%s, text_len=%d, ttl=%d', key, len(text), ttl_seconds)
 
@@ -302,7 +845,7 @@ class MessageStore:
         user_id: int,
         message_id: int,
     ) -> str | None:
-        key = f'matvey-3000:tts:{bot_username}:{chat_id}:{user_id}:{message_id}'
+        key = _tts_key(bot_username, chat_id, user_id, message_id)
         data = self.redis_conn.get(key)
         if data:
             text = data.decode('utf-8') if isinstance(data, bytes) else data
@@ -310,3 +853,424 @@ class MessageStore:
             return text
         logger.debug('TTS text not found: key=%s', key)
         return None
+
+
+class AsyncMessageStore:
+    """
+    Same API as MessageStore, but built on redis.asyncio so handlers running
+    inside the aiogram event loop never block on a Redis round trip.
+    """
+
+    def __init__(self, redis_url: str, max_connections: int = DEFAULT_MAX_CONNECTIONS):
+        # Blocking pool: when all connections are busy callers wait for a free
+        # one instead of failing with "Too many connections"
+        self.pool = aioredis.BlockingConnectionPool.from_url(
+            redis_url, max_connections=max_connections
+        )
+        self.redis_conn = aioredis.Redis(connection_pool=self.pool)
+        logger.info(
+            'Async Redis message store initialized: url=%s, max_connections=%d',
+            _redacted_url(redis_url),
+            max_connections,
+        )
+
+    @classmethod
+    def from_env(cls) -> AsyncMessageStore:
+        url = os.getenv('REDIS_URL')
+        max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS))
+        logger.debug('Creating AsyncMessageStore from environment variable REDIS_URL')
+        return cls(url, max_connections=max_connections)
+
+    async def close(self) -> None:
+        await self.redis_conn.aclose()
+        await self.pool.disconnect()
+        logger.info('Async Redis message store closed')
+
+    async def save(
+        self,
+        tag: str,
+        message: StoredChatMessage,
+        max_age: float | None = None,
+        max_messages: int | None = CUTOFF,
+    ) -> int:
+        return await self.save_many(tag, [message], max_age=max_age, max_messages=max_messages)
+
+    async def save_many(
+        self,
+        tag: str,
+        messages: list[StoredChatMessage],
+        max_age: float | None = None,
+        max_messages: int | None = CUTOFF,
+    ) -> int:
+        if not messages:
+            return 0
+        await run_cpu(_ensure_token_counts, messages)
+        buckets = _by_bucket(messages)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        per_bucket = _queue_save(pipe, tag, buckets, max_age)
+        results = await pipe.execute()
+        if (max_age is not None or max_messages is not None) and _needs_retention(
+            buckets, results, per_bucket, max_messages
+        ):
+            await self.apply_retention(tag, max_age, max_messages)
+        return _log_saved(tag, messages, results[(len(buckets) - 1) * per_bucket])
+
+    async def apply_retention(self, tag: str, max_age: float | None, max_messages: int | None) -> int:
+        counts = _bucket_counts(await self.redis_conn.hgetall(_buckets_key(tag)), with_expired=True)
+        drop, trim = _retention_plan(counts, time.time(), max_age, max_messages)
+        if not drop and trim is None:
+            return 0
+        pipe = self.redis_conn.pipeline(transaction=True)
+        _queue_retention(pipe, tag, drop, trim)
+        await pipe.execute()
+        logger.debug('Retention applied: tag=%s, buckets_dropped=%d, trimmed=%s', tag, len(drop), trim)
+        return len(drop)
+
+    async def fetch_stats(self, index_key: str = HISTORY_INDEX_KEY) -> list[tuple[str, int]]:
+        keys = await self.redis_conn.zrange(index_key, 0, -1)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(_buckets_key(key.decode() if isinstance(key, bytes) else key))
+        lengths = [_total(raw) for raw in await pipe.execute()] if keys else []
+        stats, stale = _split_stats(keys, lengths)
+        if stale:
+            await self.redis_conn.zrem(index_key, *stale)
+        logger.debug('Stats fetched: %d keys found, %d stale', len(stats), len(stale))
+        return stats
+
+    async def scan_keys(self, pattern: str, count: int = SCAN_BATCH) -> AsyncIterator[str]:
+        async for key in self.redis_conn.scan_iter(match=pattern, count=count):
+            yield key.decode() if isinstance(key, bytes) else key
+
+    async def legacy_history_keys(self, pattern: str = HISTORY_KEYS_PATTERN) -> AsyncIterator[str]:
+        batch = []
+        async for key in self.scan_keys(pattern):
+            if _is_bucket_layout_key(key):
+                continue
+            batch.append(key)
+            if len(batch) >= SCAN_BATCH:
+                for list_key in await self._lists_only(batch):
+                    yield list_key
+                batch = []
+        for list_key in await self._lists_only(batch):
+            yield list_key
+
+    async def _lists_only(self, keys: list[str]) -> list[str]:
+        if not keys:
+            return []
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        return [key for key, key_type in zip(keys, await pipe.execute()) if key_type == b'list']
+
+    async def migrate_legacy_history(
+        self, key: str, max_age: float | None = None, max_messages: int | None = CUTOFF
+    ) -> int:
+        claim = _migration_claim_key(key)
+        try:
+            await self.redis_conn.rename(key, claim)
+        except redis.ResponseError:
+            logger.info('Legacy history already claimed: key=%s', key)
+            return 0
+        raw = await self.redis_conn.lrange(claim, 0, -1)
+        messages = list(map(StoredChatMessage.deserialize, raw))
+        if messages:
+            await run_cpu(_ensure_token_counts, messages)
+            pipe = self.redis_conn.pipeline(transaction=True)
+            _queue_save(pipe, key, _by_bucket(messages), max_age)
+            pipe.delete(claim)
+            await pipe.execute()
+            await self.apply_retention(key, max_age, max_messages)
+        logger.info('Legacy history migrated: key=%s, messages=%d', key, len(messages))
+        return len(messages)
+
+    async def fetch_messages(
+        self, key: str, limit: int, raw: bool = False
+    ) -> list[StoredChatMessage] | list[bytes]:
+        logger.debug('Fetching messages: key=%s, limit=%d, raw=%s', key, limit, raw)
+        pipe = self.redis_conn.pipeline(transaction=True)
+        guessed = _queue_fetch(pipe, key, limit)
+        raw_counts, *chunks = await pipe.execute()
+        picked = _newest_buckets(_bucket_counts(raw_counts), limit)
+        read = dict(zip(guessed, chunks))
+        missing = [(start, count) for start, count in picked if start not in read]
+        if missing:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for start, count in missing:
+                pipe.lrange(_bucket_key(key, start), -count, -1)
+            read.update(zip((start for start, _ in missing), await pipe.execute()))
+        messages = _picked_messages(picked, read)
+        logger.debug('Fetched %d messages from key=%s, buckets=%d', len(messages), key, len(picked))
+        if raw:
+            return messages
+
+        return list(map(StoredChatMessage.deserialize, messages))
+
+    async def fetch_messages_since(self, key: str, since: float) -> list[StoredChatMessage]:
+        counts = _bucket_counts(await self.redis_conn.hgetall(_buckets_key(key)))
+        starts = [start for start, _ in counts if start + HISTORY_BUCKET_SECONDS > since]
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for start in starts:
+            pipe.lrange(_bucket_key(key, start), 0, -1)
+        raw = [m for chunk in await pipe.execute() for m in chunk] if starts else []
+        messages = [m for m in map(StoredChatMessage.deserialize, raw) if m.timestamp >= since]
+        logger.debug('Fetched %d messages since %d from key=%s', len(messages), since, key)
+        return messages
+
+    async def fetch_conversation_history(
+        self, key: str, limit: int, bot_username: str
+    ) -> list[tuple[str, str]]:
+        logger.debug('Fetching conversation history: key=%s, limit=%d', key, limit)
+        messages = await self.fetch_messages(key=key, limit=limit, raw=False)
+        conversation = _to_conversation(messages, bot_username)
+        logger.debug('Conversation history fetched: %d messages', len(conversation))
+        return conversation
+
+    async def clear_conversation_history(self, key: str) -> int:
+        counts = _bucket_counts(await self.redis_conn.hgetall(_buckets_key(key)))
+        pipe = self.redis_conn.pipeline(transaction=True)
+        _queue_clear(pipe, key, counts)
+        await pipe.execute()
+        count = sum(count for _, count in counts)
+        logger.info('Conversation history cleared: key=%s, messages_deleted=%d', key, count)
+        return count
+
+    async def history_keys(self, index_key: str = HISTORY_INDEX_KEY) -> list[str]:
+        return [key.decode() for key in await self.redis_conn.zrange(index_key, 0, -1)]
+
+    async def compact_history(self, key: str) -> int:
+        counts = _bucket_counts(await self.redis_conn.hgetall(_buckets_key(key)))
+        rewritten = 0
+        for start, _ in counts:
+            bucket = _bucket_key(key, start)
+            entries = await run_cpu(_json_entries, await self.redis_conn.lrange(bucket, 0, -1))
+            if not entries:
+                continue
+            pipe = self.redis_conn.pipeline(transaction=True)
+            for index, entry in entries:
+                pipe.lset(bucket, index, entry)
+            await pipe.execute()
+            rewritten += len(entries)
+        logger.info('History compacted: key=%s, entries=%d', key, rewritten)
+        return rewritten
+
+    async def count_messages(self, key: str) -> int:
+        return _total(await self.redis_conn.hgetall(_buckets_key(key)))
+
+    async def iter_messages(
+        self, key: str, window: int = HISTORY_READ_WINDOW
+    ) -> AsyncIterator[list[StoredChatMessage]]:
+        """
+        Every message of the chat oldest first, window entries per LRANGE,
+        so reading a large history never holds more than one window.
+        """
+        for start, _ in _bucket_counts(await self.redis_conn.hgetall(_buckets_key(key))):
+            bucket = _bucket_key(key, start)
+            offset = 0
+            while True:
+                chunk = await self.redis_conn.lrange(bucket, offset, offset + window - 1)
+                if chunk:
+                    yield list(map(StoredChatMessage.deserialize, chunk))
+                if len(chunk) < window:
+                    break
+                offset += window
+
+    async def build_context_messages(
+        self,
+        key: str,
+        limit: int,
+        bot_username: str,
+        system_prompt: tuple[str, str],
+        max_tokens: int = 4000,
+        encoding_name: str = "cl100k_base",
+    ) -> list[tuple[str, str]]:
+        logger.debug('Building context messages: key=%s, limit=%d, max_tokens=%d', key, limit, max_tokens)
+        messages = await self.fetch_messages(key=key, limit=limit, raw=False)
+        return await run_cpu(
+            _select_context, messages, bot_username, system_prompt, max_tokens, encoding_name
+        )
+
+    async def store_temp_image(
+        self,
+        chat_id: int,
+        user_id: int,
+        image_key: str,
+        image_bytes: bytes,
+        ttl_seconds: int = 300,
+    ) -> None:
+        key = _temp_image_key(chat_id, user_id, image_key)
+        await self.redis_conn.setex(key, ttl_seconds, image_bytes)
+        logger.debug('Temp image stored: key=%s, size=%d, ttl=%d', key, len(image_bytes), ttl_seconds)
+
+    async def get_temp_image(
+        self,
+        chat_id: int,
+        user_id: int,
+        image_key: str,
+    ) -> bytes | None:
+        key = _temp_image_key(chat_id, user_id, image_key)
+        data = await self.redis_conn.get(key)
+        if data:
+            logger.debug('Temp image retrieved: key=%s, size=%d', key, len(data))
+        else:
+            logger.debug('Temp image not found: key=%s', key)
+        return data
+
+    async def clear_temp_images(
+        self,
+        chat_id: int,
+        user_id: int,
+    ) -> int:
+        pattern = _temp_image_key(chat_id, user_id, '*')
+        keys = [key async for key in self.scan_keys(pattern)]
+        count = 0
+        if keys:
+            count = await self.redis_conn.delete(*keys)
+            logger.debug('Temp images cleared: pattern=%s, count=%d', pattern, count)
+        return count
+
+    async def store_tts_text(
+        self,
+        bot_username: str,
+        chat_id: int,
+        user_id: int,
+        message_id: int,
+        text: str,
+        ttl_seconds: int = 300,
+    ) -> None:
+        key = _tts_key(bot_username, chat_id, user_id, message_id)
+        await self.redis_conn.setex(key, ttl_seconds, text)
+        logger.debug('TTS text stored: key=%s, text_len=%d, ttl=%d', key, len(text), ttl_seconds)
+
+    async def get_tts_text(
+        self,
+        bot_username: str,
+        chat_id: int,
+        user_id: int,
+        message_id: int,
+    ) -> str | None:
+        key = _tts_key(bot_username, chat_id, user_id, message_id)
+        data = await self.redis_conn.get(key)
+        if data:
+            text = data.decode('utf-8') if isinstance(data, bytes) else data
+            logger.debug('TTS text retrieved: key=%s, text_len=%d', key, len(text))
+            return text
+        logger.debug('TTS text not found: key=%s', key)
+        return None
+
+    async def get_cached_summaries(self, keys: list[str]) -> list[str | None]:
+        if not keys:
+            return []
+        values = await self.redis_conn.mget(keys)
+        return [v.decode('utf-8') if isinstance(v, bytes) else v for v in values]
+
+    async def store_cached_summaries(self, summaries: dict[str, str], ttl_seconds: int) -> None:
+        if not summaries:
+            return
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key, summary in summaries.items():
+            pipe.setex(key, ttl_seconds, summary)
+        await pipe.execute()
+        logger.debug('Cached %d summaries, ttl=%d', len(summaries), ttl_seconds)
+
+    async def get_cached_response(self, key: str, index_key: str) -> str | None:
+        # bump the entry in the index on every read, so eviction is least-recently-used
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.zadd(index_key, {key: time.time()}, xx=True)
+        value, _ = await pipe.execute()
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    async def store_cached_response(
+        self,
+        key: str,
+        value: str,
+        ttl_seconds: int,
+        index_key: str,
+        max_entries: int,
+    ) -> int:
+        """Cache a response and evict the least recently used ones above max_entries."""
+        now = time.time()
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.setex(key, ttl_seconds, value)
+        pipe.zadd(index_key, {key: now})
+        # entries whose keys already expired on their own
+        pipe.zremrangebyscore(index_key, '-inf', now - ttl_seconds)
+        pipe.expire(index_key, ttl_seconds)
+        pipe.zcard(index_key)
+        *_, size = await pipe.execute()
+
+        if size <= max_entries:
+            return 0
+        evicted = [k for k, _ in await self.redis_conn.zpopmin(index_key, size - max_entries)]
+        if evicted:
+            await self.redis_conn.delete(*evicted)
+        logger.debug('Evicted %d cached responses from %s', len(evicted), index_key)
+        return len(evicted)
+
+    async def get_cached_file(self, key: str) -> bytes | None:
+        return await self.redis_conn.get(key)
+
+    async def store_cached_file(self, key: str, data: bytes, ttl_seconds: int) -> None:
+        await self.redis_conn.setex(key, ttl_seconds, data)
+        logger.debug('Cached file stored: key=%s, size=%d, ttl=%d', key, len(data), ttl_seconds)
+
+    async def push_job(self, queue_key: str, payload: str) -> None:
+        await self.redis_conn.lpush(queue_key, payload)
+
+    async def claim_job(self, queue_key: str, processing_key: str, timeout: float) -> str | None:
+        """Move the oldest job to processing_key and return it, waiting up to timeout seconds."""
+        payload = await self.redis_conn.blmove(queue_key, processing_key, timeout, 'RIGHT', 'LEFT')
+        return payload.decode('utf-8') if isinstance(payload, bytes) else payload
+
+    async def finish_job(self, processing_key: str, payload: str) -> None:
+        await self.redis_conn.lrem(processing_key, 1, payload)
+
+    async def bury_job(self, processing_key: str, dead_key: str, payload: str) -> None:
+        """Move a job that can't be run from processing to the dead letter list."""
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.lrem(processing_key, 1, payload)
+        pipe.lpush(dead_key, payload)
+        pipe.ltrim(dead_key, 0, DEAD_JOBS_MAX - 1)
+        await pipe.execute()
+
+    async def schedule_job(self, delayed_key: str, payload: str, run_at: float) -> None:
+        await self.redis_conn.zadd(delayed_key, {payload: run_at})
+
+    async def promote_due_jobs(self, delayed_key: str, queue_key: str, now: float) -> int:
+        """Move delayed jobs that are due back onto the queue."""
+        async with self.redis_conn.pipeline(transaction=True) as pipe:
+            # the removal and the push go in one MULTI, and if another worker
+            # touched the set meanwhile it promotes them instead
+            await pipe.watch(delayed_key)
+            due = await pipe.zrangebyscore(delayed_key, '-inf', now)
+            if not due:
+                return 0
+            pipe.multi()
+            pipe.zrem(delayed_key, *due)
+            pipe.lpush(queue_key, *due)
+            try:
+                await pipe.execute()
+            except redis.WatchError:
+                return 0
+        return len(due)
+
+    async def heartbeat_worker(self, workers_key: str, worker_id: str, now: float) -> None:
+        await self.redis_conn.zadd(workers_key, {worker_id: now})
+
+    async def stale_workers(self, workers_key: str, before: float) -> list[str]:
+        """Workers whose last heartbeat is older than before."""
+        worker_ids = await self.redis_conn.zrangebyscore(workers_key, '-inf', before)
+        return [w.decode('utf-8') if isinstance(w, bytes) else w for w in worker_ids]
+
+    async def forget_worker(self, workers_key: str, worker_id: str) -> None:
+        await self.redis_conn.zrem(workers_key, worker_id)
+
+    async def requeue_jobs(self, processing_key: str, queue_key: str) -> int:
+        """Put jobs left in processing_key by a worker that stopped back onto the queue."""
+        requeued = 0
+        while await self.redis_conn.lmove(processing_key, queue_key, 'RIGHT', 'RIGHT') is not None:
+            requeued += 1
+        if requeued:
+            logger.warning('Requeued %d unfinished jobs from %s', requeued, processing_key)
+        return requeued
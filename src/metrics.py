@@ -1,4 +1,4 @@
-from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 METRICS_PORT = 8000
 
@@ -38,6 +38,91 @@ errors_total = Counter(
     ["error_type"],
 )
 
+cache_requests_total = Counter(
+    "bot_cache_requests_total",
+    "Cache lookups",
+    ["cache", "result"],
+)
+
+executor_queue_depth = Gauge(
+    "bot_executor_queue_depth",
+    "CPU-bound tasks waiting for a worker thread",
+)
+
+chat_queue_depth = Gauge(
+    "bot_chat_queue_depth",
+    "Requests waiting for a per-chat or global concurrency slot",
+)
+
+chat_queue_wait_seconds = Histogram(
+    "bot_chat_queue_wait_seconds",
+    "Time a request waited for a concurrency slot",
+    buckets=[0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60],
+)
+
+provider_requests_total = Counter(
+    "bot_provider_requests_total",
+    "LLM provider requests by outcome",
+    ["provider", "status"],
+)
+
+provider_latency = Histogram(
+    "bot_provider_latency_seconds",
+    "Latency of successful LLM provider requests",
+    ["provider"],
+    buckets=[0.5, 1, 2, 5, 10, 20, 30, 60],
+)
+
+provider_circuit_open = Gauge(
+    "bot_provider_circuit_open",
+    "1 while the provider circuit breaker is open",
+    ["provider"],
+)
+
+provider_failovers_total = Counter(
+    "bot_provider_failovers_total",
+    "Requests moved on to the next provider after a retryable error",
+)
+
+provider_hedges_total = Counter(
+    "bot_provider_hedges_total",
+    "Hedged requests fired because the first provider was slow",
+)
+
+quota_wait_seconds = Histogram(
+    "bot_quota_wait_seconds",
+    "Time a provider request waited for its client-side RPM/TPM quota",
+    ["quota"],
+    buckets=[0, 0.1, 0.5, 1, 2, 5, 10],
+)
+
+provider_attempts = Histogram(
+    "bot_provider_attempts",
+    "Attempts a provider call took, retries included",
+    ["operation"],
+    buckets=[1, 2, 3, 4, 5, 8],
+)
+
+jobs_total = Counter(
+    "bot_jobs_total",
+    "Background jobs by outcome: queued, success, retried, error",
+    ["kind", "status"],
+)
+
+job_duration = Histogram(
+    "bot_job_duration_seconds",
+    "Time a worker spent running a background job",
+    ["kind"],
+    buckets=[0.5, 1, 2, 5, 10, 20, 30, 60, 120],
+)
+
+job_wait_seconds = Histogram(
+    "bot_job_wait_seconds",
+    "Time a background job waited in the queue before a worker picked it up",
+    ["kind"],
+    buckets=[0.1, 0.5, 1, 2, 5, 10, 30, 60],
+)
+
 
 def start_metrics_server() -> None:
     start_http_server(METRICS_PORT)
@@ -0,0 +1,35 @@
+"""
+Rewrite saved chat history still stored as JSON in the compact message
+format. Safe to run while the bot is up and to run again: entries already in
+the compact format are left alone.
+
+    REDIS_URL=redis://localhost:6379/0 uv run python src/migrate_messages.py
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import executor
+from message_store import AsyncMessageStore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    message_store = AsyncMessageStore.from_env()
+    try:
+        keys = await message_store.history_keys()
+        logger.info("Compacting history of %d chats", len(keys))
+        total = 0
+        for key in keys:
+            total += await message_store.compact_history(key)
+        logger.info("Done, %d entries rewritten", total)
+    finally:
+        await message_store.close()
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
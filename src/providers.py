@@ -4,7 +4,8 @@ import json
 import logging
 import os
 import textwrap
-from dataclasses import dataclass
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import dataclass, replace
 from enum import Enum
 
 import anthropic
@@ -12,47 +13,188 @@ import httpx
 import openai
 import replicate
 
+from clients import ProviderClients
+from executor import run_cpu
+from kandinski import KandinskiApi, KandinskiError
+import metrics
+from quotas import QuotaExhausted, QuotaRegistry, estimate_tokens
+from retry import (
+    is_connect_error,
+    is_retryable_error,
+    is_retryable_status,
+    is_transient_error,
+    is_transient_response,
+    parse_retry_after,
+    with_retries,
+)
+from routing import ProviderRouter
 
 logger = logging.getLogger(__name__)
 
-openai_client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-anthro_client = anthropic.AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+clients = ProviderClients.from_env()
+router = ProviderRouter.from_env()
+kandinski = KandinskiApi.from_env()
+quotas = QuotaRegistry.from_env()
 yagpt_folder_id = os.getenv('YANDEXGPT_FOLDER_ID', default='NoYaFolder')
 yagpt_api_key = os.getenv('YANDEXGPT_API_KEY', default='NoYaKey')
-kandinski_api_key = os.getenv('KANDINSKI_API_KEY', default='KandiKeyOopsie')
-kandinski_api_secret = os.getenv('KANDINSKI_API_SECRET', default='KandiSecretOopsie')
+
+DESCRIBE_IMAGE_MODEL = 'gpt-4o'
+# OpenAI, Anthropic and Replicate clients take OPENAI_BASE_URL, ANTHROPIC_BASE_URL
+# and REPLICATE_BASE_URL from the environment themselves
+YANDEXGPT_BASE_URL = os.getenv('YANDEXGPT_BASE_URL', default='https://llm.api.cloud.yandex.net').rstrip('/')
+YANDEXGPT_COMPLETION_URL = f'{YANDEXGPT_BASE_URL}/foundationModels/v1/completion'
+# back-off after a 429 that didn't say how long to wait
+DEFAULT_RETRY_AFTER_SECONDS = 1.0
+
+
+class ProviderError(Exception):
+    """Provider answered with something we can't use (non-200 status etc)."""
+
+    def __init__(self, message: str, retryable: bool = False, retry_after: float | None = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def _retry_after(response: httpx.Response | None) -> float:
+    """Seconds from the Retry-After header of a 429, or a default when absent."""
+    retry_after = parse_retry_after(response)
+    return DEFAULT_RETRY_AFTER_SECONDS if retry_after is None else retry_after
+
+
+def _yandexgpt_retry_after(response: httpx.Response) -> float | None:
+    return _retry_after(response) if response.status_code == 429 else None
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('utf-8')
+
+
+def _anthropic_prompt(messages):
+    user_tag = anthropic.HUMAN_PROMPT
+    bot_tag = anthropic.AI_PROMPT
+    system = [text for role, text in messages if role == 'system'][0]
+
+    # claude 2.1 might need different format for prompting since it has system prompts
+    # full_prompt = f'{system} {user_tag}{human}{bot_tag}'
+
+    # claude instant 1.2 though... Needs a different thing
+    prompt = textwrap.dedent(
+        """
+            Here are a few back and forth messages between user and a bot.
+            User messages are in tag <user>, bot messages are in tag <bot>
+        """.strip()
+    )
+    prompt = [f'{user_tag}{prompt}']
+    for role, text in messages:
+        if role == 'system':
+            continue
+        prompt.append(f'\n<{role}>{text}</{role}>')
+    prompt.append(f'\n{system}')
+    prompt.append(
+        '\nTake content of last unpaired "user" and use this as completion prompt.'
+    )
+    prompt.append(f'\nRespond ONLY with text and no tags.{bot_tag}')
+    return ''.join(prompt)
+
+
+def _yandexgpt_request(model, messages, stream=False):
+    params = {
+        'messages': [{'role': role, 'text': text} for role, text in messages],
+        'modelUri': f'gpt://{yagpt_folder_id}/{model}',
+        'completionOptions': {
+            'stream': stream,
+            'temperature': 0.6,
+            'maxTokens': "1000",
+        },
+    }
+    headers = {
+        'Authorization': f'Api-Key {yagpt_api_key}',
+        'x-folder-id': yagpt_folder_id,
+    }
+    return params, headers
 
 
 @dataclass(frozen=True)
 class TextResponse:
     success: bool
     text: str
+    # rate limits, timeouts and provider outages, worth trying another provider
+    retryable: bool = False
+    # set when the provider rate limited us, how long it asked us to back off
+    retry_after: float | None = None
+    # prompt and completion tokens billed, when the provider reports them
+    tokens_used: int | None = None
+    # our own quota for the provider ran dry, the provider wasn't asked at all
+    throttled: bool = False
+    # who answered, which after a failover isn't the chat's configured provider
+    provider: str | None = None
+    model: str | None = None
 
     @classmethod
     async def generate(cls, config, chat_id, messages):
-        provider = config.provider_for_chat_id(chat_id)
-        model = config.model_for_chat_id(chat_id)
-        logger.debug('Generating text response: provider=%s, model=%s, message_count=%d',
-                     provider, model, len(messages))
+        chain = config.provider_chain_for_chat_id(chat_id)
+        hedge = config[chat_id].hedge_requests
+        logger.debug('Generating text response: providers=%s, hedge=%s, message_count=%d',
+                     chain, hedge, len(messages))
+        return await router.run(
+            chain,
+            lambda provider: cls._generate_with(config, provider, messages),
+            hedge=hedge,
+        )
+
+    @classmethod
+    async def _generate_with(cls, config, provider, messages):
+        model = config.model_for_provider(provider)
+        reply = await cls._generate_within_quota(config, provider, model, messages)
+        return replace(reply, provider=provider, model=model)
+
+    @classmethod
+    async def _generate_within_quota(cls, config, provider, model, messages):
+        quota = quotas.get(provider, model, config.rate_limit_for(provider, model))
+        if quota is None:
+            return await cls._generate_from(config, provider, model, messages)
+
+        estimated = await run_cpu(estimate_tokens, messages)
+        try:
+            await quota.acquire(estimated)
+        except QuotaExhausted as e:
+            logger.warning('%s', e)
+            return cls(
+                success=False,
+                text=f'Кажется я подустал и воткнулся в рейт-лимит. Давай сделаем перерыв ненадолго.\n\n{e}',  # noqa
+                retryable=True,
+                throttled=True,
+            )
+        reply = None
+        try:
+            reply = await cls._generate_from(config, provider, model, messages)
+        finally:
+            # a call that raised or lost a hedge still settles, the estimate
+            # stands since the provider may have billed it
+            quota.settle(estimated, reply.tokens_used if reply else None, reply.retry_after if reply else None)
+        return reply
+
+    @classmethod
+    async def _generate_from(cls, config, provider, model, messages):
         if provider == config.PROVIDER_OPENAI:
             return await cls._generate_openai(
-                openai_client,
+                clients.openai,
                 model,
                 messages,
             )
         elif provider == config.PROVIDER_ANTHROPIC:
             return await cls._generate_anthropic(
-                anthro_client,
+                clients.anthropic,
                 model,
                 messages,
             )
         elif provider == config.PROVIDER_YANDEXGPT:
-            async with httpx.AsyncClient() as httpx_client:
-                return await cls._generate_yandexgpt(
-                    httpx_client,
-                    model,
-                    messages,
-                )
+            return await cls._generate_yandexgpt(
+                clients.http,
+                model,
+                messages,
+            )
         else:
             logger.error('Unsupported provider: %s', provider)
             return cls(success=False, text=f'Unsupported provider: {provider}')
@@ -62,15 +204,17 @@ class TextResponse:
         logger.debug('OpenAI request: model=%s, message_count=%d', model, len(messages))
         payload = [{'role': role, 'content': text} for role, text in messages]
         try:
-            response = await client.chat.completions.create(
+            response = await with_retries('openai.chat', lambda: client.chat.completions.create(
                 model=model,
                 messages=payload,
-            )
+            ), retry_error=is_transient_error)
         except openai.RateLimitError as e:
             logger.warning('OpenAI rate limit error: %s', e)
             return cls(
                 success=False,
                 text=f'Кажется я подустал и воткнулся в рейт-лимит. Давай сделаем перерыв ненадолго.\n\n{e}',  # noqa
+                retryable=True,
+                retry_after=_retry_after(e.response),
             )
         except openai.BadRequestError as e:
             logger.warning('OpenAI bad request error: %s', e)
@@ -78,11 +222,12 @@ class TextResponse:
                 success=False,
                 text=f'Beep-bop, кажется я не умею отвечать на такие вопросы:\n\n{e}',  # noqa
             )
-        except TimeoutError as e:
+        except (TimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
             logger.error('OpenAI timeout error: %s', e)
             return cls(
                 success=False,
                 text=f'Кажется у меня сбоит сеть. Ты попробуй позже, а я пока схожу чаю выпью.\n\n{e}',  # noqa
+                retryable=True,
             )
         else:
             logger.debug('OpenAI response received: model=%s, response_length=%d',
@@ -90,60 +235,40 @@ class TextResponse:
             return cls(
                 success=True,
                 text=response.choices[0].message.content,
+                tokens_used=response.usage.total_tokens if response.usage else None,
             )
 
     @classmethod
     async def _generate_anthropic(cls, client, model, messages):
         logger.debug('Anthropic request: model=%s, message_count=%d', model, len(messages))
-        user_tag = anthropic.HUMAN_PROMPT
-        bot_tag = anthropic.AI_PROMPT
-        system = [text for role, text in messages if role == 'system'][0]
-
-        # claude 2.1 might need different format for prompting since it has system prompts
-        # full_prompt = f'{system} {user_tag}{human}{bot_tag}'
-
-        # claude instant 1.2 though... Needs a different thing
-        prompt = textwrap.dedent(
-            """
-                Here are a few back and forth messages between user and a bot.
-                User messages are in tag <user>, bot messages are in tag <bot>
-            """.strip()
-        )
-        prompt = [f'{user_tag}{prompt}']
-        for role, text in messages:
-            if role == 'system':
-                continue
-            prompt.append(f'\n<{role}>{text}</{role}>')
-        prompt.append(f'\n{system}')
-        prompt.append(
-            '\nTake content of last unpaired "user" and use this as completion prompt.'
-        )
-        prompt.append(f'\nRespond ONLY with text and no tags.{bot_tag}')
-        prompt = ''.join(prompt)
+        prompt = _anthropic_prompt(messages)
 
         try:
-            response = await client.completions.create(
+            response = await with_retries('anthropic.completion', lambda: client.completions.create(
                 model=model,
                 max_tokens_to_sample=1024,  # no clue about this value
                 prompt=prompt,
-            )
-        except openai.RateLimitError as e:
+            ), retry_error=is_transient_error)
+        except anthropic.RateLimitError as e:
             logger.warning('Anthropic rate limit error: %s', e)
             return cls(
                 success=False,
                 text=f'Кажется я подустал и воткнулся в рейт-лимит. Давай сделаем перерыв ненадолго.\n\n{e}',  # noqa
+                retryable=True,
+                retry_after=_retry_after(e.response),
             )
-        except openai.BadRequestError as e:
+        except anthropic.BadRequestError as e:
             logger.warning('Anthropic bad request error: %s', e)
             return cls(
                 success=False,
                 text=f'Beep-bop, кажется я не умею отвечать на такие вопросы:\n\n{e}',  # noqa
             )
-        except TimeoutError as e:
+        except (TimeoutError, anthropic.APIConnectionError, anthropic.InternalServerError) as e:
             logger.error('Anthropic timeout error: %s', e)
             return cls(
                 success=False,
                 text=f'Кажется у меня сбоит сеть. Ты попробуй позже, а я пока схожу чаю выпью.\n\n{e}',  # noqa
+                retryable=True,
             )
         else:
             completion = response.completion.replace("<", "[").replace(">", "]")
@@ -157,31 +282,29 @@ class TextResponse:
     @classmethod
     async def _generate_yandexgpt(cls, client, model, messages):
         logger.debug('YandexGPT request: model=%s, message_count=%d', model, len(messages))
-        params = {
-            'messages': [{'role': role, 'text': text} for role, text in messages],
-            'modelUri': f'gpt://{yagpt_folder_id}/{model}',
-            'completionOptions': {
-                'stream': False,
-                'temperature': 0.6,
-                'maxTokens': "1000",
-            },
-        }
-        headers = {
-            'Authorization': f'Api-Key {yagpt_api_key}',
-            'x-folder-id': yagpt_folder_id,
-        }
-        response = await client.post(
-            'https://llm.api.cloud.yandex.net/foundationModels/v1/completion',
-            json=params,
-            headers=headers,
-        )
+        params, headers = _yandexgpt_request(model, messages)
+        try:
+            response = await with_retries('yandexgpt.completion', lambda: client.post(
+                YANDEXGPT_COMPLETION_URL,
+                json=params,
+                headers=headers,
+            ), retry_result=is_transient_response)
+        except (TimeoutError, httpx.TransportError) as e:
+            logger.error('YandexGPT timeout error: %s', e)
+            return cls(
+                success=False,
+                text=f'Кажется у меня сбоит сеть. Ты попробуй позже, а я пока схожу чаю выпью.\n\n{e}',  # noqa
+                retryable=True,
+            )
         if response.status_code == 200:
             data = response.json()
             text = data['result']['alternatives'][0]['message']['text']
+            usage = data['result'].get('usage', {})
             logger.debug('YandexGPT response received: model=%s, response_length=%d', model, len(text))
             return cls(
                 success=True,
                 text=text,
+                tokens_used=int(usage['totalTokens']) if 'totalTokens' in usage else None,
             )
         else:
             logger.error('YandexGPT request failed: status_code=%d, response=%s',
@@ -189,8 +312,187 @@ class TextResponse:
             return cls(
                 success=False,
                 text=response.text,
+                retryable=is_retryable_status(response.status_code),
+                retry_after=_yandexgpt_retry_after(response),
             )
 
+    @classmethod
+    async def generate_streaming(
+        cls,
+        config,
+        chat_id,
+        messages,
+        on_text: Callable[[str], Awaitable[None]],
+    ):
+        """
+        Same as generate, but streams the completion and calls on_text with
+        the text accumulated so far after every received delta. Fails over
+        along the provider chain only while nothing has been shown yet,
+        hedging doesn't apply since the reply is already on screen.
+        """
+        chain = config.provider_chain_for_chat_id(chat_id)
+        logger.debug('Streaming text response: providers=%s, message_count=%d', chain, len(messages))
+        reply = None
+        for provider in chain:
+            if not router.breaker(provider).allow():
+                logger.debug('Skipping provider %s, circuit is open', provider)
+                continue
+            if reply is not None:
+                logger.info('Failing over to %s', provider)
+                metrics.provider_failovers_total.inc()
+            reply, streamed = await cls._stream_with(config, provider, messages, on_text)
+            if reply.success or not reply.retryable or streamed:
+                return reply
+        if reply is None:
+            logger.warning('All provider circuits are open, trying %s anyway', chain[0])
+            reply, _ = await cls._stream_with(config, chain[0], messages, on_text)
+        return reply
+
+    @classmethod
+    async def _stream_with(cls, config, provider, messages, on_text) -> tuple['TextResponse', bool]:
+        """Stream from one provider, return the reply and whether any text was shown."""
+        model = config.model_for_provider(provider)
+        quota = quotas.get(provider, model, config.rate_limit_for(provider, model))
+        if quota is not None:
+            estimated = await run_cpu(estimate_tokens, messages)
+            try:
+                await quota.acquire(estimated)
+            except QuotaExhausted as e:
+                logger.warning('%s', e)
+                return cls(
+                    success=False,
+                    text=f'Кажется я подустал и воткнулся в рейт-лимит. Давай сделаем перерыв ненадолго.\n\n{e}',  # noqa
+                    retryable=True,
+                    throttled=True,
+                ), False
+
+        parts = []
+        shown = False
+        reply = None
+        try:
+            if provider == config.PROVIDER_OPENAI:
+                deltas = cls._stream_openai(clients.openai, model, messages)
+            elif provider == config.PROVIDER_ANTHROPIC:
+                deltas = cls._stream_anthropic(clients.anthropic, model, messages)
+            elif provider == config.PROVIDER_YANDEXGPT:
+                deltas = cls._stream_yandexgpt(clients.http, model, messages)
+            else:
+                logger.error('Unsupported provider: %s', provider)
+                return cls(success=False, text=f'Unsupported provider: {provider}'), False
+            async for delta in deltas:
+                parts.append(delta)
+                if on_text is None:
+                    continue
+                try:
+                    await on_text(''.join(parts))
+                    shown = True
+                except Exception as e:
+                    # not the provider's fault: keep the stream going, the caller
+                    # gets the whole reply at the end
+                    logger.warning('Failed to show streamed text, not updating it any more: %s', e)
+                    on_text = None
+        except (openai.RateLimitError, anthropic.RateLimitError) as e:
+            logger.warning('%s rate limit error while streaming: %s', provider, e)
+            reply = cls(
+                success=False,
+                text=f'Кажется я подустал и воткнулся в рейт-лимит. Давай сделаем перерыв ненадолго.\n\n{e}',  # noqa
+                retryable=True,
+                retry_after=_retry_after(e.response),
+            )
+        except (openai.BadRequestError, anthropic.BadRequestError) as e:
+            logger.warning('%s bad request error while streaming: %s', provider, e)
+            reply = cls(
+                success=False,
+                text=f'Beep-bop, кажется я не умею отвечать на такие вопросы:\n\n{e}',  # noqa
+            )
+        except (
+            TimeoutError,
+            httpx.TransportError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+            anthropic.APIConnectionError,
+            anthropic.InternalServerError,
+        ) as e:
+            logger.error('%s timeout error while streaming: %s', provider, e)
+            reply = cls(
+                success=False,
+                text=f'Кажется у меня сбоит сеть. Ты попробуй позже, а я пока схожу чаю выпью.\n\n{e}',  # noqa
+                retryable=True,
+            )
+        except ProviderError as e:
+            reply = cls(success=False, text=str(e), retryable=e.retryable, retry_after=e.retry_after)
+        except Exception:
+            router.record(provider, ok=False)
+            raise
+        else:
+            text = ''.join(parts)
+            logger.debug('Streamed response received: provider=%s, model=%s, response_length=%d',
+                         provider, model, len(text))
+            reply = cls(success=True, text=text)
+        finally:
+            if quota is not None:
+                # streams don't report usage: the estimate stands once text came
+                # back and is given back if nothing did
+                quota.settle(estimated, None if parts else 0, reply.retry_after if reply else None)
+
+        # time to the end of a stream isn't comparable to a plain request,
+        # so streams don't feed the hedging latencies
+        router.record(provider, ok=reply.success or not reply.retryable)
+        return replace(reply, provider=provider, model=model), shown
+
+    @classmethod
+    async def _stream_openai(cls, client, model, messages) -> AsyncIterator[str]:
+        payload = [{'role': role, 'content': text} for role, text in messages]
+        stream = await with_retries('openai.chat', lambda: client.chat.completions.create(
+            model=model,
+            messages=payload,
+            stream=True,
+        ), retry_error=is_transient_error)
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    @classmethod
+    async def _stream_anthropic(cls, client, model, messages) -> AsyncIterator[str]:
+        stream = await with_retries('anthropic.completion', lambda: client.completions.create(
+            model=model,
+            max_tokens_to_sample=1024,
+            prompt=_anthropic_prompt(messages),
+            stream=True,
+        ), retry_error=is_transient_error)
+        async for event in stream:
+            if event.completion:
+                yield event.completion.replace("<", "[").replace(">", "]")
+
+    @classmethod
+    async def _stream_yandexgpt(cls, client, model, messages) -> AsyncIterator[str]:
+        params, headers = _yandexgpt_request(model, messages, stream=True)
+        async with client.stream(
+            'POST',
+            YANDEXGPT_COMPLETION_URL,
+            json=params,
+            headers=headers,
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode(errors='replace')
+                logger.error('YandexGPT stream failed: status_code=%d, response=%s',
+                             response.status_code, body[:200])
+                raise ProviderError(
+                    body,
+                    retryable=is_retryable_status(response.status_code),
+                    retry_after=_yandexgpt_retry_after(response),
+                )
+            # every line carries the whole alternative generated so far
+            seen = 0
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                text = data['result']['alternatives'][0]['message']['text']
+                if len(text) > seen:
+                    yield text[seen:]
+                    seen = len(text)
+
 
 async def speedup_audio(audio_bytes: bytes, factor: float = 2.0) -> bytes:
     proc = await asyncio.create_subprocess_exec(
@@ -230,23 +532,23 @@ class AudioResponse:
         if speedup and speedup > 1.0:
             audio_bytes = await speedup_audio(audio_bytes, speedup)
 
-        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = clients.openai
 
         try:
-            response = await client.audio.transcriptions.create(
+            response = await with_retries('openai.transcription', lambda: client.audio.transcriptions.create(
                 model='whisper-1',
                 file=(filename, audio_bytes),
-            )
+            ))
             text = response.text
             logger.info('Audio transcription successful: length=%d chars', len(text))
             return cls(success=True, data=text)
         except openai.BadRequestError as e:
             logger.warning('Audio transcription BadRequestError: %s', e)
             return cls(success=False, data=f'Не удалось распознать аудио: {e}')
-        except openai.RateLimitError as e:
-            logger.warning('Audio transcription RateLimitError: %s', e)
-            return cls(success=False, data=f'Рейт-лимит превышен: {e}')
         except Exception as e:
+            if is_retryable_error(e):
+                # rate limits and outages are left to the job queue's retries
+                raise
             logger.error('Audio transcription error: %s', e, exc_info=True)
             return cls(success=False, data=f'Ошибка транскрипции: {e}')
 
@@ -264,15 +566,15 @@ class AudioResponse:
             logger.warning('TTS text too long: %d chars', len(text))
             return cls(success=False, data='Текст слишком длинный (макс. 4096 символов)')
 
-        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = clients.openai
 
         try:
-            response = await client.audio.speech.create(
+            response = await with_retries('openai.speech', lambda: client.audio.speech.create(
                 model=model,
                 voice=voice,
                 input=text,
                 response_format='opus',
-            )
+            ))
             audio_bytes = response.content
             logger.info('TTS successful: size=%d bytes', len(audio_bytes))
             return cls(success=True, data=audio_bytes)
@@ -297,15 +599,15 @@ class ImageResponse:
     async def edit(cls, image_bytes: bytes, prompt: str):
         logger.info('Image edit requested: prompt_length=%d, image_size=%d bytes',
                     len(prompt or ''), len(image_bytes))
-        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = clients.openai
         try:
-            response = await client.images.edit(
+            response = await with_retries('openai.images', lambda: client.images.edit(
                 model="dall-e-2",
                 image=("image.png", image_bytes, "image/png"),
                 prompt=prompt,
                 n=1,
                 size="512x512",
-            )
+            ), retry_error=is_connect_error)
             logger.info('Image edit successful')
             return cls(success=True, b64_or_url=response.data[0].url)
         except openai.BadRequestError as e:
@@ -340,16 +642,16 @@ class ImageResponse:
             'Image edit with mask requested: prompt_length=%d, image_size=%d, mask_size=%d',
             len(prompt or ''), len(image_bytes), len(mask_bytes)
         )
-        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = clients.openai
         try:
-            response = await client.images.edit(
+            response = await with_retries('openai.images', lambda: client.images.edit(
                 model='dall-e-2',
                 image=('image.png', image_bytes, 'image/png'),
                 mask=('mask.png', mask_bytes, 'image/png'),
                 prompt=prompt,
                 n=1,
                 size='512x512',
-            )
+            ), retry_error=is_connect_error)
             logger.info('Image edit with mask successful')
             return cls(success=True, b64_or_url=response.data[0].url)
         except openai.BadRequestError as e:
@@ -363,28 +665,34 @@ class ImageResponse:
             return cls(success=False, b64_or_url=f'Таймаут сети, попробуй позже: {e}')
 
     @classmethod
-    async def describe_image(cls, image_bytes: bytes) -> TextResponse:
+    async def describe_image(cls, image_bytes: bytes, cache=None) -> TextResponse:
         """
         Use GPT-4o Vision to describe an image.
 
         Args:
             image_bytes: Image as bytes (any common format)
+            cache: Optional ResponseCache, the same image is only described once
 
         Returns:
             TextResponse with detailed description or error message
         """
-        import base64
+        if cache is not None:
+            return await cache.get_or_generate(
+                'image_description',
+                ('openai', DESCRIBE_IMAGE_MODEL, image_bytes),
+                lambda: cls.describe_image(image_bytes),
+            )
 
         logger.info('Image description requested: image_size=%d', len(image_bytes))
 
-        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = clients.openai
 
         # Encode image to base64
-        b64_image = base64.b64encode(image_bytes).decode('utf-8')
+        b64_image = await run_cpu(_b64encode, image_bytes)
 
         try:
-            response = await client.chat.completions.create(
-                model='gpt-4o',
+            response = await with_retries('openai.chat', lambda: client.chat.completions.create(
+                model=DESCRIBE_IMAGE_MODEL,
                 messages=[
                     {
                         'role': 'system',
@@ -413,7 +721,7 @@ class ImageResponse:
                     }
                 ],
                 max_tokens=1000,
-            )
+            ))
             description = response.choices[0].message.content
             logger.info('Image description successful: length=%d', len(description))
             return TextResponse(success=True, text=description)
@@ -432,6 +740,7 @@ class ImageResponse:
         cls,
         image_bytes: bytes,
         modification_prompt: str,
+        cache=None,
     ):
         """
         Reimagine an image using Vision + DALL-E 3.
@@ -444,6 +753,7 @@ class ImageResponse:
         Args:
             image_bytes: Original image bytes
             modification_prompt: User's requested changes
+            cache: Optional ResponseCache for the image description
 
         Returns:
             ImageResponse with URL to new image
@@ -452,17 +762,17 @@ class ImageResponse:
                     len(image_bytes), len(modification_prompt))
 
         # Step 1: Describe the image
-        description_response = await cls.describe_image(image_bytes)
+        description_response = await cls.describe_image(image_bytes, cache=cache)
         if not description_response.success:
             return cls(success=False, b64_or_url=description_response.text)
 
         original_description = description_response.text
 
         # Step 2: Create modified prompt using GPT
-        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = clients.openai
 
         try:
-            prompt_response = await client.chat.completions.create(
+            prompt_response = await with_retries('openai.chat', lambda: client.chat.completions.create(
                 model='gpt-4o-mini',
                 messages=[
                     {
@@ -485,7 +795,7 @@ class ImageResponse:
                     }
                 ],
                 max_tokens=500,
-            )
+            ))
             modified_prompt = prompt_response.choices[0].message.content
             logger.debug('Modified prompt created: %s', modified_prompt[:100])
         except Exception as e:
@@ -500,15 +810,13 @@ class ImageResponse:
     @classmethod
     async def generate(cls, prompt, mode='dall-e'):
         logger.info('Image generation requested: mode=%s, prompt_length=%d', mode, len(prompt or ''))
-        openai_client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
         match mode:
             case 'dall-e':
-                return await cls._generate_dalle(openai_client, prompt, model='dall-e-2', size='512x512')
+                return await cls._generate_dalle(clients.openai, prompt, model='dall-e-2', size='512x512')
             case 'dall-e-3':
-                return await cls._generate_dalle(openai_client, prompt, model='dall-e-3', size='1024x1024')
+                return await cls._generate_dalle(clients.openai, prompt, model='dall-e-3', size='1024x1024')
             case 'kandinski':
-                async with httpx.AsyncClient() as httpx_client:
-                    return await cls._generate_kandinski(httpx_client, prompt)
+                return await cls._generate_kandinski(clients.http, prompt)
             case _:
                 logger.error('Unsupported image generation mode: %s', mode)
                 return cls(success=False, b64_or_url=f'Unsupported provider: {mode}')
@@ -516,75 +824,28 @@ class ImageResponse:
     @classmethod
     async def _generate_dalle(cls, client, prompt, model='dall-e-2', size='512x512'):
         logger.debug('DALL-E request: model=%s, size=%s, prompt=%r', model, size, prompt)
-        img_gen_reply = await client.images.generate(
+        img_gen_reply = await with_retries('openai.images', lambda: client.images.generate(
             model=model,
             prompt=prompt,
             n=1,
             size=size,
-        )
+        ), retry_error=is_connect_error)
         logger.info('DALL-E image generated successfully: model=%s', model)
         return cls(success=True, b64_or_url=img_gen_reply.data[0].url)
 
     @classmethod
     async def _generate_kandinski(cls, client, prompt):
-        logger.debug('Kandinski request: prompt=%r', prompt)
-        BASE_URL = 'https://api-key.fusionbrain.ai/key/api/v1'
-        headers = {
-            'X-Key': f'Key {kandinski_api_key}',
-            'x-Secret': f'Secret {kandinski_api_secret}',
-        }
-        # pick model
-        response = await client.get(
-            f'{BASE_URL}/models',
-            headers=headers,
-        )
-        # 2024jan09: only one model supported at the moment anyway
-        model_id = response.json()[0]['id']
-        logger.debug('Kandinski model selected: model_id=%s', model_id)
-        params = {
-            'type': 'GENERATE',
-            'width': 512,
-            'height': 512,
-            'num_images': 1,
-            'generateParams': {
-                'query': prompt,
-            },
-        }
-        data = {
-            'model_id': (None, str(model_id)),
-            'params': (None, json.dumps(params), 'application/json'),
-        }
-        response = await client.post(
-            f'{BASE_URL}/text2image/run',
-            headers=headers,
-            files=data,
-        )
-        run_id = response.json()['uuid']
-        logger.debug('Kandinski generation started: run_id=%s', run_id)
-
-        attempts = 10
-        delay = 10
-        while attempts > 0:
-            response = await client.get(
-                f'{BASE_URL}/text2image/status/{run_id}', headers=headers
-            )
-            data = response.json()
-            done = data['status'] == 'DONE'
-            if done:
-                break
-            logger.debug('Kandinski generation in progress: run_id=%s, attempts_remaining=%d', run_id, attempts)
-            attempts -= 1
-            await asyncio.sleep(delay)
-
-        if done:
-            logger.info('Kandinski image generated: run_id=%s, censored=%s', run_id, data['censored'])
-        else:
-            logger.warning('Kandinski generation timed out: run_id=%s', run_id)
-
+        try:
+            result = await kandinski.generate(client, prompt)
+        except KandinskiError as e:
+            logger.warning('Kandinski generation failed: %s', e)
+            return cls(success=False, b64_or_url=f'Кандинский не смог: {e}')
+        if not result.done:
+            return cls(success=False, b64_or_url='Кандинский так и не дорисовал, попробуй ещё раз')
         return cls(
-            success=done,
-            b64_or_url=data['images'][0],
-            censored=data['censored'],
+            success=True,
+            b64_or_url=result.image_b64,
+            censored=result.censored,
         )
 
 
@@ -601,8 +862,8 @@ class ReplicateEdit:
         return Config
 
     @classmethod
-    def _image_to_data_uri(cls, image_bytes: bytes) -> str:
-        b64 = base64.b64encode(image_bytes).decode('utf-8')
+    async def _image_to_data_uri(cls, image_bytes: bytes) -> str:
+        b64 = await run_cpu(_b64encode, image_bytes)
         return f'data:image/png;base64,{b64}'
 
     @classmethod
@@ -610,20 +871,24 @@ class ReplicateEdit:
         """Edit image using InstructPix2Pix - natural language instructions."""
         logger.info('Replicate edit: instruction=%r, image_size=%d', instruction[:50], len(image_bytes))
         try:
-            output = await replicate.async_run(
+            image = await cls._image_to_data_uri(image_bytes)
+            output = await with_retries('replicate', lambda: replicate.async_run(
                 cls._get_config().REPLICATE_MODEL_EDIT,
                 input={
-                    'image': cls._image_to_data_uri(image_bytes),
+                    'image': image,
                     'prompt': instruction,
                     'num_inference_steps': 50,
                     'image_cfg_scale': 1.5,
                     'guidance_scale': 7.5,
                 },
-            )
+            ))
             image_url = output[0] if isinstance(output, list) else str(output)
             logger.info('Replicate edit successful: url=%s', image_url[:80])
             return cls(success=True, image_url=image_url)
         except Exception as e:
+            if is_retryable_error(e):
+                # left to the job queue's retries
+                raise
             logger.error('Replicate edit error: %s', e, exc_info=True)
             return cls(success=False, image_url=None, error=str(e))
 
@@ -632,14 +897,18 @@ class ReplicateEdit:
         """Remove background from image."""
         logger.info('Replicate remove_bg: image_size=%d', len(image_bytes))
         try:
-            output = await replicate.async_run(
+            image = await cls._image_to_data_uri(image_bytes)
+            output = await with_retries('replicate', lambda: replicate.async_run(
                 cls._get_config().REPLICATE_MODEL_REMOVE_BG,
-                input={'image': cls._image_to_data_uri(image_bytes)},
-            )
+                input={'image': image},
+            ))
             image_url = str(output)
             logger.info('Replicate remove_bg successful: url=%s', image_url[:80])
             return cls(success=True, image_url=image_url)
         except Exception as e:
+            if is_retryable_error(e):
+                # left to the job queue's retries
+                raise
             logger.error('Replicate remove_bg error: %s', e, exc_info=True)
             return cls(success=False, image_url=None, error=str(e))
 
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable
+
+import metrics
+from message_store import count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+# how long a request may wait for its provider quota before it is failed
+# (and moved on to a fallback provider) instead
+QUOTA_MAX_WAIT_SECONDS = 10.0
+# we don't cap completion length, so assume a typical reply until usage comes back
+COMPLETION_TOKENS_ESTIMATE = 500
+# per-message overhead of the chat format
+MESSAGE_TOKENS_OVERHEAD = 4
+
+
+class QuotaExhausted(Exception):
+    """Waiting for the quota would take longer than the request is allowed to wait."""
+
+
+def estimate_tokens(messages: list[tuple[str, str]]) -> int:
+    """Prompt tokens of messages plus a guess at the completion."""
+    prompt = sum(count_tokens(text) + MESSAGE_TOKENS_OVERHEAD for _, text in messages)
+    return prompt + COMPLETION_TOKENS_ESTIMATE
+
+
+class TokenBucket:
+    """
+    Refills per_minute units evenly over a minute, up to per_minute. Takes
+    are reservations: the level may go below zero, and later callers wait for
+    the debt to be repaid first, so waiters are served in arrival order.
+    """
+
+    def __init__(self, per_minute: int, clock: Callable[[], float] = time.monotonic):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.clock = clock
+        self.level = float(per_minute)
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_for(self, amount: int) -> float:
+        """Seconds until amount can be taken."""
+        self._refill()
+        # a request bigger than the whole bucket would otherwise wait forever
+        deficit = min(amount, self.capacity) - self.level
+        return max(0.0, deficit / self.rate)
+
+    def take(self, amount: int) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def give(self, amount: int) -> None:
+        """Return (or, with a negative amount, take) units after the fact."""
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def drain(self, seconds: float) -> None:
+        """Empty the bucket and hold off refilling for the given time."""
+        self._refill()
+        self.level = min(self.level, 0.0) - seconds * self.rate
+
+
+class ProviderQuota:
+    """Requests-per-minute and tokens-per-minute buckets of one provider model."""
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: int | None = None,
+        tokens_per_minute: int | None = None,
+        max_wait: float = QUOTA_MAX_WAIT_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self.sleep = sleep
+        self.requests = TokenBucket(requests_per_minute, clock) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, clock) if tokens_per_minute else None
+
+    def _wanted(self, tokens: int) -> list[tuple[TokenBucket, int]]:
+        wanted = []
+        if self.requests is not None:
+            wanted.append((self.requests, 1))
+        if self.tokens is not None:
+            wanted.append((self.tokens, tokens))
+        return wanted
+
+    async def acquire(self, tokens: int) -> None:
+        """Reserve one request and tokens, waiting for the buckets if needed."""
+        wanted = self._wanted(tokens)
+        wait = max((bucket.wait_for(amount) for bucket, amount in wanted), default=0.0)
+        if wait > self.max_wait:
+            metrics.errors_total.labels(error_type='quota_exhausted').inc()
+            raise QuotaExhausted(f'{self.name} quota exhausted, next slot in {wait:.0f}s')
+
+        for bucket, amount in wanted:
+            bucket.take(amount)
+        metrics.quota_wait_seconds.labels(quota=self.name).observe(wait)
+        if wait <= 0:
+            return
+
+        logger.debug('Waiting %.1fs for %s quota', wait, self.name)
+        try:
+            await self.sleep(wait)
+        except asyncio.CancelledError:
+            for bucket, amount in wanted:
+                bucket.give(amount)
+            raise
+
+    def settle(self, estimated: int, tokens_used: int | None, retry_after: float | None) -> None:
+        """Correct the token reservation with real usage, and back off after a 429."""
+        if self.tokens is not None and tokens_used is not None:
+            self.tokens.give(estimated - tokens_used)
+        if retry_after is not None:
+            logger.warning('%s rate limited by the provider, holding off for %.1fs', self.name, retry_after)
+            for bucket, _ in self._wanted(0):
+                bucket.drain(retry_after)
+
+
+class QuotaRegistry:
+    """ProviderQuota per provider and model, created on first use from the configured limits."""
+
+    def __init__(self, max_wait: float = QUOTA_MAX_WAIT_SECONDS):
+        self.max_wait = max_wait
+        self._quotas: dict[tuple[str, str], ProviderQuota] = {}
+
+    @classmethod
+    def from_env(cls) -> QuotaRegistry:
+        return cls(max_wait=float(os.getenv('QUOTA_MAX_WAIT_SECONDS', QUOTA_MAX_WAIT_SECONDS)))
+
+    def get(self, provider: str, model: str, limit) -> ProviderQuota | None:
+        """Quota for provider and model, None when limit (a config RateLimit) is None."""
+        if limit is None:
+            return None
+        quota = self._quotas.get((provider, model))
+        if quota is None:
+            quota = self._quotas[(provider, model)] = ProviderQuota(
+                f'{provider}/{model}',
+                requests_per_minute=limit.requests_per_minute,
+                tokens_per_minute=limit.tokens_per_minute,
+                max_wait=self.max_wait,
+            )
+            logger.info(
+                'Quota for %s/%s: rpm=%s, tpm=%s',
+                provider, model, limit.requests_per_minute, limit.tokens_per_minute,
+            )
+        return quota
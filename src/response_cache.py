@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from collections.abc import Awaitable, Callable
+
+import metrics
+from providers import TextResponse
+
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600
+RESPONSE_CACHE_MAX_ENTRIES = 10_000
+# longer replies are rare for these commands and not worth the memory
+RESPONSE_CACHE_MAX_VALUE_BYTES = 64 * 1024
+
+
+def messages_parts(provider: str, model: str, messages: list[tuple[str, str]]) -> tuple[str, ...]:
+    return (provider, model, *(f'{role}\0{text}' for role, text in messages))
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of deterministic LLM replies (translations,
+    image descriptions) in Redis. Keys are a hash of everything that
+    determines the reply, so identical requests skip the provider entirely.
+    The cache is bounded both by TTL and by the number of entries, the least
+    recently used ones are evicted first.
+    """
+
+    def __init__(
+        self,
+        store,
+        namespace: str,
+        ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_value_bytes: int = RESPONSE_CACHE_MAX_VALUE_BYTES,
+    ):
+        self.store = store
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_value_bytes = max_value_bytes
+
+    @classmethod
+    def from_env(cls, store, namespace: str) -> ResponseCache:
+        return cls(
+            store,
+            namespace,
+            ttl_seconds=int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', RESPONSE_CACHE_TTL_SECONDS)),
+            max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', RESPONSE_CACHE_MAX_ENTRIES)),
+        )
+
+    @property
+    def index_key(self) -> str:
+        return f'matvey-3000:response-index:{self.namespace}'
+
+    def key(self, kind: str, *parts: str | bytes) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else part.encode())
+            digest.update(b'\0')
+        return f'matvey-3000:response:{self.namespace}:{kind}:{digest.hexdigest()}'
+
+    async def get_or_generate(
+        self,
+        kind: str,
+        parts: tuple[str | bytes, ...],
+        generate: Callable[[], Awaitable[TextResponse]],
+        parts_for_reply: Callable[[TextResponse], tuple[str | bytes, ...]] | None = None,
+    ) -> TextResponse:
+        """
+        Return the cached reply for parts, or generate and cache a successful
+        one. parts_for_reply gives the parts of whoever actually produced the
+        reply (e.g. a fallback provider), the reply is cached under those.
+        """
+        key = self.key(kind, *parts)
+        try:
+            cached = await self.store.get_cached_response(key, self.index_key)
+        except Exception as e:
+            # the cache is an optimisation, a Redis hiccup shouldn't fail the command
+            logger.warning('Response cache lookup failed: %s', e)
+            cached = None
+
+        if cached is not None:
+            metrics.cache_requests_total.labels(cache=kind, result='hit').inc()
+            logger.debug('Response cache hit: %s', key)
+            return TextResponse(success=True, text=cached)
+
+        metrics.cache_requests_total.labels(cache=kind, result='miss').inc()
+        reply = await generate()
+        if reply.success and len(reply.text.encode()) <= self.max_value_bytes:
+            if parts_for_reply is not None:
+                key = self.key(kind, *parts_for_reply(reply))
+            try:
+                await self.store.store_cached_response(
+                    key,
+                    reply.text,
+                    ttl_seconds=self.ttl_seconds,
+                    index_key=self.index_key,
+                    max_entries=self.max_entries,
+                )
+            except Exception as e:
+                logger.warning('Response cache store failed: %s', e)
+        return reply
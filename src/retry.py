@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+import anthropic
+import httpx
+import openai
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 8.0
+RETRY_DEADLINE_SECONDS = 30.0
+
+T = TypeVar('T')
+
+
+def is_retryable_status(status_code: int) -> bool:
+    return status_code in (408, 429) or status_code >= 500
+
+
+def is_retryable_response(response: httpx.Response) -> bool:
+    return is_retryable_status(response.status_code)
+
+
+def _status_code(e: BaseException) -> int | None:
+    if isinstance(e, (openai.APIStatusError, anthropic.APIStatusError)):
+        return e.status_code
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    # replicate.exceptions.ReplicateError carries the HTTP status as .status
+    status = getattr(e, 'status', None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable_error(e: BaseException) -> bool:
+    """Transient failures worth another attempt: network trouble, rate limits, 5xx."""
+    if isinstance(e, (TimeoutError, httpx.TransportError, openai.APIConnectionError, anthropic.APIConnectionError)):
+        return True
+    status = _status_code(e)
+    if status is not None:
+        return is_retryable_status(status)
+    return getattr(e, 'retryable', False)
+
+
+def is_transient_response(response: httpx.Response) -> bool:
+    """
+    is_retryable_response short of 429: calls behind a quota and the provider
+    router leave rate limits to those rather than sit them out in place.
+    """
+    return response.status_code != 429 and is_retryable_status(response.status_code)
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """is_retryable_error short of rate limits, see is_transient_response."""
+    return _status_code(e) != 429 and is_retryable_error(e)
+
+
+def is_connect_error(e: BaseException) -> bool:
+    """
+    The connection failed before the request went out, so retrying can't
+    pay twice for a request that is billed however it ends (e.g. an image).
+    """
+    return isinstance(e, httpx.ConnectError) or (
+        isinstance(e, openai.APIConnectionError) and isinstance(e.__cause__, httpx.ConnectError)
+    )
+
+
+def parse_retry_after(response: httpx.Response | None) -> float | None:
+    """Seconds from a Retry-After header, None when there is none."""
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Capped exponential backoff with full jitter under an overall deadline.
+    A Retry-After from the provider replaces the computed delay, and one
+    longer than max_delay ends the retries right away.
+    """
+
+    max_attempts: int = RETRY_MAX_ATTEMPTS
+    base_delay: float = RETRY_BASE_DELAY_SECONDS
+    max_delay: float = RETRY_MAX_DELAY_SECONDS
+    deadline: float = RETRY_DEADLINE_SECONDS
+    clock: Callable[[], float] = field(default=time.monotonic, repr=False, compare=False)
+    sleep: Callable[[float], Awaitable[None]] = field(default=asyncio.sleep, repr=False, compare=False)
+
+    @classmethod
+    def from_env(cls) -> RetryPolicy:
+        return cls(
+            max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', RETRY_MAX_ATTEMPTS)),
+            base_delay=float(os.getenv('RETRY_BASE_DELAY_SECONDS', RETRY_BASE_DELAY_SECONDS)),
+            max_delay=float(os.getenv('RETRY_MAX_DELAY_SECONDS', RETRY_MAX_DELAY_SECONDS)),
+            deadline=float(os.getenv('RETRY_DEADLINE_SECONDS', RETRY_DEADLINE_SECONDS)),
+        )
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float | None:
+        """Delay after the given failed attempt, None when it's not worth waiting."""
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(
+        self,
+        operation: str,
+        call: Callable[[], Awaitable[T]],
+        retry_result: Callable[[T], bool] | None = None,
+        retry_error: Callable[[BaseException], bool] = is_retryable_error,
+    ) -> T:
+        """
+        Await call() until it succeeds, raises something retry_error doesn't
+        flag, or attempts or time run out. retry_result flags results that
+        should be retried too (e.g. a 5xx httpx.Response); the last one is
+        returned as is when retries are exhausted.
+        """
+        give_up_at = self.clock() + self.deadline
+        attempt = 1
+        while True:
+            try:
+                result = await call()
+            except Exception as e:
+                if not retry_error(e):
+                    raise
+                delay = self._next_delay(attempt, parse_retry_after(getattr(e, 'response', None)), give_up_at)
+                if delay is None:
+                    metrics.provider_attempts.labels(operation=operation).observe(attempt)
+                    raise
+                logger.warning('%s attempt %d failed: %r, retrying in %.1fs', operation, attempt, e, delay)
+            else:
+                if retry_result is None or not retry_result(result):
+                    metrics.provider_attempts.labels(operation=operation).observe(attempt)
+                    return result
+                delay = self._next_delay(attempt, parse_retry_after(result), give_up_at)
+                if delay is None:
+                    metrics.provider_attempts.labels(operation=operation).observe(attempt)
+                    return result
+                logger.warning('%s attempt %d failed, retrying in %.1fs', operation, attempt, delay)
+
+            await self.sleep(delay)
+            attempt += 1
+
+    def _next_delay(self, attempt: int, retry_after: float | None, give_up_at: float) -> float | None:
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt, retry_after)
+        if delay is None or self.clock() + delay > give_up_at:
+            return None
+        return delay
+
+
+default_policy = RetryPolicy.from_env()
+
+
+async def with_retries(
+    operation: str,
+    call: Callable[[], Awaitable[T]],
+    retry_result: Callable[[T], bool] | None = None,
+    retry_error: Callable[[BaseException], bool] = is_retryable_error,
+) -> T:
+    """Run call under the default retry policy."""
+    return await default_policy.run(operation, call, retry_result, retry_error)
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Protocol
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_WINDOW_SECONDS = 60.0
+CIRCUIT_MIN_REQUESTS = 5
+CIRCUIT_FAILURE_RATIO = 0.5
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+
+LATENCY_SAMPLES = 100
+LATENCY_MIN_SAMPLES = 20
+# used as the hedge delay until a provider has enough latency samples
+HEDGE_DEFAULT_DELAY_SECONDS = 8.0
+
+
+class Reply(Protocol):
+    success: bool
+    text: str
+    retryable: bool
+    throttled: bool
+
+
+class CircuitBreaker:
+    """
+    Tracks outcomes of recent requests to one provider. Once at least
+    min_requests landed in the window and failure_ratio of them failed, the
+    circuit opens and the provider is skipped. After cooldown_seconds one
+    probe request is let through, a success closes the circuit again and a
+    failure keeps it open for another cooldown.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float = CIRCUIT_WINDOW_SECONDS,
+        min_requests: int = CIRCUIT_MIN_REQUESTS,
+        failure_ratio: float = CIRCUIT_FAILURE_RATIO,
+        cooldown_seconds: float = CIRCUIT_COOLDOWN_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.cooldown_seconds = cooldown_seconds
+        self.clock = clock
+        self._events: deque[tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = self.clock()
+        if now - self._opened_at < self.cooldown_seconds:
+            return False
+        # let one probe through, the next one waits for another cooldown
+        self._opened_at = now
+        return True
+
+    def record(self, ok: bool) -> None:
+        now = self.clock()
+        if self._opened_at is not None:
+            if ok:
+                self._close()
+            else:
+                self._opened_at = now
+            return
+
+        self._events.append((now, ok))
+        self._failures += not ok
+        while self._events and now - self._events[0][0] > self.window_seconds:
+            _, old_ok = self._events.popleft()
+            self._failures -= not old_ok
+        if len(self._events) >= self.min_requests and self._failures >= self.failure_ratio * len(self._events):
+            self._opened_at = now
+
+    def _close(self) -> None:
+        self._opened_at = None
+        self._events.clear()
+        self._failures = 0
+
+
+class LatencyTracker:
+    """Keeps the latest successful response times and answers percentile queries."""
+
+    def __init__(self, samples: int = LATENCY_SAMPLES, min_samples: int = LATENCY_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=samples)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> float | None:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, math.ceil(p * len(ordered)) - 1)]
+
+
+class ProviderRouter:
+    """
+    Sends a request along an ordered chain of providers. Providers with an
+    open circuit are skipped, a rate limit or timeout from one provider moves
+    the request on to the next, and with hedging enabled the next provider is
+    also fired when the current one hasn't answered within its p95 latency.
+    Whichever answers successfully first wins, the rest are cancelled.
+    """
+
+    def __init__(
+        self,
+        breaker_factory: Callable[[], CircuitBreaker] = CircuitBreaker,
+        hedge_default_delay: float = HEDGE_DEFAULT_DELAY_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.breaker_factory = breaker_factory
+        self.hedge_default_delay = hedge_default_delay
+        self.clock = clock
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._latencies: dict[str, LatencyTracker] = {}
+
+    @classmethod
+    def from_env(cls) -> ProviderRouter:
+        window = float(os.getenv('CIRCUIT_WINDOW_SECONDS', CIRCUIT_WINDOW_SECONDS))
+        min_requests = int(os.getenv('CIRCUIT_MIN_REQUESTS', CIRCUIT_MIN_REQUESTS))
+        failure_ratio = float(os.getenv('CIRCUIT_FAILURE_RATIO', CIRCUIT_FAILURE_RATIO))
+        cooldown = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', CIRCUIT_COOLDOWN_SECONDS))
+        return cls(
+            breaker_factory=lambda: CircuitBreaker(
+                window_seconds=window,
+                min_requests=min_requests,
+                failure_ratio=failure_ratio,
+                cooldown_seconds=cooldown,
+            ),
+            hedge_default_delay=float(os.getenv('HEDGE_DEFAULT_DELAY_SECONDS', HEDGE_DEFAULT_DELAY_SECONDS)),
+        )
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = self.breaker_factory()
+        return breaker
+
+    def latency(self, provider: str) -> LatencyTracker:
+        tracker = self._latencies.get(provider)
+        if tracker is None:
+            tracker = self._latencies[provider] = LatencyTracker()
+        return tracker
+
+    def hedge_delay(self, provider: str) -> float:
+        p95 = self.latency(provider).percentile(0.95)
+        return self.hedge_default_delay if p95 is None else p95
+
+    def record(self, provider: str, ok: bool, latency: float | None = None) -> None:
+        """Record the outcome of a request to provider; latency only for successful ones."""
+        breaker = self.breaker(provider)
+        was_open = breaker.is_open
+        breaker.record(ok)
+        if breaker.is_open != was_open:
+            state = 'opened' if breaker.is_open else 'closed'
+            logger.warning('Circuit %s for provider %s', state, provider)
+            metrics.provider_circuit_open.labels(provider=provider).set(int(breaker.is_open))
+        if latency is not None:
+            self.latency(provider).observe(latency)
+            metrics.provider_latency.labels(provider=provider).observe(latency)
+        metrics.provider_requests_total.labels(provider=provider, status='success' if ok else 'error').inc()
+
+    async def run(
+        self,
+        chain: list[str],
+        call: Callable[[str], Awaitable[Reply]],
+        hedge: bool = False,
+    ) -> Reply:
+        chain = list(dict.fromkeys(chain))
+        queue = deque(chain)
+        pending: dict[asyncio.Task, str] = {}
+
+        def launch() -> str | None:
+            while queue:
+                provider = queue.popleft()
+                if self.breaker(provider).allow():
+                    pending[asyncio.create_task(self._call(provider, call))] = provider
+                    return provider
+                logger.debug('Skipping provider %s, circuit is open', provider)
+            return None
+
+        def hedge_deadline(provider: str) -> float | None:
+            return self.clock() + self.hedge_delay(provider) if hedge else None
+
+        provider = launch()
+        if provider is None:
+            # everything is down, trying the preferred one beats failing outright
+            provider = chain[0]
+            logger.warning('All provider circuits are open, trying %s anyway', provider)
+            pending[asyncio.create_task(self._call(provider, call))] = provider
+
+        hedge_at = hedge_deadline(provider)
+        last_reply = None
+        last_error = None
+        try:
+            while pending:
+                timeout = None
+                if hedge_at is not None and queue:
+                    timeout = max(0.0, hedge_at - self.clock())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # hedge once, after that just wait for whoever answers first
+                    hedge_at = None
+                    hedged = launch()
+                    if hedged is not None:
+                        logger.info('Hedging request to %s, %s is slow to answer', hedged, provider)
+                        metrics.provider_hedges_total.inc()
+                    continue
+
+                for task in done:
+                    failed = pending.pop(task)
+                    try:
+                        reply = task.result()
+                    except Exception as e:
+                        logger.warning('Provider %s failed: %r', failed, e)
+                        last_error = e
+                        continue
+                    if reply.success or not reply.retryable:
+                        return reply
+                    logger.warning('Provider %s failed with a retryable error: %s', failed, reply.text[:100])
+                    last_reply = reply
+
+                if not pending:
+                    provider = launch()
+                    if provider is not None:
+                        logger.info('Failing over to %s', provider)
+                        metrics.provider_failovers_total.inc()
+                        if hedge_at is not None:
+                            hedge_at = hedge_deadline(provider)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if last_reply is None:
+            raise last_error
+        return last_reply
+
+    async def _call(self, provider: str, call: Callable[[str], Awaitable[Reply]]) -> Reply:
+        started_at = self.clock()
+        try:
+            reply = await call(provider)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.record(provider, ok=False)
+            raise
+        if reply.throttled:
+            # held back by our own quota, says nothing about the provider
+            return reply
+        if reply.success:
+            self.record(provider, ok=True, latency=self.clock() - started_at)
+        else:
+            # a bad request is the request's fault, not the provider's
+            self.record(provider, ok=not reply.retryable)
+        return reply
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from aiogram import types
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly one edit per second per chat (and ~20/min in groups),
+# so partial replies are coalesced: an edit goes out only when both enough
+# time has passed and enough new text has arrived since the previous one.
+EDIT_INTERVAL_SECONDS = 1.5
+EDIT_MIN_CHARS = 40
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ProgressiveReply:
+    """
+    Reply with the first streamed text as soon as it arrives and keep editing
+    the reply as more text comes in, at a rate Telegram is happy with.
+    """
+
+    def __init__(
+        self,
+        message: types.Message,
+        edit_interval: float = EDIT_INTERVAL_SECONDS,
+        min_chars: int = EDIT_MIN_CHARS,
+        clock=time.monotonic,
+        sleep=asyncio.sleep,
+    ):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.min_chars = min_chars
+        self.clock = clock
+        self.sleep = sleep
+        self.sent: types.Message | None = None
+        self.shown_text = ''
+        self.next_edit_at = 0.0
+        self.edits = 0
+
+    async def update(self, text: str) -> None:
+        if self.sent is None:
+            await self._send(text[:MAX_MESSAGE_LENGTH])
+            return
+        if self.clock() < self.next_edit_at:
+            return
+        if len(text) - len(self.shown_text) < self.min_chars:
+            return
+        await self._edit(text[:MAX_MESSAGE_LENGTH])
+
+    async def finish(self, text: str, success: bool) -> None:
+        if self.sent is None:
+            # nothing was streamed (error before the first token or a very fast reply)
+            func = self.message.reply if success else self.message.answer
+            await func(text)
+            return
+        head, tail = text[:MAX_MESSAGE_LENGTH], text[MAX_MESSAGE_LENGTH:]
+        if head != self.shown_text:
+            await self._final_edit(head)
+        while tail:
+            head, tail = tail[:MAX_MESSAGE_LENGTH], tail[MAX_MESSAGE_LENGTH:]
+            await self.message.answer(head)
+        logger.debug('Progressive reply finished: chat_id=%s, edits=%d, length=%d',
+                     self.message.chat.id, self.edits, len(text))
+
+    async def _final_edit(self, text: str) -> None:
+        """
+        The final text must reach the chat: a throttled edit is tried once
+        more after the wait Telegram asks for, and whatever else goes wrong
+        sends the text as a new message instead.
+        """
+        for attempt in range(2):
+            try:
+                try:
+                    await self.sent.edit_text(text)
+                except TelegramBadRequest as e:
+                    # partial markup that Telegram can't parse as HTML
+                    logger.warning('Final edit failed, retrying as plain text: %s', e)
+                    await self.sent.edit_text(text, parse_mode=None)
+                return
+            except TelegramRetryAfter as e:
+                if attempt:
+                    logger.warning('Final edit throttled again: %s', e)
+                    break
+                logger.info('Final edit throttled by Telegram, retrying in %ss', e.retry_after)
+                await self.sleep(e.retry_after)
+            except TelegramAPIError as e:
+                logger.warning('Final edit failed: %s', e)
+                break
+        await self.message.answer(text)
+
+    async def _send(self, text: str) -> None:
+        try:
+            self.sent = await self.message.reply(text)
+        except TelegramBadRequest as e:
+            # partial markup that Telegram can't parse as HTML
+            logger.debug('First reply sent as plain text: %s', e)
+            self.sent = await self.message.reply(text, parse_mode=None)
+        self.shown_text = text
+        self.next_edit_at = self.clock() + self.edit_interval
+
+    async def _edit(self, text: str) -> None:
+        try:
+            await self.sent.edit_text(text)
+        except TelegramRetryAfter as e:
+            logger.debug('Edit throttled by Telegram, retry after %ss', e.retry_after)
+            self.next_edit_at = self.clock() + e.retry_after
+            return
+        except TelegramAPIError as e:
+            # unclosed HTML tags in a partial reply, "message is not modified", etc.
+            logger.debug('Intermediate edit skipped: %s', e)
+        else:
+            self.edits += 1
+            self.shown_text = text
+        self.next_edit_at = self.clock() + self.edit_interval
@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+import metrics
+from executor import run_cpu
+from message_store import StoredChatMessage
+from providers import TextResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_PROMPT = """
+You are a helpful assistant who recaps everything that happened in this chat relying on its log.
+You use Russian language only, and try to do each recap in no more than 25 sentences, but don't use generalisations too often.
+The text is written by other chat members. You retell the most interesting phrases and actions, starting with the name of the actor.
+You never lose a chronology of replies and never repeat yourself, while trying to balance out amount of participants' input.
+You seldom mention texts produced by chatbots, such as you.
+Sometimes you try to be funny by mixing up events and phrases, but never overdo it.
+""".strip()
+
+FINAL_PROMPT = """
+You are a helpful assistant who recaps everything that happened in this chat relying on its log.
+You use Russian language only, and try to do each recap in no more than 25 sentences, but don't use generalisations too often.
+The text is written by other chat members. You retell the most interesting phrases and actions, starting with the name of the actor.
+You never lose a chronology of replies and never repeat yourself, while trying to balance out amount of participants' input.
+You seldom mention texts produced by chatbots, such as you.
+Sometimes you try to be funny by mixing up events and phrases, but never overdo it.
+After you recap everything, highlight three most outstanding facts or points from the text in a separate paragraph, while not repeating your own words.
+""".strip()
+
+MAX_CHUNK_TOKENS = 16385
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+# How many chunk summaries may be in flight against a provider at once,
+# shared by all /sum commands running in the process
+PROVIDER_CONCURRENCY = {
+    'openai': 4,
+    'anthropic': 4,
+    'yandexgpt': 2,
+}
+DEFAULT_CONCURRENCY = 2
+
+# Level-0 chunks never cross window borders, so the chunks of a window that
+# is already over keep their content (and cached summary) on every /sum
+SUMMARY_WINDOW_SECONDS = 6 * 3600
+SUMMARY_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+_provider_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def provider_semaphore(provider: str) -> asyncio.Semaphore:
+    semaphore = _provider_semaphores.get(provider)
+    if semaphore is None:
+        limit = PROVIDER_CONCURRENCY.get(provider, DEFAULT_CONCURRENCY)
+        semaphore = _provider_semaphores[provider] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+def chunk_texts(
+    texts: list[str],
+    count_tokens: Callable[[str], int],
+    max_tokens: int,
+    overlap_tokens: int = 0,
+) -> list[str]:
+    """
+    Greedily pack texts into newline-joined chunks below max_tokens.
+
+    Every text is tokenised exactly once and chunk sizes are kept as running
+    sums, so chunking is linear in the input. With overlap_tokens > 0 a chunk
+    starts with the tail of the previous one (whole texts, up to that many
+    tokens) to keep some context across chunk borders. A single text larger
+    than max_tokens becomes a chunk of its own.
+    """
+    # +1 for the newline joining texts inside a chunk
+    sizes = [count_tokens(text) + 1 for text in texts]
+    chunks = []
+    current: list[int] = []  # indexes into texts
+    current_tokens = 0
+    fresh = 0  # texts in current chunk that aren't overlap from the previous one
+
+    for i, size in enumerate(sizes):
+        if fresh and current_tokens + size >= max_tokens:
+            chunks.append('\n'.join(texts[j] for j in current).strip())
+            overlap, overlap_size = [], 0
+            for j in reversed(current):
+                if overlap_size + sizes[j] > overlap_tokens or overlap_size + sizes[j] + size >= max_tokens:
+                    break
+                overlap.append(j)
+                overlap_size += sizes[j]
+            current = overlap[::-1]
+            current_tokens = overlap_size
+            fresh = 0
+        current.append(i)
+        current_tokens += size
+        fresh += 1
+
+    if fresh:
+        chunks.append('\n'.join(texts[j] for j in current).strip())
+    return chunks
+
+
+def split_into_windows(
+    messages: list[StoredChatMessage],
+    window_seconds: int = SUMMARY_WINDOW_SECONDS,
+) -> list[list[str]]:
+    """
+    Group chronologically ordered messages into time windows of window_seconds
+    (SUMMARY_WINDOW_SECONDS, six hours, by default) aligned to the epoch.
+    """
+    return [
+        [str(msg) for msg in group]
+        for _, group in itertools.groupby(messages, key=lambda msg: msg.timestamp // window_seconds)
+    ]
+
+
+class SummaryCache:
+    """
+    Content-addressed chunk summaries in Redis: a chunk that was summarised
+    before with the same prompt is never sent to the LLM again.
+    """
+
+    def __init__(self, store, namespace: str, ttl_seconds: int = SUMMARY_CACHE_TTL_SECONDS):
+        self.store = store
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+
+    def key(self, prompt: str, chunk: str) -> str:
+        digest = hashlib.sha256(f'{prompt}\0{chunk}'.encode()).hexdigest()
+        return f'matvey-3000:summary:{self.namespace}:{digest}'
+
+    async def get_many(self, prompt: str, chunks: list[str]) -> list[str | None]:
+        cached = await self.store.get_cached_summaries([self.key(prompt, chunk) for chunk in chunks])
+        hits = sum(summary is not None for summary in cached)
+        metrics.cache_requests_total.labels(cache='summary', result='hit').inc(hits)
+        metrics.cache_requests_total.labels(cache='summary', result='miss').inc(len(chunks) - hits)
+        return cached
+
+    async def set_many(self, prompt: str, summaries: dict[str, str]) -> None:
+        await self.store.store_cached_summaries(
+            {self.key(prompt, chunk): summary for chunk, summary in summaries.items()},
+            ttl_seconds=self.ttl_seconds,
+        )
+
+
+class SummaryError(Exception):
+    """Every chunk of a summary level failed."""
+
+
+@dataclass
+class SummaryProgress:
+    level: int = 0
+    done: int = 0
+    total: int = 0
+
+    @property
+    def entity(self) -> str:
+        return 'чанк' if self.level == 0 else 'предсаммари'
+
+
+class SummaryEngine:
+    """
+    Map-reduce summariser: chunk summaries of one level run concurrently
+    (bounded by the provider semaphore) and levels are reduced as a tree, so
+    wall-clock time grows with tree depth rather than with chunk count.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[list[tuple[str, str]]], Awaitable[TextResponse]],
+        count_tokens: Callable[[str], int],
+        semaphore: asyncio.Semaphore,
+        max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+        overlap_tokens: int = 0,
+        on_progress: Callable[[SummaryProgress], Awaitable[None]] | None = None,
+        progress_interval: float = PROGRESS_INTERVAL_SECONDS,
+        cache: SummaryCache | None = None,
+    ):
+        self.generate = generate
+        self.count_tokens = count_tokens
+        self.semaphore = semaphore
+        self.max_chunk_tokens = max_chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.cache = cache
+        self.progress = SummaryProgress()
+        self._last_progress_at = 0.0
+
+    def chunk(self, texts: list[str]) -> list[str]:
+        return chunk_texts(
+            texts,
+            count_tokens=self.count_tokens,
+            max_tokens=self.max_chunk_tokens,
+            overlap_tokens=self.overlap_tokens,
+        )
+
+    async def summarize(self, texts: list[str]) -> TextResponse:
+        return await self.summarize_windows([texts])
+
+    async def summarize_windows(self, windows: list[list[str]]) -> TextResponse:
+        try:
+            summaries = await self._reduce(windows)
+        except SummaryError as e:
+            return TextResponse(success=False, text=str(e))
+
+        if not summaries:
+            return TextResponse(success=False, text='Не получилось сделать ни одного саммари')
+
+        async with self.semaphore:
+            return await self.generate([('system', FINAL_PROMPT), ('user', '\n'.join(summaries))])
+
+    async def _reduce(self, windows: list[list[str]]) -> list[str]:
+        chunks = [chunk for window in windows for chunk in await run_cpu(self.chunk, window)]
+        logger.debug('Split %d windows into %d chunks', len(windows), len(chunks))
+        summaries = await self._summarize_level(chunks, level=0)
+
+        final_budget = self.max_chunk_tokens - await run_cpu(self.count_tokens, FINAL_PROMPT)
+        level = 1
+        while len(summaries) > 1 and await run_cpu(self.count_tokens, '\n'.join(summaries)) > final_budget:
+            chunks = await run_cpu(self.chunk, summaries)
+            if len(chunks) >= len(summaries):
+                # summaries don't shrink anymore, let the final call deal with it
+                logger.warning('Summary reduce made no progress at level=%d', level)
+                break
+            summaries = await self._summarize_level(chunks, level=level)
+            level += 1
+
+        logger.info('Summary tree reduced: depth=%d, final_parts=%d', level, len(summaries))
+        return summaries
+
+    async def _summarize_level(self, chunks: list[str], level: int) -> list[str]:
+        cached = [None] * len(chunks)
+        if self.cache is not None:
+            cached = await self.cache.get_many(CHUNK_PROMPT, chunks)
+        missing = [chunk for chunk, summary in zip(chunks, cached) if summary is None]
+        logger.debug('Summary level=%d: chunks=%d, cached=%d', level, len(chunks), len(chunks) - len(missing))
+
+        self.progress = SummaryProgress(level=level, done=len(chunks) - len(missing), total=len(chunks))
+        await self._report(force=True)
+        replies = await asyncio.gather(*(self._summarize_chunk(chunk) for chunk in missing))
+        fresh = dict(zip(missing, replies))
+
+        summaries = []
+        for chunk, summary in zip(chunks, cached):
+            if summary is not None:
+                summaries.append(summary)
+            elif fresh[chunk].success:
+                summaries.append(fresh[chunk].text)
+            else:
+                logger.warning('Chunk summary failed at level=%d: %s', level, fresh[chunk].text[:100])
+        if not summaries and replies:
+            # nothing usable at this level, surface the provider error
+            raise SummaryError(replies[0].text)
+
+        if self.cache is not None:
+            await self.cache.set_many(
+                CHUNK_PROMPT, {chunk: reply.text for chunk, reply in fresh.items() if reply.success}
+            )
+        return summaries
+
+    async def _summarize_chunk(self, chunk: str) -> TextResponse:
+        async with self.semaphore:
+            reply = await self.generate([('system', CHUNK_PROMPT), ('user', chunk)])
+        self.progress.done += 1
+        await self._report(force=self.progress.done == self.progress.total)
+        return reply
+
+    async def _report(self, force: bool = False) -> None:
+        if self.on_progress is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress_at < self.progress_interval:
+            return
+        self._last_progress_at = now
+        try:
+            await self.on_progress(self.progress)
+        except Exception as e:
+            # progress is cosmetic, never fail the summary because of it
+            logger.debug('Summary progress report failed: %s', e)
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Handlers marked with flags={'provider_call': True} go through the limiter,
+# everything else (admin commands, ignored chatter) is never queued
+PROVIDER_CALL_FLAG = 'provider_call'
+
+GLOBAL_MAX_IN_FLIGHT = 16
+CHAT_MAX_IN_FLIGHT = 2
+CHAT_MAX_QUEUED = 4
+SHED_REACTION = '🥱'
+
+
+class ChatOverloaded(Exception):
+    """The chat already has as many requests queued as it is allowed to."""
+
+
+class FairLimiter:
+    """
+    Caps requests in flight per chat and in total. Chats waiting for a global
+    slot are served round-robin, so one noisy chat can't starve the others,
+    and a chat that queues more than max_queued requests gets the extra ones
+    rejected instead of piling them up.
+    """
+
+    def __init__(
+        self,
+        global_limit: int = GLOBAL_MAX_IN_FLIGHT,
+        per_chat_limit: int = CHAT_MAX_IN_FLIGHT,
+        max_queued: int = CHAT_MAX_QUEUED,
+    ):
+        self.global_limit = global_limit
+        self.per_chat_limit = per_chat_limit
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self._chat_in_flight: dict[int, int] = {}
+        self._waiters: dict[int, deque[asyncio.Future]] = {}
+        self._rotation: deque[int] = deque()  # chats with waiters, in serving order
+
+    @classmethod
+    def from_env(cls) -> FairLimiter:
+        return cls(
+            global_limit=int(os.getenv('GLOBAL_MAX_IN_FLIGHT', GLOBAL_MAX_IN_FLIGHT)),
+            per_chat_limit=int(os.getenv('CHAT_MAX_IN_FLIGHT', CHAT_MAX_IN_FLIGHT)),
+            max_queued=int(os.getenv('CHAT_MAX_QUEUED', CHAT_MAX_QUEUED)),
+        )
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def chat_in_flight(self, chat_id: int) -> int:
+        return self._chat_in_flight.get(chat_id, 0)
+
+    async def acquire(self, chat_id: int) -> float:
+        """Wait for a slot and return the time spent waiting, in seconds."""
+        waiters = self._waiters.get(chat_id)
+        if not self._can_start(chat_id) and len(waiters or ()) >= self.max_queued:
+            raise ChatOverloaded(chat_id)
+
+        started_at = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        if waiters is None:
+            waiters = self._waiters[chat_id] = deque()
+            self._rotation.append(chat_id)
+        waiters.append(future)
+        self._dispatch()
+        metrics.chat_queue_depth.set(self.queued)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted right as we got cancelled
+                self.release(chat_id)
+            else:
+                self._forget(chat_id, future)
+            raise
+        return time.monotonic() - started_at
+
+    def release(self, chat_id: int) -> None:
+        self.in_flight -= 1
+        left = self._chat_in_flight[chat_id] - 1
+        if left:
+            self._chat_in_flight[chat_id] = left
+        else:
+            del self._chat_in_flight[chat_id]
+        self._dispatch()
+
+    def _can_start(self, chat_id: int) -> bool:
+        # anyone already in line goes first
+        return (
+            not self._rotation
+            and self.in_flight < self.global_limit
+            and self.chat_in_flight(chat_id) < self.per_chat_limit
+        )
+
+    def _dispatch(self) -> None:
+        # one pass over the rotation per granted slot; a chat that is at its
+        # own limit keeps its place in line but is skipped
+        skipped = 0
+        while self._rotation and self.in_flight < self.global_limit and skipped < len(self._rotation):
+            chat_id = self._rotation.popleft()
+            if self.chat_in_flight(chat_id) >= self.per_chat_limit:
+                self._rotation.append(chat_id)
+                skipped += 1
+                continue
+            waiters = self._waiters[chat_id]
+            waiters.popleft().set_result(None)
+            self.in_flight += 1
+            self._chat_in_flight[chat_id] = self.chat_in_flight(chat_id) + 1
+            if waiters:
+                self._rotation.append(chat_id)
+            else:
+                del self._waiters[chat_id]
+            skipped = 0
+        metrics.chat_queue_depth.set(self.queued)
+
+    def _forget(self, chat_id: int, future: asyncio.Future) -> None:
+        waiters = self._waiters.get(chat_id)
+        if waiters is None:
+            return
+        waiters.remove(future)
+        if not waiters:
+            del self._waiters[chat_id]
+            self._rotation.remove(chat_id)
+        metrics.chat_queue_depth.set(self.queued)
+
+
+class ChatConcurrencyMiddleware(BaseMiddleware):
+    """Run flagged handlers through a FairLimiter keyed by chat id."""
+
+    def __init__(self, limiter: FairLimiter):
+        self.limiter = limiter
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not get_flag(data, PROVIDER_CALL_FLAG):
+            return await handler(event, data)
+
+        chat_id = _chat_id(event)
+        try:
+            waited = await self.limiter.acquire(chat_id)
+        except ChatOverloaded:
+            logger.warning('Shedding request: chat_id=%s already has %d queued', chat_id, self.limiter.max_queued)
+            metrics.errors_total.labels(error_type='chat_overloaded').inc()
+            await _shed(event)
+            return None
+
+        metrics.chat_queue_wait_seconds.observe(waited)
+        if waited > 1:
+            logger.info('Request waited %.1fs for a slot: chat_id=%s', waited, chat_id)
+        try:
+            return await handler(event, data)
+        finally:
+            self.limiter.release(chat_id)
+
+
+def _chat_id(event: types.TelegramObject) -> int:
+    if not isinstance(event, types.CallbackQuery):
+        return event.chat.id
+    # callbacks from inline mode come without a message, the user who pressed
+    # the button stands in for the chat
+    if event.message is None:
+        return event.from_user.id
+    return event.message.chat.id
+
+
+async def _shed(event: types.TelegramObject) -> None:
+    try:
+        if isinstance(event, types.CallbackQuery):
+            await event.answer(SHED_REACTION)
+        else:
+            reaction = types.reaction_type_emoji.ReactionTypeEmoji(type='emoji', emoji=SHED_REACTION)
+            await event.react(reaction=[reaction])
+    except Exception as e:
+        logger.debug('Failed to react to a shed request: %s', e)
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class WebhookSettings:
+    # public base url Telegram should call, e.g. https://matvey.example.com
+    # when empty, setWebhook is not called (handy for POSTing fake updates locally)
+    base_url: str | None = None
+    path: str = '/webhook'
+    secret_token: str | None = None
+    host: str = '0.0.0.0'
+    port: int = 8080
+
+    @classmethod
+    def from_env(cls) -> WebhookSettings:
+        return cls(
+            base_url=os.getenv('WEBHOOK_URL') or None,
+            path=os.getenv('WEBHOOK_PATH', cls.path),
+            secret_token=os.getenv('WEBHOOK_SECRET') or None,
+            host=os.getenv('WEBHOOK_HOST', cls.host),
+            port=int(os.getenv('WEBHOOK_PORT', cls.port)),
+        )
+
+    @property
+    def url(self) -> str | None:
+        if not self.base_url:
+            return None
+        return self.base_url.rstrip('/') + self.path
+
+
+def build_webhook_app(
+    dp: Dispatcher,
+    bot: Bot,
+    settings: WebhookSettings,
+    handle_in_background: bool = True,
+) -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.secret_token,
+        handle_in_background=handle_in_background,
+    ).register(app, path=settings.path)
+    app.router.add_get('/healthz', _healthz)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def _healthz(request: web.Request) -> web.Response:
+    return web.Response(text='ok')
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, settings: WebhookSettings) -> None:
+    """Serve Telegram updates over HTTP until cancelled."""
+    if settings.url:
+        await bot.set_webhook(
+            settings.url,
+            secret_token=settings.secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info('Webhook registered: url=%s', settings.url)
+    else:
+        logger.warning('WEBHOOK_URL is not set, not registering webhook with Telegram')
+
+    runner = web.AppRunner(build_webhook_app(dp, bot, settings))
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.host, port=settings.port)
+    await site.start()
+    logger.info('Webhook server listening on %s:%d%s', settings.host, settings.port, settings.path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+
+import executor
+import metrics
+from bot import bot, config, image_jobs, jobs, message_store
+from jobs import IMAGE_JOB_WORKERS, JOB_WORKERS
+from providers import clients as provider_clients
+
+logger = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    # importing the handlers registers their jobs
+    import handlers  # noqa: F401
+
+    concurrency = int(os.getenv("JOB_WORKERS", JOB_WORKERS)) or JOB_WORKERS
+    image_concurrency = int(os.getenv("IMAGE_JOB_WORKERS", IMAGE_JOB_WORKERS)) or IMAGE_JOB_WORKERS
+    logger.info(
+        "Starting job worker for bot_username=%s, worker_id=%s, concurrency=%d, image_concurrency=%d",
+        config.me,
+        jobs.worker_id,
+        concurrency,
+        image_concurrency,
+    )
+    metrics.start_metrics_server()
+    try:
+        await asyncio.gather(jobs.run(bot, concurrency), image_jobs.run(bot, image_concurrency))
+    finally:
+        await message_store.close()
+        await provider_clients.aclose()
+        executor.shutdown()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from background import ChatTasks
+
+
+async def test_finished_tasks_are_forgotten():
+    tasks = ChatTasks()
+    task = tasks.spawn(1, asyncio.sleep(0))
+    assert tasks.running(1) == 1
+
+    await task
+    await asyncio.sleep(0)
+
+    assert tasks.running(1) == 0
+
+
+async def test_cancel_only_touches_own_chat():
+    tasks = ChatTasks()
+    first = tasks.spawn(1, asyncio.sleep(10))
+    second = tasks.spawn(1, asyncio.sleep(10))
+    other = tasks.spawn(2, asyncio.sleep(10))
+
+    assert tasks.cancel(1) == 2
+    await asyncio.gather(first, second, return_exceptions=True)
+
+    assert first.cancelled() and second.cancelled()
+    assert not other.done()
+    assert tasks.cancel(3) == 0
+
+    await tasks.aclose()
+    assert other.cancelled()
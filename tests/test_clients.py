@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from clients import ClientLimits, ProviderClients
+
+
+def test_client_limits_from_env(monkeypatch):
+    monkeypatch.setenv('PROVIDER_MAX_CONNECTIONS', '7')
+    monkeypatch.setenv('PROVIDER_KEEPALIVE_EXPIRY', '2.5')
+    monkeypatch.setenv('PROVIDER_HTTP2', 'true')
+
+    limits = ClientLimits.from_env()
+
+    assert limits.max_connections == 7
+    assert limits.keepalive_expiry == 2.5
+    assert limits.http2 is True
+    assert limits.max_keepalive_connections == ClientLimits.max_keepalive_connections
+
+
+async def test_clients_are_created_once_and_shared(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'sk-ant-test')
+    clients = ProviderClients(ClientLimits(max_connections=3))
+
+    assert clients.openai is clients.openai
+    assert clients.anthropic is clients.anthropic
+    assert clients.http is clients.http
+    assert clients.http._transport._pool._max_connections == 3
+    # retrying is left to retry.RetryPolicy
+    assert clients.openai.max_retries == 0
+    assert clients.anthropic.max_retries == 0
+
+    await clients.aclose()
+
+    assert clients._openai is None
+    assert clients._anthropic is None
+    assert clients._http is None
+
+
+async def test_aclose_without_clients_is_noop():
+    await ProviderClients(ClientLimits()).aclose()
@@ -0,0 +1,50 @@
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import executor
+import metrics
+
+
+async def test_run_cpu_runs_in_worker_thread():
+    result = await executor.run_cpu(lambda a, b=0: (a + b, threading.current_thread().name), 2, b=3)
+
+    assert result[0] == 5
+    assert result[1].startswith('matvey-cpu')
+
+
+async def test_run_cpu_queue_depth_returns_to_zero():
+    await executor.run_cpu(sum, [1, 2, 3])
+
+    assert metrics.executor_queue_depth._value.get() == 0
+
+
+async def test_run_cpu_propagates_exceptions():
+    def boom():
+        raise ValueError('nope')
+
+    try:
+        await executor.run_cpu(boom)
+    except ValueError as e:
+        assert str(e) == 'nope'
+    else:
+        raise AssertionError('exception was swallowed')
+
+
+async def test_cancelled_queued_call_leaves_queue_depth():
+    release = threading.Event()
+    blockers = [asyncio.ensure_future(executor.run_cpu(release.wait)) for _ in range(executor.CPU_WORKERS)]
+    await asyncio.sleep(0.05)
+    queued = asyncio.ensure_future(executor.run_cpu(sum, [1]))
+    await asyncio.sleep(0.05)
+    assert metrics.executor_queue_depth._value.get() == 1
+
+    queued.cancel()
+    await asyncio.gather(queued, return_exceptions=True)
+    release.set()
+    await asyncio.gather(*blockers)
+
+    assert metrics.executor_queue_depth._value.get() == 0
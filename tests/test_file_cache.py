@@ -0,0 +1,85 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+from unittest.mock import AsyncMock
+
+from file_cache import FileCache
+
+
+class FakeStore:
+    def __init__(self):
+        self.data = {}
+
+    async def get_cached_file(self, key):
+        return self.data.get(key)
+
+    async def store_cached_file(self, key, data, ttl_seconds):
+        self.data[key] = data
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def cache(clock):
+    return FileCache(
+        FakeStore(),
+        namespace='testbot',
+        ttl_seconds=60,
+        memory_budget_bytes=10,
+        redis_max_file_bytes=8,
+        clock=clock,
+    )
+
+
+class TestFileCache:
+    async def test_repeat_requests_skip_download(self, cache):
+        download = AsyncMock(return_value=b'photo')
+
+        assert await cache.get_or_download('uniq', download) == b'photo'
+        assert await cache.get_or_download('uniq', download) == b'photo'
+
+        download.assert_awaited_once()
+        assert cache.store.data == {'matvey-3000:file:testbot:uniq': b'photo'}
+
+    async def test_redis_tier_serves_after_memory_eviction(self, cache):
+        download = AsyncMock(side_effect=[b'aaaaaa', b'bbbbbb'])
+
+        await cache.get_or_download('a', download)
+        await cache.get_or_download('b', download)  # pushes 'a' out of the 10 byte budget
+        assert list(cache._memory) == ['b']
+        assert cache.memory_bytes == 6
+
+        assert await cache.get_or_download('a', AsyncMock()) == b'aaaaaa'
+        assert download.await_count == 2
+
+    async def test_memory_entries_expire(self, cache, clock):
+        cache.store.get_cached_file = AsyncMock(return_value=None)
+        download = AsyncMock(return_value=b'photo')
+
+        await cache.get_or_download('uniq', download)
+        clock.now = 61
+        await cache.get_or_download('uniq', download)
+
+        assert download.await_count == 2
+
+    async def test_large_files_skip_redis_and_memory(self, cache):
+        download = AsyncMock(return_value=b'x' * 11)
+
+        await cache.get_or_download('big', download)
+
+        assert cache.store.data == {}
+        assert cache.memory_bytes == 0
@@ -0,0 +1,196 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+from unittest.mock import AsyncMock
+from aiogram import types
+
+from jobs import Job, JobQueue
+from retry import RetryPolicy
+
+
+class FakeStore:
+    def __init__(self):
+        self.lists = {}
+        self.delayed = {}
+        self.workers = {}
+
+    async def push_job(self, queue_key, payload):
+        self.lists.setdefault(queue_key, []).insert(0, payload)
+
+    async def claim_job(self, queue_key, processing_key, timeout):
+        queue = self.lists.get(queue_key)
+        if not queue:
+            await asyncio.sleep(0)
+            return None
+        payload = queue.pop()
+        self.lists.setdefault(processing_key, []).insert(0, payload)
+        return payload
+
+    async def finish_job(self, processing_key, payload):
+        self.lists[processing_key].remove(payload)
+
+    async def bury_job(self, processing_key, dead_key, payload):
+        self.lists[processing_key].remove(payload)
+        self.lists.setdefault(dead_key, []).insert(0, payload)
+
+    async def schedule_job(self, delayed_key, payload, run_at):
+        self.delayed[payload] = run_at
+
+    async def promote_due_jobs(self, delayed_key, queue_key, now):
+        due = [payload for payload, run_at in self.delayed.items() if run_at <= now]
+        for payload in due:
+            del self.delayed[payload]
+            await self.push_job(queue_key, payload)
+        return len(due)
+
+    async def heartbeat_worker(self, workers_key, worker_id, now):
+        self.workers[worker_id] = now
+
+    async def stale_workers(self, workers_key, before):
+        return [worker_id for worker_id, seen in self.workers.items() if seen <= before]
+
+    async def forget_worker(self, workers_key, worker_id):
+        self.workers.pop(worker_id, None)
+
+    async def requeue_jobs(self, processing_key, queue_key):
+        moved = self.lists.pop(processing_key, [])
+        self.lists.setdefault(queue_key, []).extend(moved)
+        return len(moved)
+
+
+def make_message(text='/edit add a hat'):
+    return types.Message.model_validate({
+        'message_id': 42,
+        'date': 0,
+        'chat': {'id': 7, 'type': 'group'},
+        'text': text,
+        'reply_to_message': {
+            'message_id': 41,
+            'date': 0,
+            'chat': {'id': 7, 'type': 'group'},
+            'photo': [{'file_id': 'f', 'file_unique_id': 'u', 'width': 1, 'height': 1}],
+        },
+    })
+
+
+@pytest.fixture
+def store():
+    return FakeStore()
+
+
+@pytest.fixture
+def queue(store):
+    return JobQueue(store, namespace='testbot', worker_id='w1', max_attempts=2,
+                    retry_policy=RetryPolicy(base_delay=0, max_delay=0))
+
+
+async def claim(queue):
+    return await queue.store.claim_job(queue.queue_key, queue.processing_key, 0)
+
+
+async def test_job_gets_the_message_and_kwargs(queue, store):
+    seen = []
+
+    @queue.job('edit')
+    async def edit(message, instruction):
+        seen.append((message.chat.id, message.reply_to_message.photo[-1].file_id, instruction))
+
+    await queue.enqueue('edit', make_message(), instruction='add a hat')
+    await queue.process(AsyncMock(), await claim(queue))
+
+    assert seen == [(7, 'f', 'add a hat')]
+    assert store.lists[queue.processing_key] == []
+
+
+async def test_unknown_kind_is_rejected(queue):
+    with pytest.raises(KeyError):
+        await queue.enqueue('nope', make_message())
+
+
+async def test_failed_job_is_retried_then_reported(queue, store):
+    calls = []
+
+    @queue.job('edit')
+    async def edit(message):
+        calls.append(message.message_id)
+        raise RuntimeError('replicate is down')
+
+    bot = AsyncMock()
+    await queue.enqueue('edit', make_message())
+
+    await queue.process(bot, await claim(queue))
+    assert len(store.delayed) == 1
+    bot.send_message.assert_not_awaited()
+
+    await store.promote_due_jobs(queue.delayed_key, queue.queue_key, float('inf'))
+    payload = await claim(queue)
+    assert Job.deserialize(payload).attempts == 1
+    await queue.process(bot, payload)
+
+    assert calls == [42, 42]
+    assert store.delayed == {}
+    bot.send_message.assert_awaited_once()
+    assert bot.send_message.await_args.args[0] == 7
+    assert bot.send_message.await_args.kwargs['reply_to_message_id'] == 42
+
+
+
+async def test_unreadable_job_is_dead_lettered(queue, store):
+    @queue.job('edit')
+    async def edit(message):
+        raise AssertionError('should not run')
+
+    await store.push_job(queue.queue_key, 'not json')
+    await store.push_job(queue.queue_key, Job(kind='gone', message={}, kwargs={}).serialize())
+    await queue.process(AsyncMock(), await claim(queue))
+    await queue.process(AsyncMock(), await claim(queue))
+
+    assert store.lists[queue.processing_key] == []
+    assert len(store.lists[queue.dead_key]) == 2
+
+
+async def test_worker_survives_a_failing_store_call(queue, store):
+    done = []
+
+    @queue.job('edit')
+    async def edit(message):
+        done.append(message.message_id)
+
+    store.finish_job = AsyncMock(side_effect=[ConnectionError('redis went away'), None])
+    await queue.enqueue('edit', make_message())
+    await queue.enqueue('edit', make_message())
+
+    worker = asyncio.create_task(queue._consume(AsyncMock()))
+    for _ in range(100):
+        if len(done) == 2:
+            break
+        await asyncio.sleep(0)
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+
+    assert done == [42, 42]
+
+
+def test_worker_ids_are_unique_per_queue(store):
+    assert JobQueue(store, namespace='testbot').worker_id != JobQueue(store, namespace='testbot').worker_id
+
+
+async def test_jobs_of_a_dead_worker_are_requeued(queue, store):
+    @queue.job('edit')
+    async def edit(message):
+        pass
+
+    dead = JobQueue(store, namespace='testbot', worker_id='w0', worker_timeout=60)
+    await dead.recover_dead_workers(now=1000)
+    await queue.enqueue('edit', make_message())
+    await claim(dead)
+
+    # still within the timeout: the job stays with w0
+    assert await queue.recover_dead_workers(now=1030) == 0
+    assert await queue.recover_dead_workers(now=1061) == 1
+    assert store.lists[queue.queue_key] and not store.lists.get(dead.processing_key)
+    assert set(store.workers) == {'w1'}
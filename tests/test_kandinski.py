@@ -0,0 +1,136 @@
+import itertools
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import httpx
+import pytest
+
+from kandinski import KandinskiApi, KandinskiError, poll_intervals
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSleep:
+    def __init__(self, clock):
+        self.clock = clock
+        self.slept = []
+
+    async def __call__(self, seconds):
+        self.slept.append(seconds)
+        self.clock.now += seconds
+
+
+class FakeFusionbrain:
+    def __init__(self, statuses):
+        self.statuses = iter(statuses)
+        self.paths = []
+
+    def __call__(self, request):
+        path = request.url.path.removeprefix('/key/api/v1')
+        self.paths.append(path)
+        if path == '/models':
+            return httpx.Response(200, json=[{'id': 4}])
+        if path == '/text2image/run':
+            return httpx.Response(201, json={'uuid': 'run-1'})
+        status = next(self.statuses)
+        return httpx.Response(200, json={'status': status, 'images': ['aW1n'], 'censored': False})
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def sleep(clock):
+    return FakeSleep(clock)
+
+
+def make_client(api):
+    return httpx.AsyncClient(transport=httpx.MockTransport(api))
+
+
+def test_poll_intervals_grow_up_to_cap():
+    intervals = list(itertools.islice(poll_intervals(first=1, factor=2, cap=5), 5))
+
+    assert intervals == [1, 2, 4, 5, 5]
+
+
+async def test_quick_job_is_picked_up_quickly(clock, sleep):
+    api = FakeFusionbrain(['PROCESSING', 'PROCESSING', 'DONE'])
+    kandinski = KandinskiApi('key', 'secret', clock=clock, sleep=sleep)
+
+    async with make_client(api) as client:
+        result = await kandinski.generate(client, 'a cat')
+
+    assert result.done
+    assert result.image_b64 == 'aW1n'
+    assert sum(sleep.slept) < 3
+
+
+async def test_model_id_is_cached(clock, sleep):
+    api = FakeFusionbrain(['DONE', 'DONE', 'DONE'])
+    kandinski = KandinskiApi('key', 'secret', model_ttl=60, clock=clock, sleep=sleep)
+
+    async with make_client(api) as client:
+        await kandinski.generate(client, 'a cat')
+        await kandinski.generate(client, 'a dog')
+        assert api.paths.count('/models') == 1
+
+        clock.now += 61
+        await kandinski.generate(client, 'a cow')
+
+    assert api.paths.count('/models') == 2
+
+
+async def test_gives_up_after_poll_timeout(clock, sleep):
+    api = FakeFusionbrain(itertools.repeat('PROCESSING'))
+    kandinski = KandinskiApi('key', 'secret', poll_timeout=30, clock=clock, sleep=sleep)
+
+    async with make_client(api) as client:
+        result = await kandinski.generate(client, 'a cat')
+
+    assert not result.done
+    assert sum(sleep.slept) <= 30
+
+
+async def test_failed_job_raises(clock, sleep):
+    api = FakeFusionbrain(['FAIL'])
+    kandinski = KandinskiApi('key', 'secret', clock=clock, sleep=sleep)
+
+    async with make_client(api) as client:
+        with pytest.raises(KandinskiError):
+            await kandinski.generate(client, 'a cat')
+
+
+async def test_error_response_raises(clock, sleep):
+    kandinski = KandinskiApi('key', 'secret', clock=clock, sleep=sleep)
+
+    async with make_client(lambda request: httpx.Response(401, json={'error': 'bad key'})) as client:
+        with pytest.raises(KandinskiError, match='401'):
+            await kandinski.generate(client, 'a cat')
+
+
+async def test_base_url_can_be_overridden(clock, sleep):
+    api = FakeFusionbrain(['DONE'])
+    kandinski = KandinskiApi('key', 'secret', base_url='http://127.0.0.1:8090/key/api/v1/', clock=clock, sleep=sleep)
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        return api(request)
+
+    async with make_client(handler) as client:
+        result = await kandinski.generate(client, 'a cat')
+
+    assert result.done
+    assert set(hosts) == {'127.0.0.1'}
+    assert api.paths == ['/models', '/text2image/run', '/text2image/status/run-1']
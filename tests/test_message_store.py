@@ -1,13 +1,25 @@
+import asyncio
+import fnmatch
 import pytest
+import redis
 import sys
 from pathlib import Path
-from unittest.mock import Mock, MagicMock
+from unittest.mock import AsyncMock, Mock, MagicMock
 from dataclasses import asdict
 
 # Add src directory to path
 sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
 
-from message_store import MessageStore, StoredChatMessage
+import message_store as message_store_module
+from message_store import (
+    ENCODING_RETRY_SECONDS,
+    HISTORY_BUCKET_SECONDS,
+    HISTORY_INDEX_KEY,
+    AsyncMessageStore,
+    MessageStore,
+    StoredChatMessage,
+    get_encoding,
+)
 
 
 @pytest.fixture
@@ -18,6 +30,7 @@ def mock_redis():
     redis_mock.llen.return_value = 0
     redis_mock.rpush.return_value = 1
     redis_mock.delete.return_value = 1
+    redis_mock.pipeline.return_value.execute.return_value = [1, True]
     return redis_mock
 
 
@@ -29,6 +42,185 @@ def message_store(mock_redis):
     return store
 
 
+@pytest.fixture
+def mock_async_redis():
+    """Mock redis.asyncio connection."""
+    redis_mock = AsyncMock()
+    redis_mock.lrange.return_value = []
+    redis_mock.llen.return_value = 0
+    redis_mock.rpush.return_value = 1
+    redis_mock.delete.return_value = 1
+    redis_mock.pipeline = MagicMock()
+    redis_mock.pipeline.return_value.execute = AsyncMock(return_value=[1, True])
+    return redis_mock
+
+
+@pytest.fixture
+def async_message_store(mock_async_redis):
+    """Create AsyncMessageStore with mocked Redis."""
+    store = AsyncMessageStore.__new__(AsyncMessageStore)
+    store.redis_conn = mock_async_redis
+    return store
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands the history layout uses."""
+
+    def __init__(self):
+        self.data = {}
+        self.expire_at = {}
+        self.round_trips = 0
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def _call(self, name, *args, **kwargs):
+        self.commands.append((name, args))
+        return getattr(self, f'_{name}')(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if hasattr(type(self), f'_{name}'):
+            def command(*args, **kwargs):
+                self.round_trips += 1
+                return self._call(name, *args, **kwargs)
+            return command
+        raise AttributeError(name)
+
+    @staticmethod
+    def _b(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def _rpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        items.extend(self._b(v) for v in values)
+        return len(items)
+
+    def _lrange(self, key, start, end):
+        items = self.data.get(key, [])
+        start = max(len(items) + start, 0) if start < 0 else start
+        end = len(items) + end if end < 0 else end
+        return items[start:end + 1]
+
+    def _lset(self, key, index, value):
+        self.data[key][index] = self._b(value)
+        return True
+
+    def _ltrim(self, key, start, end):
+        self.data[key] = self._lrange(key, start, end)
+        return True
+
+    def _hincrby(self, key, field, amount):
+        fields = self.data.setdefault(key, {})
+        fields[self._b(field)] = self._b(int(fields.get(self._b(field), 0)) + amount)
+        return int(fields[self._b(field)])
+
+    def _hset(self, key, field, value):
+        self.data.setdefault(key, {})[self._b(field)] = self._b(value)
+        return 1
+
+    def _hdel(self, key, *fields):
+        hash_ = self.data.get(key, {})
+        return sum(hash_.pop(self._b(f), None) is not None for f in fields)
+
+    def _hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def _hvals(self, key):
+        return list(self.data.get(key, {}).values())
+
+    def _expireat(self, key, when):
+        self.expire_at[key] = when
+        return True
+
+    def _delete(self, *keys):
+        return sum(self.data.pop(k, None) is not None for k in keys)
+
+    def _rename(self, key, new_key):
+        if key not in self.data:
+            raise redis.ResponseError('no such key')
+        self.data[new_key] = self.data.pop(key)
+        return True
+
+    def _zadd(self, key, mapping, nx=False):
+        zset = self.data.setdefault(key, {})
+        added = 0
+        for member, score in mapping.items():
+            member = self._b(member)
+            if member not in zset:
+                added += 1
+            elif nx:
+                continue
+            zset[member] = score
+        return added
+
+    def _zrange(self, key, start, end):
+        zset = self.data.get(key, {})
+        return sorted(zset, key=zset.get)
+
+    def _zrem(self, key, *members):
+        zset = self.data.get(key, {})
+        return sum(zset.pop(self._b(m), None) is not None for m in members)
+
+    def _type(self, key):
+        value = self.data.get(key)
+        return {list: b'list', dict: b'hash'}.get(type(value), b'none')
+
+    def scan_iter(self, match, count):
+        return iter([k.encode() for k in list(self.data) if fnmatch.fnmatchcase(k, match)])
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.queued = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.queued.append((name, args, kwargs))
+        return queue
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [self.redis._call(name, *args, **kwargs) for name, args, kwargs in self.queued]
+
+
+class AsyncFakeRedis(FakeRedis):
+    def pipeline(self, transaction=True):
+        return AsyncFakePipeline(self)
+
+    def __getattr__(self, name):
+        command = super().__getattr__(name)
+
+        async def async_command(*args, **kwargs):
+            return command(*args, **kwargs)
+        return async_command
+
+    async def scan_iter(self, match, count):
+        for key in super().scan_iter(match, count):
+            yield key
+
+
+class AsyncFakePipeline(FakePipeline):
+    async def execute(self):
+        return super().execute()
+
+
+@pytest.fixture
+def history_store():
+    """MessageStore over an in-memory Redis, for the bucketed history layout."""
+    store = MessageStore.__new__(MessageStore)
+    store.redis_conn = FakeRedis()
+    return store
+
+
+@pytest.fixture
+def async_history_store():
+    store = AsyncMessageStore.__new__(AsyncMessageStore)
+    store.redis_conn = AsyncFakeRedis()
+    return store
+
+
 @pytest.fixture
 def sample_messages():
     """Create sample chat messages."""
@@ -64,6 +256,21 @@ def sample_messages():
     ]
 
 
+def test_get_encoding_retries_a_failed_load_later(mocker):
+    mocker.patch.dict(message_store_module._encodings, clear=True)
+    failed_at = mocker.patch.dict(message_store_module._encoding_failed_at, clear=True)
+    load = mocker.patch('message_store.tiktoken.get_encoding', side_effect=[OSError('offline'), 'encoding'])
+
+    assert get_encoding('test') is None
+    assert get_encoding('test') is None
+    assert load.call_count == 1
+
+    failed_at['test'] -= ENCODING_RETRY_SECONDS
+    assert get_encoding('test') == 'encoding'
+    assert get_encoding('test') == 'encoding'
+    assert load.call_count == 2
+
+
 class TestStoredChatMessage:
     """Test StoredChatMessage dataclass."""
 
@@ -80,12 +287,37 @@ class TestStoredChatMessage:
         serialized = msg.serialize()
         deserialized = StoredChatMessage.deserialize(serialized)
         
-        assert deserialized.chat_name == msg.chat_name
+        # the chat is known from the key, compact entries don't repeat it
+        assert deserialized.chat_name == ""
         assert deserialized.from_username == msg.from_username
         assert deserialized.from_full_name == msg.from_full_name
         assert deserialized.timestamp == msg.timestamp
         assert deserialized.text == msg.text
 
+    def test_deserialize_legacy_entry_without_token_count(self):
+        """Entries written before token counts were stored still load."""
+        legacy = '{"chat_name": "Test", "from_username": "user", "from_full_name": "User", "timestamp": 1, "text": "hi"}'
+
+        msg = StoredChatMessage.deserialize(legacy)
+
+        assert msg.text == "hi"
+        assert msg.token_count is None
+
+    def test_compact_format_roundtrip_with_missing_fields(self):
+        msg = StoredChatMessage("", None, None, 1700000000, None)
+
+        assert StoredChatMessage.deserialize(msg.serialize()) == msg
+
+    def test_compact_format_is_smaller_than_json(self):
+        msg = StoredChatMessage("Test Chat", "user1", "User One", 1700000000, "Привет!", token_count=3)
+
+        assert len(msg.serialize()) < len(msg.serialize_json().encode()) / 2
+
+    def test_token_count_survives_roundtrip(self):
+        msg = StoredChatMessage("Test", "user", "User", 1, "hi", token_count=7)
+
+        assert StoredChatMessage.deserialize(msg.serialize()).token_count == 7
+
     def test_str_representation(self):
         """Test string representation of message."""
         msg = StoredChatMessage(
@@ -105,57 +337,173 @@ class TestStoredChatMessage:
 class TestMessageStore:
     """Test MessageStore functionality."""
 
-    def test_save_message(self, message_store, mock_redis, sample_messages):
-        """Test saving a message to Redis."""
+    def test_save_message(self, history_store, sample_messages):
+        """A message goes to the hourly bucket of its timestamp."""
         msg = sample_messages[0]
-        key = "test:key"
-        
-        message_store.save(key, msg)
-        
-        mock_redis.rpush.assert_called_once_with(key, msg.serialize())
 
-    def test_save_message_with_cutoff(self, message_store, mock_redis, sample_messages):
-        """Test that messages are trimmed when exceeding CUTOFF."""
-        msg = sample_messages[0]
-        key = "test:key"
-        
-        # Simulate list length exceeding CUTOFF
-        mock_redis.llen.return_value = 2001
-        
-        message_store.save(key, msg)
-        
-        mock_redis.ltrim.assert_called_once()
+        bucket_len = history_store.save("test:key", msg)
 
-    def test_fetch_messages(self, message_store, mock_redis, sample_messages):
-        """Test fetching messages from Redis."""
-        key = "test:key"
-        serialized = [msg.serialize() for msg in sample_messages]
-        mock_redis.lrange.return_value = serialized
-        
-        result = message_store.fetch_messages(key, limit=10, raw=False)
-        
-        assert len(result) == len(sample_messages)
-        assert all(isinstance(msg, StoredChatMessage) for msg in result)
-        mock_redis.lrange.assert_called_once_with(key, -10, -1)
+        assert bucket_len == 1
+        assert history_store.redis_conn.data["test:key:b:0"] == [msg.serialize()]
+        assert history_store.redis_conn.data["test:key:buckets"] == {b"0": b"1"}
+
+    def test_save_keeps_newest_max_messages(self, history_store):
+        """Starting a new bucket trims the oldest messages beyond max_messages."""
+        hour = HISTORY_BUCKET_SECONDS
+        old = [StoredChatMessage("Chat", "user1", "User", t, f"old {t}") for t in range(3)]
+        new = [StoredChatMessage("Chat", "user1", "User", hour + t, f"new {t}") for t in range(2)]
+        history_store.save_many("test:key", old, max_messages=3)
+
+        history_store.save_many("test:key", new, max_messages=3)
+
+        texts = [m.text for m in history_store.fetch_messages("test:key", limit=-1)]
+        assert texts == ["old 2", "new 0", "new 1"]
+        assert history_store.redis_conn.data["test:key:buckets"] == {b"0": b"1", str(hour).encode(): b"2"}
+
+    def test_save_keeps_max_messages_within_a_bucket(self, history_store):
+        """The count limit holds on every save, not only when a bucket starts."""
+        messages = [StoredChatMessage("Chat", "user1", "User", t, f"m{t}") for t in range(5)]
+        history_store.save_many("test:key", messages[:3], max_messages=3)
+
+        history_store.save_many("test:key", messages[3:], max_messages=3)
+
+        texts = [m.text for m in history_store.fetch_messages("test:key", limit=-1)]
+        assert texts == ["m2", "m3", "m4"]
+
+    def test_save_within_slack_takes_one_round_trip(self, history_store):
+        messages = [StoredChatMessage("Chat", "user1", "User", t, f"m{t}") for t in range(12)]
+        history_store.save_many("test:key", messages[:10], max_messages=10)
+        history_store.redis_conn.round_trips = 0
+
+        history_store.save_many("test:key", messages[10:11], max_messages=10)
+
+        assert history_store.redis_conn.round_trips == 1
+        history_store.save_many("test:key", messages[11:], max_messages=10)
+        assert len(history_store.fetch_messages("test:key", limit=-1)) == 10
+
+    def test_expired_buckets_are_not_counted(self, history_store, mocker):
+        hour = HISTORY_BUCKET_SECONDS
+        now = mocker.patch('message_store.time.time', return_value=10)
+        messages = [StoredChatMessage("Chat", "user1", "User", t * hour, f"m{t}") for t in (0, 2)]
+        history_store.save_many("test:key", messages, max_age=hour, max_messages=None)
+
+        # the first bucket has expired, its entry stays in the hash until retention runs
+        now.return_value = 2 * hour + 10
+        assert history_store.fetch_stats() == [("test:key", 1)]
+        assert [m.text for m in history_store.fetch_messages("test:key", limit=-1)] == ["m2"]
+
+    def test_save_sets_bucket_ttl_from_max_age(self, history_store, sample_messages):
+        history_store.save("test:key", sample_messages[0], max_age=86400)
+
+        assert history_store.redis_conn.expire_at["test:key:b:0"] == HISTORY_BUCKET_SECONDS + 86400
+        assert history_store.redis_conn.expire_at["test:key:buckets"] == HISTORY_BUCKET_SECONDS + 86400
+
+    def test_apply_retention_drops_expired_buckets(self, history_store, mocker):
+        hour = HISTORY_BUCKET_SECONDS
+        messages = [StoredChatMessage("Chat", "user1", "User", t * hour, f"m{t}") for t in range(3)]
+        history_store.save_many("test:key", messages, max_messages=None)
+        mocker.patch('message_store.time.time', return_value=3 * hour)
+
+        dropped = history_store.apply_retention("test:key", max_age=hour, max_messages=None)
+
+        assert dropped == 2
+        assert [m.text for m in history_store.fetch_messages("test:key", limit=-1)] == ["m2"]
+
+    def test_save_many_single_round_trip(self, history_store, sample_messages):
+        """Messages of one bucket are pushed with one pipelined call."""
+        # the bucket exists already, so no retention pass is needed
+        history_store.redis_conn.data["test:key:buckets"] = {b"0": b"5"}
 
-    def test_fetch_messages_raw(self, message_store, mock_redis, sample_messages):
+        bucket_len = history_store.save_many("test:key", sample_messages[:2])
+
+        assert history_store.redis_conn.round_trips == 1
+        assert bucket_len == 2
+
+    def test_save_stores_token_count(self, message_store, mock_redis, mocker):
+        """Token count is computed once at save time and persisted with the message."""
+        mocker.patch('message_store.count_tokens', return_value=5)
+        msg = StoredChatMessage("Chat", "user1", "User", 1000, "some text")
+
+        message_store.save("test:key", msg)
+
+        serialized = mock_redis.pipeline.return_value.rpush.call_args.args[1]
+        assert StoredChatMessage.deserialize(serialized).token_count == 5
+
+    def test_build_context_messages_uses_stored_token_counts(self, history_store, mocker):
+        """Stored token counts are used instead of re-encoding history."""
+        count_tokens = mocker.patch('message_store.count_tokens', return_value=1)
+        messages = [
+            StoredChatMessage("Chat", "user1", "User", 1000, "Old message", token_count=60),
+            StoredChatMessage("Chat", "user1", "User", 1001, "Recent message", token_count=30),
+        ]
+        history_store.save_many("test:key", messages, max_messages=None)
+
+        result = history_store.build_context_messages(
+            key="test:key",
+            limit=10,
+            bot_username="testbot",
+            system_prompt=('system', 'prompt'),
+            max_tokens=50,
+        )
+
+        assert result == [('system', 'prompt'), ('user', 'Recent message')]
+        # only the system prompt gets tokenised
+        count_tokens.assert_called_once_with('prompt', 'cl100k_base')
+
+    def test_fetch_messages(self, history_store, sample_messages):
+        """Only the newest buckets holding limit messages are read."""
+        hour = HISTORY_BUCKET_SECONDS
+        for i, msg in enumerate(sample_messages):
+            msg.timestamp = i * hour
+        history_store.save_many("test:key", sample_messages, max_messages=None)
+        history_store.redis_conn.commands.clear()
+
+        result = history_store.fetch_messages("test:key", limit=2, raw=False)
+
+        assert [m.text for m in result] == [m.text for m in sample_messages[2:]]
+        # the first two reads are the current and the previous bucket
+        read = [args[0] for name, args in history_store.redis_conn.commands if name == "lrange"]
+        assert read[2:] == [f"test:key:b:{2 * hour}", f"test:key:b:{3 * hour}"]
+
+    def test_fetch_recent_messages_in_one_round_trip(self, history_store, sample_messages, mocker):
+        hour = HISTORY_BUCKET_SECONDS
+        for i, msg in enumerate(sample_messages):
+            msg.timestamp = i * hour
+        history_store.save_many("test:key", sample_messages, max_messages=None)
+        mocker.patch('message_store.time.time', return_value=3 * hour + 10)
+        history_store.redis_conn.round_trips = 0
+
+        result = history_store.fetch_messages("test:key", limit=2, raw=False)
+
+        assert [m.text for m in result] == [m.text for m in sample_messages[2:]]
+        assert history_store.redis_conn.round_trips == 1
+
+    def test_fetch_messages_since(self, history_store):
+        hour = HISTORY_BUCKET_SECONDS
+        messages = [StoredChatMessage("Chat", "user1", "User", t, f"at {t}") for t in (0, hour + 10, hour + 20)]
+        history_store.save_many("test:key", messages, max_messages=None)
+
+        result = history_store.fetch_messages_since("test:key", since=hour + 15)
+
+        assert [m.text for m in result] == [f"at {hour + 20}"]
+
+    def test_fetch_messages_raw(self, history_store, sample_messages):
         """Test fetching raw messages from Redis."""
         key = "test:key"
+        history_store.save_many(key, sample_messages, max_messages=None)
         serialized = [msg.serialize() for msg in sample_messages]
-        mock_redis.lrange.return_value = serialized
         
-        result = message_store.fetch_messages(key, limit=5, raw=True)
+        result = history_store.fetch_messages(key, limit=5, raw=True)
         
         assert result == serialized
 
-    def test_fetch_conversation_history(self, message_store, mock_redis, sample_messages):
+    def test_fetch_conversation_history(self, history_store, sample_messages):
         """Test fetching conversation history as (role, text) tuples."""
         key = "test:key"
         bot_username = "testbot"
-        serialized = [msg.serialize() for msg in sample_messages]
-        mock_redis.lrange.return_value = serialized
+        history_store.save_many(key, sample_messages, max_messages=None)
         
-        result = message_store.fetch_conversation_history(key, limit=10, bot_username=bot_username)
+        result = history_store.fetch_conversation_history(key, limit=10, bot_username=bot_username)
         
         expected = [
             ('user', 'Hello bot!'),
@@ -165,23 +513,22 @@ class TestMessageStore:
         ]
         assert result == expected
 
-    def test_clear_conversation_history(self, message_store, mock_redis):
-        """Test clearing conversation history."""
-        key = "test:key"
-        mock_redis.llen.return_value = 42
-        
-        deleted_count = message_store.clear_conversation_history(key)
-        
-        assert deleted_count == 42
-        mock_redis.delete.assert_called_once_with(key)
+    def test_clear_conversation_history(self, history_store, sample_messages):
+        """Clearing removes every bucket of the chat and its index entry."""
+        history_store.save_many("test:key", sample_messages, max_messages=None)
+
+        deleted_count = history_store.clear_conversation_history("test:key")
+
+        assert deleted_count == len(sample_messages)
+        assert history_store.redis_conn.data[HISTORY_INDEX_KEY] == {}
+        assert set(history_store.redis_conn.data) == {HISTORY_INDEX_KEY}
 
-    def test_build_context_messages_empty_history(self, message_store, mock_redis):
+    def test_build_context_messages_empty_history(self, history_store):
         """Test building context with no history."""
         key = "test:key"
         system_prompt = ('system', 'You are a helpful bot')
-        mock_redis.lrange.return_value = []
         
-        result = message_store.build_context_messages(
+        result = history_store.build_context_messages(
             key=key,
             limit=10,
             bot_username="testbot",
@@ -191,15 +538,14 @@ class TestMessageStore:
         
         assert result == [system_prompt]
 
-    def test_build_context_messages_with_history(self, message_store, mock_redis, sample_messages):
+    def test_build_context_messages_with_history(self, history_store, sample_messages):
         """Test building context with conversation history."""
         key = "test:key"
         system_prompt = ('system', 'You are a helpful bot')
         bot_username = "testbot"
-        serialized = [msg.serialize() for msg in sample_messages]
-        mock_redis.lrange.return_value = serialized
+        history_store.save_many(key, sample_messages, max_messages=None)
         
-        result = message_store.build_context_messages(
+        result = history_store.build_context_messages(
             key=key,
             limit=10,
             bot_username=bot_username,
@@ -213,7 +559,7 @@ class TestMessageStore:
         # Check that history is included
         assert any(text == 'Hello bot!' for role, text in result)
 
-    def test_build_context_messages_filters_none_text(self, message_store, mock_redis):
+    def test_build_context_messages_filters_none_text(self, history_store):
         """Test that messages with None or empty text are filtered out."""
         key = "test:key"
         system_prompt = ('system', 'You are a helpful bot')
@@ -225,10 +571,9 @@ class TestMessageStore:
             StoredChatMessage("Chat", "user1", "User", 1002, ""),
             StoredChatMessage("Chat", "user1", "User", 1003, "Another valid"),
         ]
-        serialized = [msg.serialize() for msg in messages]
-        mock_redis.lrange.return_value = serialized
+        history_store.save_many(key, messages, max_messages=None)
         
-        result = message_store.build_context_messages(
+        result = history_store.build_context_messages(
             key=key,
             limit=10,
             bot_username="testbot",
@@ -242,7 +587,7 @@ class TestMessageStore:
         assert ('user', 'Valid message') in result
         assert ('user', 'Another valid') in result
 
-    def test_build_context_messages_respects_token_limit(self, message_store, mock_redis):
+    def test_build_context_messages_respects_token_limit(self, history_store):
         """Test that context building respects token limits."""
         key = "test:key"
         system_prompt = ('system', 'You are a helpful bot')
@@ -254,10 +599,9 @@ class TestMessageStore:
             StoredChatMessage("Chat", "user1", "User", 1001, long_text),
             StoredChatMessage("Chat", "user1", "User", 1002, "Short message"),
         ]
-        serialized = [msg.serialize() for msg in messages]
-        mock_redis.lrange.return_value = serialized
+        history_store.save_many(key, messages, max_messages=None)
         
-        result = message_store.build_context_messages(
+        result = history_store.build_context_messages(
             key=key,
             limit=10,
             bot_username="testbot",
@@ -270,7 +614,7 @@ class TestMessageStore:
         assert len(result) <= 3
         assert result[0] == system_prompt
 
-    def test_build_context_messages_prioritizes_recent(self, message_store, mock_redis):
+    def test_build_context_messages_prioritizes_recent(self, history_store):
         """Test that most recent messages are prioritized when token limit is reached."""
         key = "test:key"
         system_prompt = ('system', 'Short prompt')
@@ -281,10 +625,9 @@ class TestMessageStore:
             StoredChatMessage("Chat", "user1", "User", 1001, "Middle message"),
             StoredChatMessage("Chat", "user1", "User", 1002, "Recent message"),
         ]
-        serialized = [msg.serialize() for msg in messages]
-        mock_redis.lrange.return_value = serialized
+        history_store.save_many(key, messages, max_messages=None)
         
-        result = message_store.build_context_messages(
+        result = history_store.build_context_messages(
             key=key,
             limit=10,
             bot_username="testbot",
@@ -297,15 +640,204 @@ class TestMessageStore:
         if len(result) > 1:  # If any history was included
             assert "Recent message" in texts
 
-    def test_fetch_stats(self, message_store, mock_redis):
-        """Test fetching statistics about stored messages."""
-        pattern = "test:*"
-        mock_redis.keys.return_value = [b"test:chat1", b"test:chat2"]
-        mock_redis.type.return_value = b"list"
-        mock_redis.llen.side_effect = [10, 20]
-        
-        result = message_store.fetch_stats(pattern)
-        
-        assert len(result) == 2
-        assert ("test:chat1", 10) in result
-        assert ("test:chat2", 20) in result
+    def test_fetch_stats(self, history_store, sample_messages):
+        """Stats come from the key index and the bucket counts, never KEYS."""
+        history_store.save_many("test:chat1", sample_messages[:1], max_messages=None)
+        history_store.save_many("test:chat2", sample_messages, max_messages=None)
+        history_store.redis_conn.data[HISTORY_INDEX_KEY][b"test:gone"] = 0
+
+        result = history_store.fetch_stats()
+
+        assert sorted(result) == [("test:chat1", 1), ("test:chat2", 4)]
+        assert b"test:gone" not in history_store.redis_conn.data[HISTORY_INDEX_KEY]
+
+    def test_save_indexes_history_key(self, message_store, mock_redis, sample_messages):
+        message_store.save("test:key", sample_messages[0])
+
+        pipe = mock_redis.pipeline.return_value
+        index_key, mapping = pipe.zadd.call_args.args
+        assert index_key == HISTORY_INDEX_KEY
+        assert list(mapping) == ["test:key"]
+
+    def test_migrate_legacy_history(self, history_store, sample_messages):
+        """Old one-list-per-chat histories are found with SCAN and moved into buckets."""
+        fake = history_store.redis_conn
+        fake.data["matvey-3000:history:bot:1"] = [msg.serialize_json().encode() for msg in sample_messages]
+        fake.data["matvey-3000:history:bot:2"] = {b"not": b"a list"}
+        history_store.save("matvey-3000:history:bot:3", sample_messages[0])
+
+        legacy = list(history_store.legacy_history_keys())
+        moved = history_store.migrate_legacy_history(legacy[0])
+
+        assert legacy == ["matvey-3000:history:bot:1"]
+        assert moved == len(sample_messages)
+        assert "matvey-3000:history:bot:1" not in fake.data
+        result = history_store.fetch_messages("matvey-3000:history:bot:1", limit=-1)
+        assert [m.text for m in result] == [m.text for m in sample_messages]
+
+    def test_clear_temp_images_uses_scan(self, message_store, mock_redis):
+        mock_redis.scan_iter.return_value = iter([b"matvey-3000:temp_image:1:2:original"])
+
+        assert message_store.clear_temp_images(1, 2) == 1
+
+        mock_redis.delete.assert_called_once_with("matvey-3000:temp_image:1:2:original")
+        mock_redis.keys.assert_not_called()
+
+
+    def test_compact_history_rewrites_json_entries(self, history_store, sample_messages):
+        history_store.save_many("test:key", sample_messages[:2], max_messages=None)
+        bucket = history_store.redis_conn.data["test:key:b:0"]
+        bucket[0] = sample_messages[0].serialize_json().encode()
+        history_store.redis_conn.expire_at["test:key:b:0"] = 123
+
+        assert history_store.compact_history("test:key") == 1
+
+        assert all(StoredChatMessage.is_compact(entry) for entry in bucket)
+        assert history_store.redis_conn.expire_at["test:key:b:0"] == 123
+        assert history_store.compact_history("test:key") == 0
+
+
+class TestAsyncMessageStore:
+    """Test AsyncMessageStore mirrors MessageStore behaviour."""
+
+    async def test_save_message(self, async_history_store, sample_messages):
+        msg = sample_messages[0]
+
+        bucket_len = await async_history_store.save("test:key", msg)
+
+        assert bucket_len == 1
+        assert async_history_store.redis_conn.data["test:key:b:0"] == [msg.serialize()]
+        assert async_history_store.redis_conn.data[HISTORY_INDEX_KEY].keys() == {b"test:key"}
+
+    async def test_fetch_messages(self, async_history_store, sample_messages):
+        await async_history_store.save_many("test:key", sample_messages, max_messages=None)
+
+        result = await async_history_store.fetch_messages("test:key", limit=10)
+
+        assert [(m.from_username, m.timestamp, m.text) for m in result] == [
+            (m.from_username, m.timestamp, m.text) for m in sample_messages
+        ]
+
+    async def test_fetch_messages_since(self, async_history_store):
+        hour = HISTORY_BUCKET_SECONDS
+        messages = [StoredChatMessage("Chat", "user1", "User", t, f"at {t}") for t in (0, hour, 2 * hour)]
+        await async_history_store.save_many("test:key", messages, max_messages=None)
+
+        result = await async_history_store.fetch_messages_since("test:key", since=hour)
+
+        assert [m.timestamp for m in result] == [hour, 2 * hour]
+
+    async def test_iter_messages_reads_fixed_windows(self, async_history_store):
+        hour = HISTORY_BUCKET_SECONDS
+        messages = [StoredChatMessage("Chat", "user1", "User", t, f"m{t}") for t in (0, 1, 2, 3, 4, hour)]
+        await async_history_store.save_many("test:key", messages, max_messages=None)
+        async_history_store.redis_conn.commands.clear()
+
+        windows = [window async for window in async_history_store.iter_messages("test:key", window=2)]
+
+        assert [[m.text for m in window] for window in windows] == [["m0", "m1"], ["m2", "m3"], ["m4"], [f"m{hour}"]]
+        assert await async_history_store.count_messages("test:key") == 6
+        ranges = [args for name, args in async_history_store.redis_conn.commands if name == "lrange"]
+        assert ranges == [("test:key:b:0", 0, 1), ("test:key:b:0", 2, 3), ("test:key:b:0", 4, 5),
+                          (f"test:key:b:{hour}", 0, 1)]
+
+    async def test_fetch_conversation_history(self, async_history_store, sample_messages):
+        await async_history_store.save_many("test:key", sample_messages, max_messages=None)
+
+        result = await async_history_store.fetch_conversation_history(
+            "test:key", limit=10, bot_username="testbot"
+        )
+
+        assert [role for role, _ in result] == ['user', 'assistant', 'user', 'assistant']
+
+    async def test_clear_conversation_history(self, async_history_store, sample_messages):
+        await async_history_store.save_many("test:key", sample_messages, max_messages=None)
+
+        deleted_count = await async_history_store.clear_conversation_history("test:key")
+
+        assert deleted_count == len(sample_messages)
+        assert await async_history_store.fetch_messages("test:key", limit=-1) == []
+
+    async def test_save_applies_count_retention(self, async_history_store):
+        hour = HISTORY_BUCKET_SECONDS
+        for t in range(4):
+            msg = StoredChatMessage("Chat", "user1", "User", t * hour, f"m{t}")
+            await async_history_store.save("test:key", msg, max_messages=2)
+
+        result = await async_history_store.fetch_messages("test:key", limit=-1)
+
+        assert [m.text for m in result] == ["m2", "m3"]
+        assert "test:key:b:0" not in async_history_store.redis_conn.data
+
+    async def test_migrate_legacy_history(self, async_history_store, sample_messages):
+        fake = async_history_store.redis_conn
+        fake.data["matvey-3000:history:bot:1"] = [msg.serialize_json().encode() for msg in sample_messages]
+
+        legacy = [key async for key in async_history_store.legacy_history_keys()]
+        await async_history_store.migrate_legacy_history(legacy[0], max_messages=2)
+
+        assert legacy == ["matvey-3000:history:bot:1"]
+        result = await async_history_store.fetch_messages("matvey-3000:history:bot:1", limit=-1)
+        assert [m.text for m in result] == [m.text for m in sample_messages[2:]]
+
+    async def test_migrate_legacy_history_twice(self, async_history_store, sample_messages):
+        """Migrations running side by side, or again later, move a list only once."""
+        key = "matvey-3000:history:bot:1"
+        async_history_store.redis_conn.data[key] = [msg.serialize_json().encode() for msg in sample_messages]
+
+        moved = await asyncio.gather(
+            async_history_store.migrate_legacy_history(key, max_messages=None),
+            async_history_store.migrate_legacy_history(key, max_messages=None),
+        )
+        moved.append(await async_history_store.migrate_legacy_history(key, max_messages=None))
+
+        assert sorted(moved) == [0, 0, len(sample_messages)]
+        result = await async_history_store.fetch_messages(key, limit=-1)
+        assert [m.text for m in result] == [m.text for m in sample_messages]
+        assert [k for k in async_history_store.redis_conn.data if "migrating" in k] == []
+
+    async def test_build_context_messages_empty_history(self, async_history_store):
+        system_prompt = ('system', 'You are a helpful bot')
+
+        result = await async_history_store.build_context_messages(
+            key="test:key",
+            limit=10,
+            bot_username="testbot",
+            system_prompt=system_prompt,
+        )
+
+        assert result == [system_prompt]
+
+    async def test_tts_text_roundtrip(self, async_message_store, mock_async_redis):
+        mock_async_redis.get.return_value = 'hello'.encode()
+
+        await async_message_store.store_tts_text('bot', 1, 2, 3, 'hello')
+        text = await async_message_store.get_tts_text('bot', 1, 2, 3)
+
+        assert text == 'hello'
+        mock_async_redis.setex.assert_awaited_once_with('matvey-3000:tts:bot:1:2:3', 300, 'hello')
+
+    async def test_store_cached_response_evicts_least_recently_used(self, async_message_store, mock_async_redis):
+        pipe = mock_async_redis.pipeline.return_value
+        pipe.execute.return_value = [True, 1, 0, True, 12]
+        mock_async_redis.zpopmin.return_value = [(b'old:1', 1.0), (b'old:2', 2.0)]
+
+        evicted = await async_message_store.store_cached_response(
+            'new', 'value', ttl_seconds=60, index_key='index', max_entries=10
+        )
+
+        assert evicted == 2
+        pipe.setex.assert_called_once_with('new', 60, 'value')
+        mock_async_redis.zpopmin.assert_awaited_once_with('index', 2)
+        mock_async_redis.delete.assert_awaited_once_with(b'old:1', b'old:2')
+
+    async def test_store_cached_response_below_limit(self, async_message_store, mock_async_redis):
+        pipe = mock_async_redis.pipeline.return_value
+        pipe.execute.return_value = [True, 1, 0, True, 3]
+
+        evicted = await async_message_store.store_cached_response(
+            'new', 'value', ttl_seconds=60, index_key='index', max_entries=10
+        )
+
+        assert evicted == 0
+        mock_async_redis.zpopmin.assert_not_awaited()
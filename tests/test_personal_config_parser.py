@@ -78,6 +78,10 @@ def tmp_path_toml_config_v4(tmp_path, bot_me, user1_id, user2_id, default_prompt
       This phrase can be used to express surprise at something attractive
     """
 
+    [rate_limits.openai."gpt-3.5-turbo-1106"]
+    requests_per_minute = 500
+    tokens_per_minute = 60000
+
     [[chats.allowed]]
     id = {user1_id}
     who = "user1"
@@ -85,6 +89,9 @@ def tmp_path_toml_config_v4(tmp_path, bot_me, user1_id, user2_id, default_prompt
     custom prompt for chat_id={user1_id}
     this chat wants different prompt
     """
+    fallback_providers = ["openai", "yandexgpt"]
+    history_max_age_days = 30
+    history_max_messages = 0
 
     [[chats.allowed]]
     id = {user2_id}
@@ -129,3 +136,36 @@ def test_config_can_override_prompt_for_user1_no_effect_on_user2(
     # changing prompt for one user cannot override prompt for another one
     new_prompt2 = config[user2_id].prompt
     assert prompt_u2 == new_prompt2
+
+
+def test_provider_chain_starts_with_chat_provider_and_skips_repeats(
+    tmp_path_toml_config_v4, user1_id, user2_id
+):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+
+    assert config.provider_chain_for_chat_id(user1_id) == ['yandexgpt', 'openai']
+    assert config.provider_chain_for_chat_id(user2_id) == ['yandexgpt']
+
+    config.override_provider_for_chat_id(user1_id, config.PROVIDER_ANTHROPIC)
+    assert config.provider_chain_for_chat_id(user1_id) == ['anthropic', 'openai', 'yandexgpt']
+
+
+def test_rate_limits_are_keyed_by_provider_and_model(tmp_path_toml_config_v4):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+
+    limit = config.rate_limit_for('openai', 'gpt-3.5-turbo-1106')
+    assert limit.requests_per_minute == 500
+    assert limit.tokens_per_minute == 60000
+    assert config.rate_limit_for('yandexgpt', 'yandexgpt-lite') is None
+
+
+def test_history_retention_per_chat(tmp_path_toml_config_v4, user1_id, user2_id):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+
+    assert config[user1_id].history_max_age_seconds == 30 * 86400
+    assert config[user1_id].history_max_messages is None
+    assert config[user2_id].history_max_age_seconds is None
+    assert config[user2_id].history_max_messages == 2000
@@ -0,0 +1,138 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+
+from config import RateLimit
+from quotas import COMPLETION_TOKENS_ESTIMATE, ProviderQuota, QuotaExhausted, QuotaRegistry, TokenBucket, estimate_tokens
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSleep:
+    def __init__(self, clock):
+        self.clock = clock
+        self.slept = []
+
+    async def __call__(self, seconds):
+        self.slept.append(seconds)
+        self.clock.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+class TestTokenBucket:
+    def test_starts_full_and_refills_per_minute(self, clock):
+        bucket = TokenBucket(60, clock)
+        assert bucket.wait_for(60) == 0
+
+        bucket.take(60)
+        assert bucket.wait_for(1) == pytest.approx(1.0)
+
+        clock.now = 30
+        assert bucket.wait_for(30) == 0
+        assert bucket.wait_for(31) == pytest.approx(1.0)
+
+    def test_debt_is_repaid_in_order(self, clock):
+        bucket = TokenBucket(60, clock)
+        bucket.take(60)
+        bucket.take(10)
+
+        assert bucket.wait_for(5) == pytest.approx(15.0)
+
+    def test_oversized_request_waits_for_full_bucket_only(self, clock):
+        bucket = TokenBucket(60, clock)
+        bucket.take(30)
+
+        assert bucket.wait_for(1000) == pytest.approx(30.0)
+
+    def test_drain_holds_off_refill(self, clock):
+        bucket = TokenBucket(60, clock)
+        bucket.drain(5)
+
+        assert bucket.wait_for(1) == pytest.approx(6.0)
+
+
+class TestProviderQuota:
+    async def test_waits_instead_of_failing(self, clock):
+        sleep = FakeSleep(clock)
+        quota = ProviderQuota('openai/gpt', requests_per_minute=2, max_wait=60, clock=clock, sleep=sleep)
+
+        await quota.acquire(100)
+        await quota.acquire(100)
+        await quota.acquire(100)
+
+        assert sleep.slept == [pytest.approx(30.0)]
+
+    async def test_tokens_per_minute_limit(self, clock):
+        sleep = FakeSleep(clock)
+        quota = ProviderQuota('openai/gpt', tokens_per_minute=600, max_wait=60, clock=clock, sleep=sleep)
+
+        await quota.acquire(600)
+        await quota.acquire(100)
+
+        assert sleep.slept == [pytest.approx(10.0)]
+
+    async def test_fails_when_wait_is_too_long(self, clock):
+        quota = ProviderQuota('openai/gpt', requests_per_minute=1, max_wait=10, clock=clock)
+        await quota.acquire(1)
+
+        with pytest.raises(QuotaExhausted):
+            await quota.acquire(1)
+
+    async def test_settle_returns_unused_tokens(self, clock):
+        quota = ProviderQuota('openai/gpt', tokens_per_minute=1000, clock=clock)
+        await quota.acquire(1000)
+
+        quota.settle(estimated=1000, tokens_used=400, retry_after=None)
+
+        assert quota.tokens.wait_for(600) == 0
+
+    async def test_rate_limit_feeds_back_into_buckets(self, clock):
+        quota = ProviderQuota('openai/gpt', requests_per_minute=60, max_wait=60, clock=clock)
+        await quota.acquire(1)
+
+        quota.settle(estimated=1, tokens_used=None, retry_after=5)
+
+        assert quota.requests.wait_for(1) == pytest.approx(6.0)
+
+    async def test_cancelled_waiter_gives_its_reservation_back(self, clock):
+        async def sleep(seconds):
+            await asyncio.Event().wait()
+
+        quota = ProviderQuota('openai/gpt', requests_per_minute=1, max_wait=120, clock=clock, sleep=sleep)
+        await quota.acquire(1)
+        task = asyncio.create_task(quota.acquire(1))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert quota.requests.wait_for(1) == pytest.approx(60.0)
+
+
+def test_registry_only_limits_configured_models():
+    registry = QuotaRegistry()
+
+    assert registry.get('openai', 'gpt-4o', None) is None
+    quota = registry.get('openai', 'gpt-4o', RateLimit(requests_per_minute=10))
+    assert registry.get('openai', 'gpt-4o', RateLimit(requests_per_minute=10)) is quota
+    assert quota.tokens is None
+
+
+def test_estimate_covers_prompt_and_completion():
+    estimate = estimate_tokens([('system', 'be nice'), ('user', 'hello there')])
+
+    assert COMPLETION_TOKENS_ESTIMATE < estimate < COMPLETION_TOKENS_ESTIMATE + 20
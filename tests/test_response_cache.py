@@ -0,0 +1,92 @@
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+from unittest.mock import AsyncMock
+
+from providers import TextResponse
+from response_cache import ResponseCache, messages_parts
+
+
+class FakeStore:
+    def __init__(self):
+        self.data = {}
+
+    async def get_cached_response(self, key, index_key):
+        return self.data.get(key)
+
+    async def store_cached_response(self, key, value, ttl_seconds, index_key, max_entries):
+        self.data[key] = value
+        return 0
+
+
+@pytest.fixture
+def cache():
+    return ResponseCache(FakeStore(), namespace='testbot', max_value_bytes=100)
+
+
+class TestResponseCache:
+    async def test_second_request_is_served_from_cache(self, cache):
+        generate = AsyncMock(return_value=TextResponse(success=True, text='hello'))
+        parts = messages_parts('openai', 'gpt-4o', [('system', 'translate'), ('user', 'привет')])
+
+        first = await cache.get_or_generate('translation', parts, generate)
+        second = await cache.get_or_generate('translation', parts, generate)
+
+        assert first.text == second.text == 'hello'
+        assert second.success
+        generate.assert_awaited_once()
+
+    async def test_key_depends_on_model_and_content(self, cache):
+        messages = [('user', 'hi')]
+        keys = {
+            cache.key('translation', *messages_parts('openai', 'gpt-4o', messages)),
+            cache.key('translation', *messages_parts('openai', 'gpt-4o-mini', messages)),
+            cache.key('translation', *messages_parts('openai', 'gpt-4o', [('user', 'hey')])),
+            cache.key('image_description', 'openai', 'gpt-4o', b'\x89PNG'),
+        }
+        assert len(keys) == 4
+
+    async def test_fallback_reply_is_cached_under_the_provider_that_answered(self, cache):
+        messages = [('system', 'translate'), ('user', 'привет')]
+        generate = AsyncMock(return_value=TextResponse(
+            success=True, text='hello', provider='anthropic', model='claude',
+        ))
+
+        def parts_for_reply(reply):
+            return messages_parts(reply.provider, reply.model, messages)
+
+        await cache.get_or_generate(
+            'translation', messages_parts('openai', 'gpt-4o', messages), generate, parts_for_reply=parts_for_reply,
+        )
+
+        assert set(cache.store.data) == {cache.key('translation', *messages_parts('anthropic', 'claude', messages))}
+
+    async def test_failures_are_not_cached(self, cache):
+        generate = AsyncMock(return_value=TextResponse(success=False, text='rate limit'))
+
+        await cache.get_or_generate('translation', ('a',), generate)
+        await cache.get_or_generate('translation', ('a',), generate)
+
+        assert generate.await_count == 2
+        assert cache.store.data == {}
+
+    async def test_oversized_replies_are_not_cached(self, cache):
+        generate = AsyncMock(return_value=TextResponse(success=True, text='x' * 101))
+
+        await cache.get_or_generate('translation', ('a',), generate)
+
+        assert cache.store.data == {}
+
+    async def test_store_errors_fall_through_to_provider(self, cache):
+        cache.store.get_cached_response = AsyncMock(side_effect=ConnectionError('redis down'))
+        generate = AsyncMock(return_value=TextResponse(success=True, text='hello'))
+
+        reply = await cache.get_or_generate('translation', ('a',), generate)
+
+        assert reply.text == 'hello'
@@ -0,0 +1,152 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import httpx
+import openai
+import pytest
+from unittest.mock import AsyncMock
+
+from retry import RetryPolicy, is_connect_error, is_retryable_error, is_transient_error, is_transient_response
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSleep:
+    def __init__(self, clock):
+        self.clock = clock
+        self.slept = []
+
+    async def __call__(self, seconds):
+        self.slept.append(seconds)
+        self.clock.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def sleep(clock):
+    return FakeSleep(clock)
+
+
+def status_error(status_code, headers=None):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return openai.APIStatusError('error', response=response, body=None)
+
+
+def rate_limit_error(headers=None):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError('rate limited', response=response, body=None)
+
+
+@pytest.mark.parametrize('error, retryable', [
+    (TimeoutError(), True),
+    (httpx.ConnectError('refused'), True),
+    (status_error(503), True),
+    (status_error(400), False),
+    (rate_limit_error(), True),
+    (ValueError('bad json'), False),
+])
+def test_error_classification(error, retryable):
+    assert is_retryable_error(error) is retryable
+
+
+def test_rate_limits_are_not_transient():
+    assert not is_transient_error(rate_limit_error())
+    assert is_transient_error(status_error(503))
+    assert not is_transient_response(httpx.Response(429))
+    assert is_transient_response(httpx.Response(502))
+
+
+def test_only_failed_connects_are_safe_to_repeat():
+    request = httpx.Request('POST', 'https://api.openai.com/v1/images/generations')
+    refused = openai.APIConnectionError(request=request)
+    refused.__cause__ = httpx.ConnectError('refused')
+
+    assert is_connect_error(refused)
+    assert not is_connect_error(openai.APITimeoutError(request=request))
+    assert not is_connect_error(status_error(503))
+
+
+def test_backoff_is_capped_and_jittered():
+    policy = RetryPolicy(base_delay=1.0, max_delay=4.0)
+
+    delays = [policy.backoff(attempt) for attempt in range(1, 10) for _ in range(20)]
+
+    assert all(0 <= delay <= 4.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_backoff_follows_retry_after_unless_too_long():
+    policy = RetryPolicy(max_delay=4.0)
+
+    assert policy.backoff(1, retry_after=2.0) == 2.0
+    assert policy.backoff(1, retry_after=30.0) is None
+
+
+async def test_retries_transient_errors_until_success(clock, sleep):
+    policy = RetryPolicy(max_attempts=3, clock=clock, sleep=sleep)
+    call = AsyncMock(side_effect=[TimeoutError(), status_error(502), 'ok'])
+
+    assert await policy.run('test', call) == 'ok'
+    assert call.await_count == 3
+    assert len(sleep.slept) == 2
+
+
+async def test_gives_up_after_max_attempts(clock, sleep):
+    policy = RetryPolicy(max_attempts=2, clock=clock, sleep=sleep)
+    call = AsyncMock(side_effect=TimeoutError())
+
+    with pytest.raises(TimeoutError):
+        await policy.run('test', call)
+    assert call.await_count == 2
+
+
+async def test_does_not_retry_permanent_errors(clock, sleep):
+    policy = RetryPolicy(clock=clock, sleep=sleep)
+    call = AsyncMock(side_effect=status_error(400))
+
+    with pytest.raises(openai.APIStatusError):
+        await policy.run('test', call)
+    assert call.await_count == 1
+
+
+async def test_stops_at_deadline(clock, sleep):
+    policy = RetryPolicy(max_attempts=10, base_delay=4.0, max_delay=4.0, deadline=5.0, clock=clock, sleep=sleep)
+    call = AsyncMock(side_effect=rate_limit_error(headers={'retry-after': '3'}))
+
+    with pytest.raises(openai.RateLimitError):
+        await policy.run('test', call)
+    assert sleep.slept == [3.0]
+
+
+async def test_retryable_results_are_retried_and_last_one_returned(clock, sleep):
+    policy = RetryPolicy(max_attempts=2, clock=clock, sleep=sleep)
+    unavailable = httpx.Response(503)
+    call = AsyncMock(return_value=unavailable)
+
+    result = await policy.run('test', call, retry_result=lambda r: r.status_code >= 500)
+
+    assert result is unavailable
+    assert call.await_count == 2
+
+
+async def test_retry_error_narrows_what_is_retried(clock, sleep):
+    policy = RetryPolicy(clock=clock, sleep=sleep)
+    call = AsyncMock(side_effect=rate_limit_error())
+
+    with pytest.raises(openai.RateLimitError):
+        await policy.run('test', call, retry_error=is_transient_error)
+    assert call.await_count == 1
@@ -0,0 +1,204 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+
+from providers import TextResponse
+from routing import CircuitBreaker, LatencyTracker, ProviderRouter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+OK = TextResponse(success=True, text='hello')
+RATE_LIMITED = TextResponse(success=False, text='rate limited', retryable=True)
+BAD_REQUEST = TextResponse(success=False, text='bad request')
+THROTTLED = TextResponse(success=False, text='quota exhausted', retryable=True, throttled=True)
+
+
+def replies(**by_provider):
+    """A provider call returning canned replies, recording who was called."""
+    calls = []
+
+    async def call(provider):
+        calls.append(provider)
+        reply = by_provider[provider]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    return call, calls
+
+
+class TestCircuitBreaker:
+    def test_opens_once_failure_ratio_reached(self):
+        breaker = CircuitBreaker(min_requests=4, failure_ratio=0.5, clock=FakeClock())
+        for ok in (True, True, False):
+            breaker.record(ok)
+        assert not breaker.is_open
+
+        breaker.record(False)
+
+        assert breaker.is_open
+        assert not breaker.allow()
+
+    def test_old_failures_leave_the_window(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(window_seconds=60, min_requests=3, failure_ratio=0.5, clock=clock)
+        breaker.record(False)
+        breaker.record(False)
+        clock.now = 100
+        breaker.record(True)
+
+        assert not breaker.is_open
+
+    def test_single_probe_after_cooldown(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(min_requests=1, cooldown_seconds=30, clock=clock)
+        breaker.record(False)
+
+        clock.now = 31
+        assert breaker.allow()
+        assert not breaker.allow()
+
+        breaker.record(True)
+        assert not breaker.is_open
+        assert breaker.allow()
+
+    def test_failed_probe_keeps_circuit_open(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(min_requests=1, cooldown_seconds=30, clock=clock)
+        breaker.record(False)
+        clock.now = 31
+        assert breaker.allow()
+
+        breaker.record(False)
+
+        assert breaker.is_open
+        clock.now = 50
+        assert not breaker.allow()
+
+
+def test_latency_percentile_needs_enough_samples():
+    tracker = LatencyTracker(samples=100, min_samples=10)
+    for seconds in range(1, 10):
+        tracker.observe(seconds)
+    assert tracker.percentile(0.95) is None
+
+    for seconds in range(10, 101):
+        tracker.observe(seconds)
+    assert tracker.percentile(0.95) == 95
+
+
+class TestProviderRouter:
+    async def test_first_provider_answers(self):
+        call, calls = replies(openai=OK, anthropic=OK)
+
+        reply = await ProviderRouter().run(['openai', 'anthropic'], call)
+
+        assert reply == OK
+        assert calls == ['openai']
+
+    async def test_fails_over_on_retryable_error(self):
+        call, calls = replies(openai=RATE_LIMITED, anthropic=OK)
+
+        reply = await ProviderRouter().run(['openai', 'anthropic'], call)
+
+        assert reply == OK
+        assert calls == ['openai', 'anthropic']
+
+    async def test_bad_request_is_not_retried(self):
+        call, calls = replies(openai=BAD_REQUEST, anthropic=OK)
+
+        reply = await ProviderRouter().run(['openai', 'anthropic'], call)
+
+        assert reply == BAD_REQUEST
+        assert calls == ['openai']
+
+    async def test_last_error_returned_when_every_provider_fails(self):
+        call, calls = replies(openai=RATE_LIMITED, anthropic=RATE_LIMITED)
+
+        reply = await ProviderRouter().run(['openai', 'anthropic'], call)
+
+        assert reply == RATE_LIMITED
+        assert calls == ['openai', 'anthropic']
+
+    async def test_own_quota_running_dry_is_not_a_provider_failure(self):
+        router = ProviderRouter(breaker_factory=lambda: CircuitBreaker(min_requests=1))
+        call, calls = replies(openai=THROTTLED, anthropic=OK)
+
+        assert await router.run(['openai', 'anthropic'], call) == OK
+        assert calls == ['openai', 'anthropic']
+        assert not router.breaker('openai').is_open
+
+    async def test_exception_fails_over_and_is_reraised_when_nothing_is_left(self):
+        call, calls = replies(openai=RuntimeError('boom'), anthropic=OK)
+        router = ProviderRouter()
+        assert await router.run(['openai', 'anthropic'], call) == OK
+
+        with pytest.raises(RuntimeError):
+            await router.run(['openai'], call)
+
+    async def test_open_circuit_is_skipped(self):
+        router = ProviderRouter(breaker_factory=lambda: CircuitBreaker(min_requests=1))
+        router.record('openai', ok=False)
+        call, calls = replies(openai=OK, anthropic=OK)
+
+        reply = await router.run(['openai', 'anthropic'], call)
+
+        assert reply == OK
+        assert calls == ['anthropic']
+
+    async def test_preferred_provider_tried_when_all_circuits_are_open(self):
+        router = ProviderRouter(breaker_factory=lambda: CircuitBreaker(min_requests=1))
+        router.record('openai', ok=False)
+        router.record('anthropic', ok=False)
+        call, calls = replies(openai=OK, anthropic=OK)
+
+        assert await router.run(['openai', 'anthropic'], call) == OK
+        assert calls == ['openai']
+
+    async def test_hedges_slow_provider_and_cancels_the_loser(self):
+        slow_cancelled = asyncio.Event()
+
+        async def call(provider):
+            if provider == 'openai':
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    slow_cancelled.set()
+                    raise
+            return TextResponse(success=True, text=provider)
+
+        router = ProviderRouter(hedge_default_delay=0.01)
+        reply = await router.run(['openai', 'anthropic'], call, hedge=True)
+
+        assert reply.text == 'anthropic'
+        assert slow_cancelled.is_set()
+
+    async def test_no_hedge_without_hedging(self):
+        async def call(provider):
+            await asyncio.sleep(0.05)
+            return TextResponse(success=True, text=provider)
+
+        router = ProviderRouter(hedge_default_delay=0.01)
+        reply = await router.run(['openai', 'anthropic'], call)
+
+        assert reply.text == 'openai'
+
+    async def test_hedge_delay_follows_p95_latency(self):
+        router = ProviderRouter(hedge_default_delay=8.0)
+        assert router.hedge_delay('openai') == 8.0
+
+        for _ in range(20):
+            router.record('openai', ok=True, latency=2.0)
+
+        assert router.hedge_delay('openai') == 2.0
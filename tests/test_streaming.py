@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import httpx
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+from unittest.mock import AsyncMock, MagicMock
+
+import providers
+from providers import TextResponse
+from streaming import ProgressiveReply
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def mock_message():
+    message = MagicMock()
+    message.reply = AsyncMock()
+    message.answer = AsyncMock()
+    message.reply.return_value.edit_text = AsyncMock()
+    return message
+
+
+@pytest.fixture
+def progressive(mock_message, clock):
+    return ProgressiveReply(mock_message, edit_interval=1.0, min_chars=5, clock=clock)
+
+
+async def test_first_update_replies_with_the_text_at_once(progressive, mock_message):
+    await progressive.update('Hi')
+
+    mock_message.reply.assert_awaited_once_with('Hi')
+
+
+async def test_first_reply_falls_back_to_plain_text(progressive, mock_message):
+    sent = mock_message.reply.return_value
+    mock_message.reply.side_effect = [TelegramBadRequest(method=MagicMock(), message="can't parse entities"), sent]
+
+    await progressive.update('<b>Hi')
+
+    assert mock_message.reply.await_args.kwargs == {'parse_mode': None}
+    assert progressive.sent is sent
+
+
+async def test_updates_are_coalesced_by_time_and_size(progressive, mock_message, clock):
+    sent = mock_message.reply.return_value
+    await progressive.update('H')
+
+    # too early
+    await progressive.update('Hello there')
+    sent.edit_text.assert_not_awaited()
+
+    # interval passed, enough new text
+    clock.now = 1.0
+    await progressive.update('Hello there')
+    sent.edit_text.assert_awaited_once_with('Hello there')
+
+    # interval passed, but too little new text
+    clock.now = 5.0
+    await progressive.update('Hello there!')
+    assert sent.edit_text.await_count == 1
+
+
+async def test_finish_edits_final_text(progressive, mock_message):
+    sent = mock_message.reply.return_value
+    await progressive.update('H')
+
+    await progressive.finish('Hello there, full reply', success=True)
+
+    sent.edit_text.assert_awaited_once_with('Hello there, full reply')
+
+
+async def test_throttled_final_edit_is_retried_after_the_wait(mock_message, clock):
+    sleep = AsyncMock()
+    progressive = ProgressiveReply(mock_message, edit_interval=1.0, min_chars=5, clock=clock, sleep=sleep)
+    sent = mock_message.reply.return_value
+    await progressive.update('H')
+    sent.edit_text.side_effect = [TelegramRetryAfter(method=MagicMock(), message='flood', retry_after=3), None]
+
+    await progressive.finish('Hello there', success=True)
+
+    sleep.assert_awaited_once_with(3)
+    assert sent.edit_text.await_count == 2
+    mock_message.answer.assert_not_awaited()
+
+
+async def test_failed_final_edit_sends_the_text_anew(progressive, mock_message):
+    sent = mock_message.reply.return_value
+    await progressive.update('H')
+    sent.edit_text.side_effect = TelegramNetworkError(method=MagicMock(), message='bad gateway')
+
+    await progressive.finish('Hello there', success=True)
+
+    mock_message.answer.assert_awaited_once_with('Hello there')
+
+
+async def test_finish_without_stream_falls_back_to_answer(progressive, mock_message):
+    await progressive.finish('rate limited', success=False)
+
+    mock_message.answer.assert_awaited_once_with('rate limited')
+    mock_message.reply.assert_not_awaited()
+
+
+async def test_yandexgpt_stream_yields_deltas_from_cumulative_lines():
+    lines = [
+        {'result': {'alternatives': [{'message': {'role': 'assistant', 'text': text}}]}}
+        for text in ['Hel', 'Hello', 'Hello, world']
+    ]
+    body = '\n'.join(json.dumps(line) for line in lines)
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, text=body))
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        deltas = [
+            delta
+            async for delta in TextResponse._stream_yandexgpt(
+                client, 'yandexgpt-lite', [('user', 'hi')]
+            )
+        ]
+
+    assert deltas == ['Hel', 'lo', ', world']
+
+
+class StreamConfig:
+    PROVIDER_OPENAI = 'openai'
+    PROVIDER_ANTHROPIC = 'anthropic'
+    PROVIDER_YANDEXGPT = 'yandexgpt'
+
+    def model_for_provider(self, provider):
+        return 'gpt-test'
+
+    def rate_limit_for(self, provider, model):
+        return None
+
+
+@pytest.fixture
+def stream_router(monkeypatch):
+    router = MagicMock()
+    monkeypatch.setattr(providers, 'router', router)
+    return router
+
+
+def stream_of(*deltas, error=None):
+    async def stream(cls, client, model, messages):
+        for delta in deltas:
+            yield delta
+        if error is not None:
+            raise error
+    return classmethod(stream)
+
+
+async def test_failing_callback_is_not_a_provider_failure(monkeypatch, stream_router):
+    monkeypatch.setattr(TextResponse, '_stream_openai', stream_of('Hel', 'lo'))
+    on_text = AsyncMock(side_effect=RuntimeError('telegram is down'))
+
+    reply, shown = await TextResponse._stream_with(StreamConfig(), 'openai', [('user', 'hi')], on_text)
+
+    assert reply.success and reply.text == 'Hello'
+    assert not shown
+    on_text.assert_awaited_once()
+    stream_router.record.assert_called_once_with('openai', ok=True)
+
+
+async def test_quota_is_given_back_when_the_stream_fails(monkeypatch, stream_router):
+    quota = MagicMock()
+    quota.acquire = AsyncMock()
+    monkeypatch.setattr(providers, 'quotas', MagicMock(get=MagicMock(return_value=quota)))
+    monkeypatch.setattr(TextResponse, '_stream_openai', stream_of(error=RuntimeError('boom')))
+
+    with pytest.raises(RuntimeError):
+        await TextResponse._stream_with(StreamConfig(), 'openai', [('user', 'hi')], AsyncMock())
+
+    estimated = quota.acquire.await_args.args[0]
+    quota.settle.assert_called_once_with(estimated, 0, None)
+    stream_router.record.assert_called_once_with('openai', ok=False)
+
+
+async def test_quota_is_settled_when_a_call_is_cancelled(monkeypatch):
+    quota = MagicMock()
+    quota.acquire = AsyncMock()
+    monkeypatch.setattr(providers, 'quotas', MagicMock(get=MagicMock(return_value=quota)))
+    started = asyncio.Event()
+
+    async def generate_from(cls, config, provider, model, messages):
+        started.set()
+        await asyncio.Event().wait()
+    monkeypatch.setattr(TextResponse, '_generate_from', classmethod(generate_from))
+
+    task = asyncio.create_task(TextResponse._generate_within_quota(StreamConfig(), 'openai', 'gpt', [('user', 'hi')]))
+    await started.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    estimated = quota.acquire.await_args.args[0]
+    quota.settle.assert_called_once_with(estimated, None, None)
@@ -0,0 +1,197 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+
+from message_store import StoredChatMessage
+from providers import TextResponse
+from summarizer import (
+    CHUNK_PROMPT,
+    FINAL_PROMPT,
+    SummaryCache,
+    SummaryEngine,
+    chunk_texts,
+    split_into_windows,
+)
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+class FakeLLM:
+    """Summarises every chunk into a fixed number of words and tracks concurrency."""
+
+    def __init__(self, summary_words=5, delay=0.01, fail_on=None):
+        self.summary_words = summary_words
+        self.delay = delay
+        self.fail_on = fail_on
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    async def __call__(self, messages):
+        self.calls.append(messages)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if self.fail_on and self.fail_on in messages[1][1]:
+            return TextResponse(success=False, text='rate limited')
+        if messages[0][1] == FINAL_PROMPT:
+            return TextResponse(success=True, text='final recap')
+        return TextResponse(success=True, text=' '.join(['sum'] * self.summary_words))
+
+
+def make_engine(llm, concurrency=3, max_chunk_tokens=400, on_progress=None):
+    budget = count_words(FINAL_PROMPT) + max_chunk_tokens // 2
+    return SummaryEngine(
+        generate=llm,
+        count_tokens=count_words,
+        semaphore=asyncio.Semaphore(concurrency),
+        max_chunk_tokens=budget,
+        on_progress=on_progress,
+        progress_interval=0,
+    )
+
+
+@pytest.fixture
+def texts():
+    return [f'user{i}: ' + 'word ' * 20 for i in range(100)]
+
+
+async def test_chunks_run_concurrently_within_limit(texts):
+    llm = FakeLLM()
+    engine = make_engine(llm, concurrency=3)
+
+    reply = await engine.summarize(texts)
+
+    assert reply == TextResponse(success=True, text='final recap')
+    assert llm.max_in_flight == 3
+    assert llm.calls[-1][0] == ('system', FINAL_PROMPT)
+
+
+async def test_reduce_runs_as_tree_until_it_fits(texts):
+    llm = FakeLLM(summary_words=80)
+    levels = []
+
+    async def on_progress(progress):
+        levels.append((progress.level, progress.done, progress.total))
+
+    engine = make_engine(llm, on_progress=on_progress)
+
+    reply = await engine.summarize(texts)
+
+    assert reply.success
+    seen_levels = {level for level, _, _ in levels}
+    assert seen_levels == {0, 1}
+    # every level reports completion of all of its chunks
+    for level in seen_levels:
+        total = max(t for lv, _, t in levels if lv == level)
+        assert (level, total, total) in levels
+
+
+async def test_failed_chunks_are_skipped(texts):
+    llm = FakeLLM(fail_on='user0:')
+    engine = make_engine(llm)
+
+    reply = await engine.summarize(texts)
+
+    assert reply.success
+    chunk_calls = [c for c in llm.calls if c[0] == ('system', CHUNK_PROMPT)]
+    assert len(chunk_calls) > 1
+
+
+async def test_all_chunks_failed_returns_error():
+    llm = FakeLLM(fail_on='user')
+    engine = make_engine(llm)
+
+    reply = await engine.summarize(['user: hello there'])
+
+    assert reply == TextResponse(success=False, text='rate limited')
+
+
+def test_chunk_texts_packs_below_limit():
+    texts = ['a b c', 'd e', 'f g h i', 'j']
+
+    chunks = chunk_texts(texts, count_words, max_tokens=8)
+
+    assert chunks == ['a b c\nd e', 'f g h i\nj']
+
+
+def test_chunk_texts_tokenises_each_text_once():
+    calls = []
+
+    def counting(text):
+        calls.append(text)
+        return count_words(text)
+
+    texts = [f'message number {i}' for i in range(1000)]
+    chunks = chunk_texts(texts, counting, max_tokens=50)
+
+    assert len(calls) == len(texts)
+    assert '\n'.join(chunks).split('\n') == texts
+
+
+def test_chunk_texts_oversized_text_gets_own_chunk():
+    texts = ['small', 'word ' * 20, 'tail']
+
+    chunks = chunk_texts(texts, count_words, max_tokens=10)
+
+    assert chunks == ['small', ('word ' * 20).strip(), 'tail']
+
+
+def test_chunk_texts_overlap_repeats_tail_of_previous_chunk():
+    texts = ['one', 'two', 'three', 'four', 'five']
+
+    chunks = chunk_texts(texts, count_words, max_tokens=7, overlap_tokens=2)
+
+    assert chunks == ['one\ntwo\nthree', 'three\nfour\nfive']
+
+
+class FakeSummaryStore:
+    def __init__(self):
+        self.data = {}
+
+    async def get_cached_summaries(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def store_cached_summaries(self, summaries, ttl_seconds):
+        self.data.update(summaries)
+
+
+def test_split_into_windows_groups_by_time():
+    messages = [
+        StoredChatMessage('chat', 'u', 'U', ts, f'msg {ts}')
+        for ts in [0, 10, 3599, 3600, 7300]
+    ]
+
+    windows = split_into_windows(messages, window_seconds=3600)
+
+    assert [len(w) for w in windows] == [3, 1, 1]
+    assert windows[1] == [str(messages[3])]
+
+
+async def test_cached_windows_are_not_summarised_again():
+    store = FakeSummaryStore()
+    windows = [['old window ' * 5], ['another old one ' * 5]]
+
+    llm = FakeLLM()
+    engine = make_engine(llm, on_progress=None)
+    engine.cache = SummaryCache(store, namespace='bot:1')
+    await engine.summarize_windows(windows)
+    assert len(llm.calls) == 3  # two chunks + final
+
+    llm = FakeLLM()
+    engine = make_engine(llm)
+    engine.cache = SummaryCache(store, namespace='bot:1')
+    reply = await engine.summarize_windows(windows + [['fresh messages']])
+
+    assert reply.success
+    chunk_calls = [c[1][1] for c in llm.calls if c[0] == ('system', CHUNK_PROMPT)]
+    assert chunk_calls == ['fresh messages']
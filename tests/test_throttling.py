@@ -0,0 +1,144 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+from aiogram import types
+from aiogram.dispatcher.event.handler import HandlerObject
+from unittest.mock import AsyncMock, MagicMock
+
+from throttling import (
+    PROVIDER_CALL_FLAG,
+    SHED_REACTION,
+    ChatConcurrencyMiddleware,
+    ChatOverloaded,
+    FairLimiter,
+)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class TestFairLimiter:
+    async def test_per_chat_limit(self):
+        limiter = FairLimiter(global_limit=10, per_chat_limit=2, max_queued=10)
+        tasks = [asyncio.create_task(limiter.acquire(1)) for _ in range(3)]
+        await settle()
+        assert [t.done() for t in tasks] == [True, True, False]
+        assert limiter.queued == 1
+
+        limiter.release(1)
+        await settle()
+        assert tasks[2].done()
+        assert limiter.chat_in_flight(1) == 2
+
+    async def test_global_limit_is_shared_round_robin(self):
+        limiter = FairLimiter(global_limit=1, per_chat_limit=5, max_queued=10)
+        await limiter.acquire(1)  # noisy chat holds the only slot
+        order = []
+
+        async def request(chat_id):
+            await limiter.acquire(chat_id)
+            order.append(chat_id)
+
+        tasks = [asyncio.create_task(request(chat_id)) for chat_id in (1, 1, 1, 2, 3)]
+        await settle()
+        assert order == []
+
+        for _ in range(5):
+            limiter.release(order[-1] if order else 1)
+            await settle()
+        # chats 2 and 3 don't wait behind all of chat 1's backlog
+        assert order == [1, 2, 3, 1, 1]
+        await asyncio.gather(*tasks)
+
+    async def test_overflow_is_rejected(self):
+        limiter = FairLimiter(global_limit=1, per_chat_limit=1, max_queued=1)
+        await limiter.acquire(1)
+        waiting = asyncio.create_task(limiter.acquire(1))
+        await settle()
+        with pytest.raises(ChatOverloaded):
+            await limiter.acquire(1)
+        # other chats still get a place in line
+        other = asyncio.create_task(limiter.acquire(2))
+        await settle()
+        assert limiter.queued == 2
+        waiting.cancel()
+        other.cancel()
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        limiter = FairLimiter(global_limit=1, per_chat_limit=1, max_queued=5)
+        await limiter.acquire(1)
+        waiting = asyncio.create_task(limiter.acquire(2))
+        await settle()
+        waiting.cancel()
+        await settle()
+        assert limiter.queued == 0
+
+        limiter.release(1)
+        assert limiter.in_flight == 0
+        await limiter.acquire(3)
+        assert limiter.in_flight == 1
+
+
+def make_message(chat_id=-100):
+    message = MagicMock(spec=types.Message)
+    message.chat = MagicMock()
+    message.chat.id = chat_id
+    message.react = AsyncMock()
+    return message
+
+
+async def noop(message):
+    pass
+
+
+def handler_data(flagged=True):
+    flags = {PROVIDER_CALL_FLAG: True} if flagged else {}
+    return {'handler': HandlerObject(callback=noop, flags=flags)}
+
+
+class TestChatConcurrencyMiddleware:
+    async def test_unflagged_handlers_bypass_limiter(self):
+        limiter = FairLimiter(global_limit=0, per_chat_limit=0, max_queued=0)
+        middleware = ChatConcurrencyMiddleware(limiter)
+        handler = AsyncMock(return_value='ok')
+        assert await middleware(handler, make_message(), handler_data(flagged=False)) == 'ok'
+
+    async def test_slot_is_released_after_handler(self):
+        limiter = FairLimiter(global_limit=1, per_chat_limit=1, max_queued=1)
+        middleware = ChatConcurrencyMiddleware(limiter)
+        handler = AsyncMock(side_effect=RuntimeError('boom'))
+        with pytest.raises(RuntimeError):
+            await middleware(handler, make_message(), handler_data())
+        assert limiter.in_flight == 0
+
+    async def test_overflow_is_shed_with_reaction(self):
+        limiter = FairLimiter(global_limit=1, per_chat_limit=1, max_queued=0)
+        await limiter.acquire(-100)
+        middleware = ChatConcurrencyMiddleware(limiter)
+        handler = AsyncMock()
+        message = make_message(-100)
+
+        assert await middleware(handler, message, handler_data()) is None
+        handler.assert_not_called()
+        reaction = message.react.call_args.kwargs['reaction'][0]
+        assert reaction.emoji == SHED_REACTION
+
+    async def test_inline_callback_is_limited_per_user(self):
+        limiter = FairLimiter(global_limit=1, per_chat_limit=1, max_queued=0)
+        await limiter.acquire(42)
+        middleware = ChatConcurrencyMiddleware(limiter)
+        callback = MagicMock(spec=types.CallbackQuery)
+        callback.message = None
+        callback.from_user = MagicMock(id=42)
+        callback.answer = AsyncMock()
+        handler = AsyncMock()
+
+        assert await middleware(handler, callback, handler_data()) is None
+        handler.assert_not_called()
+        callback.answer.assert_awaited_once_with(SHED_REACTION)
@@ -0,0 +1,87 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import pytest
+from aiogram import Bot, Dispatcher, Router, types
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import WebhookSettings, build_webhook_app
+
+
+SECRET = 'test-secret'
+
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 10,
+        'date': 1700000000,
+        'chat': {'id': -100, 'type': 'supergroup', 'title': 'test'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Test'},
+        'text': 'hello',
+    },
+}
+
+
+@pytest.fixture
+async def webhook_client():
+    received = []
+    router = Router()
+
+    @router.message()
+    async def record(message: types.Message):
+        received.append(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot(token='42:TEST')
+    settings = WebhookSettings(path='/webhook', secret_token=SECRET)
+    app = build_webhook_app(dp, bot, settings, handle_in_background=False)
+
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    yield client, received
+    await client.close()
+
+
+class TestWebhookSettings:
+    def test_url_joins_base_and_path(self):
+        settings = WebhookSettings(base_url='https://bot.example.com/', path='/hook')
+        assert settings.url == 'https://bot.example.com/hook'
+
+    def test_url_is_none_without_base(self):
+        assert WebhookSettings().url is None
+
+    def test_from_env(self, monkeypatch):
+        monkeypatch.setenv('WEBHOOK_URL', 'https://bot.example.com')
+        monkeypatch.setenv('WEBHOOK_SECRET', 'abc')
+        monkeypatch.setenv('WEBHOOK_PORT', '9000')
+        settings = WebhookSettings.from_env()
+        assert settings.url == 'https://bot.example.com/webhook'
+        assert settings.secret_token == 'abc'
+        assert settings.port == 9000
+
+
+class TestWebhookApp:
+    async def test_update_is_dispatched(self, webhook_client):
+        client, received = webhook_client
+        resp = await client.post(
+            '/webhook', json=UPDATE, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET}
+        )
+        assert resp.status == 200
+        assert received == ['hello']
+
+    async def test_wrong_secret_is_rejected(self, webhook_client):
+        client, received = webhook_client
+        resp = await client.post(
+            '/webhook', json=UPDATE, headers={'X-Telegram-Bot-Api-Secret-Token': 'nope'}
+        )
+        assert resp.status == 401
+        assert received == []
+
+    async def test_healthz(self, webhook_client):
+        client, _ = webhook_client
+        resp = await client.get('/healthz')
+        assert resp.status == 200
+        assert await resp.text() == 'ok'